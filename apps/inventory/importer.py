@@ -0,0 +1,279 @@
+"""
+Bulk product import.
+
+Rows are read one at a time from a CSV or JSON Lines request body and
+handled in chunks. Each chunk resolves its sellers and categories with
+one query each, inserts its products with bulk_create and links their
+categories with one more bulk_create, all inside the chunk's own
+transaction. Rows that fail validation, and every row of a chunk that
+fails to insert, are reported by row number while the rest of the file
+is still imported.
+"""
+import csv
+import json
+import logging
+from collections import defaultdict
+
+from django.db import DatabaseError, transaction
+from django.db.models import Q
+from kombu.exceptions import OperationalError
+from redis import RedisError
+
+from apps.profiles.models import Company
+from utils import trigram
+from utils.search_cache import bump_generation
+from .models import Category, Product
+from .serializers import ProductImportSerializer
+from .services import ProductLeaderboard, StatsService
+from .tasks import recount_categories
+
+logger = logging.getLogger(__name__)
+
+CSV_CONTENT_TYPES = ("text/csv", "application/csv")
+JSON_LINES_CONTENT_TYPES = (
+    "application/x-ndjson",
+    "application/jsonl",
+    "application/x-jsonlines",
+)
+# CSV cells holding several values, "Food;Drinks"
+LIST_FIELDS = ("categories", "payment_methods", "shipping_information")
+LIST_SEPARATOR = ";"
+
+
+def read_rows(stream, content_type):
+    """
+    Yield (row number, row, error) for each row of a CSV or JSON Lines
+    byte stream, reading it a line at a time
+    """
+    lines = (line.decode("utf-8-sig") for line in stream)
+    if content_type in CSV_CONTENT_TYPES:
+        for number, row in enumerate(csv.DictReader(lines), start=1):
+            row = {key: value.strip() for key, value in row.items() if key and value}
+            for field in LIST_FIELDS:
+                if field in row:
+                    row[field] = [
+                        value.strip()
+                        for value in row[field].split(LIST_SEPARATOR)
+                        if value.strip()
+                    ]
+            yield number, row, None
+        return
+
+    number = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        number += 1
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            yield number, None, {"non_field_errors": [f"Invalid JSON: {error}"]}
+            continue
+        if not isinstance(row, dict):
+            yield number, None, {"non_field_errors": ["Expected a JSON object"]}
+            continue
+        yield number, row, None
+
+
+class ProductImporter:
+    CHUNK_SIZE = 500
+
+    def __init__(self, user, default_seller=None):
+        self.default_seller = default_seller
+        if user.is_superuser:
+            self.companies = Company.objects.all()
+        else:
+            self.companies = Company.objects.filter(contact_people__user=user)
+        # name -> pk, looked up once per import
+        self.sellers = {}
+        self.categories = {}
+        self.category_pks = set()
+        self.created = 0
+        self.errors = []
+
+    def run(self, rows):
+        chunk = []
+        for number, row, error in rows:
+            if error:
+                self.errors.append({"row": number, "errors": error})
+                continue
+            chunk.append((number, row))
+            if len(chunk) == self.CHUNK_SIZE:
+                self.import_chunk(chunk)
+                chunk = []
+        if chunk:
+            self.import_chunk(chunk)
+
+        if self.created:
+            bump_generation(Product, Category)
+            StatsService.invalidate()
+            category_pks = list(self.category_pks)
+            transaction.on_commit(lambda: self.recount(category_pks))
+        return {
+            "created": self.created,
+            "failed": len(self.errors),
+            "errors": sorted(self.errors, key=lambda error: error["row"]),
+        }
+
+    def validate(self, number, row):
+        errors = {}
+        serializer = ProductImportSerializer(data=row)
+        if not serializer.is_valid():
+            errors.update(serializer.errors)
+
+        seller = row.get("seller") or self.default_seller
+        if not seller:
+            errors["seller"] = ["This field is required."]
+        categories = row.get("categories") or []
+        if isinstance(categories, str):
+            categories = [categories]
+        max_length = Category._meta.get_field("name").max_length
+        if not all(
+            isinstance(name, str) and 0 < len(name) <= max_length for name in categories
+        ):
+            errors["categories"] = [
+                f"Category names must be 1 to {max_length} characters."
+            ]
+
+        if errors:
+            self.errors.append({"row": number, "errors": errors})
+            return None
+        return number, serializer.validated_data, seller, categories
+
+    def import_chunk(self, chunk):
+        rows = [row for row in (self.validate(*row) for row in chunk) if row]
+        self.resolve_sellers({seller for _, _, seller, _ in rows})
+        self.resolve_categories({name for *_, names in rows for name in names})
+
+        products, links, numbers = [], [], []
+        for number, data, seller, category_names in rows:
+            if self.sellers[seller] is None:
+                self.errors.append(
+                    {
+                        "row": number,
+                        "errors": {
+                            "seller": [f"{seller} is not one of your companies."]
+                        },
+                    }
+                )
+                continue
+            for field in ("payment_methods", "shipping_information"):
+                if field in data:
+                    data[field] = sorted(data[field])
+            products.append(Product(seller_id=self.sellers[seller], **data))
+            links.append({self.categories[name] for name in category_names})
+            numbers.append(number)
+        if not products:
+            return
+
+        for product, slug in zip(products, self.unique_slugs(products)):
+            product.slug = slug
+        try:
+            with transaction.atomic():
+                Product.objects.bulk_create(products)
+                # MySQL doesn't return the primary keys of bulk inserts
+                pks = dict(
+                    Product.objects.filter(
+                        slug__in=[product.slug for product in products]
+                    ).values_list("slug", "pk")
+                )
+                Product.categories.through.objects.bulk_create(
+                    [
+                        Product.categories.through(
+                            product_id=pks[product.slug], category_id=category_pk
+                        )
+                        for product, category_pks in zip(products, links)
+                        for category_pk in category_pks
+                    ],
+                    batch_size=1000,
+                )
+        except DatabaseError:
+            logger.exception("Could not import rows %s-%s", numbers[0], numbers[-1])
+            self.errors.extend(
+                {
+                    "row": number,
+                    "errors": {"non_field_errors": ["Could not save this row."]},
+                }
+                for number in numbers
+            )
+            return
+
+        for product in products:
+            product.pk = pks[product.slug]
+        self.created += len(products)
+        self.category_pks.update(pk for category_pks in links for pk in category_pks)
+        self.index(products)
+
+    def resolve_sellers(self, names):
+        missing = names - self.sellers.keys()
+        if not missing:
+            return
+        found = defaultdict(list)
+        for pk, name in self.companies.filter(company_name__in=missing).values_list(
+            "pk", "company_name"
+        ):
+            found[name].append(pk)
+        for name in missing:
+            # like create_product, a name shared by several companies is
+            # ambiguous and not used
+            self.sellers[name] = found[name][0] if len(found[name]) == 1 else None
+
+    def resolve_categories(self, names):
+        missing = names - self.categories.keys()
+        if not missing:
+            return
+        self.categories.update(
+            Category.objects.filter(name__in=missing).values_list("name", "pk")
+        )
+        # like create_product, unknown categories are created
+        for name in missing - self.categories.keys():
+            self.categories[name] = Category.objects.get_or_create(name=name)[0].pk
+
+    def unique_slugs(self, products):
+        """
+        Pick unique slugs for a whole chunk with one query, AutoSlugField
+        only checks against rows already saved so names repeated within a
+        chunk would collide
+        """
+        field = Product._meta.get_field("slug")
+        bases = [
+            field.slugify(product.name)[: field.max_length - 8] or "product"
+            for product in products
+        ]
+        lookup = Q()
+        for base in set(bases):
+            lookup |= Q(slug__startswith=base)
+        taken = set(Product.objects.filter(lookup).values_list("slug", flat=True))
+
+        slugs = []
+        suffixes = defaultdict(lambda: 1)
+        for base in bases:
+            slug = base if suffixes[base] == 1 else f"{base}-{suffixes[base]}"
+            while slug in taken:
+                suffixes[base] += 1
+                slug = f"{base}-{suffixes[base]}"
+            taken.add(slug)
+            slugs.append(slug)
+        return slugs
+
+    def index(self, products):
+        """
+        bulk_create sends no post_save, index the new products here
+        """
+        try:
+            for field in ("name", "description"):
+                index = trigram.get_index(Product, field)
+                if index is not None:
+                    index.add_new(
+                        [(product.pk, getattr(product, field)) for product in products]
+                    )
+            ProductLeaderboard.update([product.pk for product in products])
+        except RedisError:
+            logger.exception("Could not index imported products")
+
+    def recount(self, category_pks):
+        try:
+            recount_categories.delay(category_pks)
+        except (OperationalError, RedisError):
+            # the hourly rebuild_category_counts corrects the counts
+            logger.exception("Could not queue a recount of %s", category_pks)
@@ -0,0 +1,340 @@
+"""
+Search latency benchmark.
+
+Seeds a synthetic catalog of the requested sizes into the configured
+database, then times the search and listing endpoints at each size and
+reports p50/p95 latency and the number of queries per request. Results
+can be saved as a baseline and later runs compared against it, so run it
+against a local database that can be thrown away. It refuses to run
+unless DEBUG is on or --force is passed.
+
+    python manage.py benchmark_search --sizes 1000 10000 --save
+    python manage.py benchmark_search --sizes 1000 10000 --compare
+"""
+import json
+import math
+import random
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from redis import RedisError
+from rest_framework.test import APIRequestFactory
+
+from apps.inventory.models import Category, Company, Product
+from apps.inventory.services import ProductLeaderboard
+from utils import trigram
+from utils.search_cache import bump_generation
+
+# benchmark sellers are told apart from real ones by their email domain
+BENCHMARK_DOMAIN = "@benchmark.invalid"
+PRODUCTS_PER_COMPANY = 50
+SEED_BATCH_SIZE = 5000
+DEFAULT_BASELINE = Path(settings.BASE_DIR) / "benchmarks" / "search_baseline.json"
+
+CATALOG = {
+    "Cocoa Products": ["Cocoa Beans", "Cocoa Powder", "Cocoa Butter", "Cocoa Liquor"],
+    "Shea Products": ["Shea Butter", "Shea Nuts", "Shea Oil"],
+    "Coffee": ["Arabica Coffee Beans", "Robusta Coffee Beans", "Ground Coffee"],
+    "Grains": ["White Maize", "Sorghum", "Pearl Millet", "Parboiled Rice"],
+    "Edible Oils": ["Palm Oil", "Groundnut Oil", "Coconut Oil"],
+    "Nuts and Seeds": ["Cashew Nuts", "Sesame Seeds", "Bambara Beans"],
+    "Fruits": ["Pineapple", "Mango", "Dried Mango Slices", "Plantain Chips"],
+    "Textiles": ["Kente Cloth", "Cotton Yarn", "Wax Print Fabric"],
+    "Minerals": ["Bauxite", "Manganese Ore", "Gold Dore"],
+    "Seafood": ["Smoked Tilapia", "Frozen Mackerel", "Dried Anchovies"],
+}
+ADJECTIVES = [
+    "Organic",
+    "Premium",
+    "Raw",
+    "Refined",
+    "Unrefined",
+    "Roasted",
+    "Fresh",
+    "Natural",
+    "Export Grade",
+    "Fair Trade",
+]
+PACKS = ["25kg bags", "50kg bags", "1 ton bulk", "500g packs", "drums", "cartons"]
+REGIONS = ["Ashanti", "Kano", "Abidjan", "Tamale", "Lagos", "Dakar", "Arusha", "Douala"]
+USES = ["export", "food processing", "retail", "wholesale distribution"]
+COMPANY_PREFIXES = [
+    "Golden",
+    "Savanna",
+    "Coastal",
+    "Sahel",
+    "Volta",
+    "Atlas",
+    "Zambezi",
+]
+COMPANY_SUFFIXES = ["Agro", "Exports", "Trading", "Commodities", "Farms", "Industries"]
+COUNTRIES = ["GH", "NG", "CI", "SN", "KE", "TZ", "CM", "EG", "ZA", "RW"]
+
+SCENARIOS = [
+    ("products search", "/api/v1/products/", {"search": "organic cocoa"}),
+    ("products typo search", "/api/v1/products/", {"search": "cocao powdr"}),
+    ("products facets", "/api/v1/products/", {"search": "shea", "facets": "true"}),
+    ("products category", "/api/v1/products/", {"category": "Cocoa Products"}),
+    ("products top", "/api/v1/products/", {"top": "true"}),
+    ("products limit", "/api/v1/products/", {"limit": "20"}),
+    ("products page", "/api/v1/products/", {"page_size": "20"}),
+    ("companies search", "/api/v1/company/", {"search": "savanna agro"}),
+    ("companies country", "/api/v1/company/", {"country": "GH"}),
+]
+
+
+def percentile(samples, percent):
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+class Command(BaseCommand):
+    help = "Time the product and company search endpoints on synthetic catalogs"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            nargs="+",
+            type=int,
+            default=[1000, 10000, 100000, 1000000],
+            help="Catalog sizes to benchmark, seeded incrementally",
+        )
+        parser.add_argument("--runs", type=int, default=30)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--warm",
+            action="store_true",
+            help="Let the search result cache serve repeated requests",
+        )
+        parser.add_argument(
+            "--save", nargs="?", const=DEFAULT_BASELINE, help="Save a baseline"
+        )
+        parser.add_argument(
+            "--compare",
+            nargs="?",
+            const=DEFAULT_BASELINE,
+            help="Fail if p95 or query counts regressed against a baseline",
+        )
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.2,
+            help="Allowed p95 slowdown against the baseline, 0.2 is 20%%",
+        )
+        parser.add_argument(
+            "--cleanup", action="store_true", help="Delete the benchmark catalog"
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Run with DEBUG off, against a database that isn't local",
+        )
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options["force"]:
+            raise CommandError(
+                "benchmark_search seeds products into "
+                f"{connection.settings_dict['NAME']}, run it with DEBUG on "
+                "or pass --force"
+            )
+        if options["cleanup"]:
+            self.cleanup()
+            return
+
+        self.random = random.Random(options["seed"])
+        self.factory = APIRequestFactory()
+        results = {}
+        for size in sorted(options["sizes"]):
+            existing = self.benchmark_products().count()
+            if existing > size:
+                self.stderr.write(
+                    f"Skipping {size}: {existing} benchmark products already seeded"
+                )
+                continue
+            self.seed(size, existing)
+            results[str(size)] = self.run_scenarios(options["runs"], options["warm"])
+            self.report(size, results[str(size)])
+
+        if options["compare"]:
+            self.compare(results, Path(options["compare"]), options["tolerance"])
+        if options["save"]:
+            path = Path(options["save"])
+            path.parent.mkdir(parents=True, exist_ok=True)
+            baseline = {
+                "database": connection.vendor,
+                "runs": options["runs"],
+                "warm": options["warm"],
+                "sizes": results,
+            }
+            path.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+            self.stdout.write(self.style.SUCCESS(f"Baseline saved to {path}"))
+
+    def benchmark_products(self):
+        return Product.objects.filter(seller__email__endswith=BENCHMARK_DOMAIN)
+
+    def seed(self, size, existing):
+        if existing == size:
+            return
+        self.stdout.write(f"Seeding {size - existing} products")
+        categories = {
+            name: Category.objects.get_or_create(name=name)[0] for name in CATALOG
+        }
+        companies = self.seed_companies(max(1, size // PRODUCTS_PER_COMPANY))
+
+        for start in range(existing, size, SEED_BATCH_SIZE):
+            stop = min(start + SEED_BATCH_SIZE, size)
+            products, product_categories = [], []
+            for number in range(start, stop):
+                category = self.random.choice(list(CATALOG))
+                noun = self.random.choice(CATALOG[category])
+                adjective = self.random.choice(ADJECTIVES)
+                pack = self.random.choice(PACKS)
+                products.append(
+                    Product(
+                        name=f"{adjective} {noun} {pack}",
+                        slug=f"benchmark-product-{number}",
+                        description=(
+                            f"{adjective} {noun.lower()} sourced from "
+                            f"{self.random.choice(REGIONS)}, packed in {pack}. "
+                            f"Suitable for {self.random.choice(USES)}."
+                        ),
+                        seller=self.random.choice(companies),
+                        views=int(self.random.paretovariate(1.5)),
+                        payment_methods=self.random.sample(
+                            [choice for choice, _ in Product.PAYMENT_METHODS], 2
+                        ),
+                        shipping_information=self.random.sample(
+                            [choice for choice, _ in Product.SHIPPING_INFORMATION], 2
+                        ),
+                        trading_areas=self.random.choice(Product.TRADING_AREAS)[0],
+                    )
+                )
+                product_categories.append(categories[category].pk)
+
+            with transaction.atomic():
+                Product.objects.bulk_create(products)
+                # MySQL doesn't return the primary keys of bulk inserts
+                pks = dict(
+                    Product.objects.filter(
+                        slug__in=[product.slug for product in products]
+                    ).values_list("slug", "pk")
+                )
+                Product.categories.through.objects.bulk_create(
+                    [
+                        Product.categories.through(
+                            product_id=pks[product.slug], category_id=category_pk
+                        )
+                        for product, category_pk in zip(products, product_categories)
+                    ]
+                )
+            self.stdout.write(f"  {stop}/{size}")
+
+        self.refresh_indexes()
+
+    def seed_companies(self, count):
+        companies = list(Company.objects.filter(email__endswith=BENCHMARK_DOMAIN))
+        if len(companies) < count:
+            Company.objects.bulk_create(
+                [
+                    Company(
+                        company_name=(
+                            f"{self.random.choice(COMPANY_PREFIXES)} "
+                            f"{self.random.choice(COMPANY_SUFFIXES)} {number} Ltd"
+                        ),
+                        email=f"seller{number}{BENCHMARK_DOMAIN}",
+                        countries=self.random.choice(COUNTRIES),
+                    )
+                    for number in range(len(companies), count)
+                ]
+            )
+            companies = list(Company.objects.filter(email__endswith=BENCHMARK_DOMAIN))
+        return companies
+
+    def refresh_indexes(self):
+        """
+        bulk_create sends no signals, so rebuild what they keep up to date
+        """
+        try:
+            for index in trigram.registered_indexes():
+                index.build()
+            ProductLeaderboard.build()
+        except RedisError as error:
+            self.stderr.write(f"Could not rebuild the Redis indexes: {error}")
+        bump_generation(Product, Category, Company)
+
+    def run_scenarios(self, runs, warm):
+        results = {}
+        for name, path, params in SCENARIOS:
+            view = resolve(path).func
+            # untimed request to fill connection and database caches
+            view(self.factory.get(path, params)).render()
+
+            timings, queries = [], []
+            for _ in range(runs):
+                if not warm:
+                    bump_generation(Product, Category, Company)
+                request = self.factory.get(path, params)
+                with CaptureQueriesContext(connection) as context:
+                    started = time.perf_counter()
+                    response = view(request)
+                    response.render()
+                    timings.append((time.perf_counter() - started) * 1000)
+                if response.status_code != 200:
+                    raise CommandError(f"{name} returned {response.status_code}")
+                queries.append(len(context.captured_queries))
+            results[name] = {
+                "p50_ms": round(percentile(timings, 50), 2),
+                "p95_ms": round(percentile(timings, 95), 2),
+                "queries": max(queries),
+            }
+        return results
+
+    def report(self, size, results):
+        self.stdout.write(f"\n{size} products")
+        self.stdout.write(f"{'scenario':<24}{'p50 ms':>10}{'p95 ms':>10}{'queries':>9}")
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<24}{result['p50_ms']:>10}{result['p95_ms']:>10}"
+                f"{result['queries']:>9}"
+            )
+
+    def compare(self, results, path, tolerance):
+        if not path.exists():
+            raise CommandError(f"No baseline at {path}")
+        baseline = json.loads(path.read_text())["sizes"]
+
+        regressions = []
+        for size, scenarios in results.items():
+            for name, result in scenarios.items():
+                before = baseline.get(size, {}).get(name)
+                if before is None:
+                    continue
+                # ignore sub-millisecond noise on very fast scenarios
+                if (
+                    result["p95_ms"] > before["p95_ms"] * (1 + tolerance)
+                    and result["p95_ms"] - before["p95_ms"] > 1
+                ):
+                    regressions.append(
+                        f"{size} {name}: p95 {before['p95_ms']} -> {result['p95_ms']} ms"
+                    )
+                if result["queries"] > before["queries"]:
+                    regressions.append(
+                        f"{size} {name}: queries {before['queries']} -> "
+                        f"{result['queries']}"
+                    )
+
+        if regressions:
+            raise CommandError("Regressions found:\n" + "\n".join(regressions))
+        self.stdout.write(self.style.SUCCESS(f"No regressions against {path}"))
+
+    def cleanup(self):
+        companies = Company.objects.filter(email__endswith=BENCHMARK_DOMAIN)
+        # deleting the sellers cascades to their products
+        deleted, _ = companies.delete()
+        self.refresh_indexes()
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} benchmark rows"))
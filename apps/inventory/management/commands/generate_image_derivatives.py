@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from apps.inventory.models import ProductImage
+from apps.inventory.services import ImageDerivatives
+
+
+class Command(BaseCommand):
+    help = "Generate the resized copies of product images that don't have them"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all", action="store_true", help="Regenerate every product image"
+        )
+
+    def handle(self, *args, **options):
+        images = ProductImage.objects.exclude(image="").exclude(image=None)
+        if not options["all"]:
+            images = images.filter(derivatives=None)
+        pks = list(images.values_list("pk", flat=True))
+        for count, pk in enumerate(pks, start=1):
+            ImageDerivatives.generate(pk)
+            if count % 100 == 0:
+                self.stdout.write(f"{count}/{len(pks)}")
+        self.stdout.write(self.style.SUCCESS(f"Processed {len(pks)} images"))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from utils import trigram
+
+
+class Command(BaseCommand):
+    help = "Rebuild the trigram search indexes for products and companies"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--missing",
+            action="store_true",
+            help="Only build the indexes that aren't built yet",
+        )
+
+    def handle(self, *args, **options):
+        for index in trigram.registered_indexes():
+            self.stdout.write(f"Rebuilding {index.name}")
+            index.build(rebuild=not options["missing"])
+        self.stdout.write(self.style.SUCCESS("Trigram indexes rebuilt"))
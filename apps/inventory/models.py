@@ -13,6 +13,7 @@ from django.conf import settings
 from django.core.exceptions import ValidationError
 from multiselectfield import MultiSelectField
 import uuid
+from utils.search import FullTextIndex
 
 # Create your models here.
 
@@ -57,6 +58,14 @@ class Category(MPTTModel):
     companies = models.ManyToManyField(Company, blank=True, related_name="categories")
 
     description = models.TextField(blank=True, null=True)
+    # active products filed directly under the category, and under it or
+    # any of its subcategories, kept up to date by CategoryCounts
+    product_count = models.PositiveIntegerField(
+        default=0, db_index=True, editable=False
+    )
+    subtree_product_count = models.PositiveIntegerField(
+        default=0, db_index=True, editable=False
+    )
 
     def user_directory_path(instance, filename):
         # file will be uploaded to MEDIA_ROOT/user_<id>/<filename>
@@ -98,6 +107,36 @@ class ProductImage(models.Model):
     image = models.FileField(upload_to=user_directory_path, blank=True, null=True)
 
 
+class ProductImageDerivative(models.Model):
+    """
+    A resized copy of a ProductImage made by the generate_image_derivatives
+    task, in the original's format and in WebP when that is smaller
+    """
+
+    # longest edge in pixels, images are never upscaled
+    SIZES = {"thumbnail": 160, "card": 480, "detail": 1200}
+
+    def user_directory_path(instance, filename):
+        return "user_{0}/derivatives/{1}".format("main", filename)
+
+    image = models.ForeignKey(
+        ProductImage, on_delete=models.CASCADE, related_name="derivatives"
+    )
+    size = models.CharField(max_length=20, choices=[(size, size) for size in SIZES])
+    format = models.CharField(max_length=10)
+    file = models.FileField(upload_to=user_directory_path)
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    bytes = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["image", "size", "format"], name="unique_image_derivative"
+            )
+        ]
+
+
 class Product(models.Model):
     """
     Product details table
@@ -216,7 +255,7 @@ class Product(models.Model):
     documents = models.ManyToManyField(
         ProductDocument, blank=True, related_name="product"
     )
-    views = models.IntegerField(default=0)
+    views = models.IntegerField(default=0, db_index=True)
     unit = models.CharField(max_length=250, blank=True, null=True)
     weight = models.CharField(max_length=20, blank=True, null=True)
     cost = models.DecimalField(decimal_places=2, default="0.00", max_digits=20)
@@ -298,6 +337,13 @@ add "max_choices" to limit the number of choices for the radio buttons
         null=True,
     )
 
+    class Meta:
+        indexes = [
+            FullTextIndex(fields=["name", "description"], name="product_fulltext_idx"),
+            # keyset pagination order
+            models.Index(fields=["-updated_at", "-id"], name="product_updated_idx"),
+        ]
+
     def __str__(self):
         return str(self.name) if self.name else ""
 
@@ -403,6 +449,12 @@ class SourcingRequest(models.Model):
     unit = models.CharField(max_length=250, blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # keyset pagination order
+            models.Index(fields=["-created_at", "-id"], name="sourcing_created_idx"),
+        ]
+
     def __str__(self):
         return str(self.name) if self.name else ""
 
@@ -459,3 +511,63 @@ class QuotationForm(models.Model):
 
     def __str__(self):
         return str(self.name) if self.name else ""
+
+
+class MediaUpload(models.Model):
+    """
+    An image or document accepted by the API and staged as its base64
+    payload until the ingest_media_upload task decodes, validates and
+    stores it and links it to its product or quotation
+    """
+
+    class Kind(models.TextChoices):
+        PRODUCT_IMAGE = "product_image", _("Product Image")
+        PRODUCT_DOCUMENT = "product_document", _("Product Document")
+        QUOTATION_IMAGE = "quotation_image", _("Quotation Image")
+
+    class Status(models.TextChoices):
+        PENDING = "pending", _("Pending")
+        PROCESSING = "processing", _("Processing")
+        DONE = "done", _("Done")
+        FAILED = "failed", _("Failed")
+
+    kind = models.CharField(max_length=20, choices=Kind.choices)
+    status = models.CharField(
+        max_length=20, choices=Status.choices, default=Status.PENDING, db_index=True
+    )
+    # file name given to documents
+    name = models.CharField(max_length=500, blank=True, null=True)
+    staged_file = models.FileField(upload_to="staging/%Y/%m/%d/", blank=True, null=True)
+    product = models.ForeignKey(
+        Product,
+        blank=True,
+        null=True,
+        on_delete=models.CASCADE,
+        related_name="media_uploads",
+    )
+    quotation = models.ForeignKey(
+        QuotationForm,
+        blank=True,
+        null=True,
+        on_delete=models.CASCADE,
+        related_name="media_uploads",
+    )
+    uploaded_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        blank=True,
+        null=True,
+        on_delete=models.SET_NULL,
+        related_name="media_uploads",
+    )
+    image = models.ForeignKey(
+        ProductImage, blank=True, null=True, on_delete=models.SET_NULL
+    )
+    document = models.ForeignKey(
+        ProductDocument, blank=True, null=True, on_delete=models.SET_NULL
+    )
+    error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.kind} upload {self.pk} ({self.status})"
@@ -3,6 +3,7 @@ from .models import (
     Product,
     Category,
     ProductImage,
+    MediaUpload,
     # CurrencyRates,
     ProductDocument,
     SourcingRequest,
@@ -10,6 +11,7 @@ from .models import (
     QuotationImage,
 )
 from utils.utils import Base64File
+from utils.serializers import EagerLoadingMixin
 import base64
 
 
@@ -24,9 +26,10 @@ import base64
 #         return obj.rates
 
 
-class ProductReturnSerializer(serializers.ModelSerializer):
+class ProductReturnSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     categories = serializers.SerializerMethodField(required=False)
     images = serializers.SerializerMethodField(required=False)
+    image_variants = serializers.SerializerMethodField(required=False)
     brochure = serializers.SerializerMethodField(required=False)
     seller = serializers.SerializerMethodField(required=False)
     # rates = serializers.SerializerMethodField(required=False)
@@ -37,19 +40,83 @@ class ProductReturnSerializer(serializers.ModelSerializer):
         model = Product
         fields = "__all__"
 
+    # list views load these with setup_eager_loading
+    select_related_fields = {
+        "seller": ["seller"],
+        "about_company": ["seller"],
+    }
+    prefetch_related_fields = {
+        "categories": ["categories"],
+        "images": ["images", "images__derivatives"],
+        "image_variants": ["images", "images__derivatives"],
+        "documents": ["documents"],
+    }
+    only_fields = {
+        "seller": ["seller__company_name"],
+        "about_company": ["seller__about"],
+    }
+    expandable_fields = {
+        "seller": ["seller__company_name", "seller__countries", "seller__profile_logo"],
+        "categories": [],
+    }
+
     def get_seller(self, obj):
-        return obj.seller.company_name if obj.seller else ""
+        if not obj.seller:
+            return ""
+        if self.is_expanded("seller"):
+            return {
+                "id": obj.seller.id,
+                "company_name": obj.seller.company_name,
+                "countries": obj.seller.countries.code,
+                "profile_logo": (
+                    "https://www.tradepayafrica.com" + obj.seller.profile_logo.url
+                    if obj.seller.profile_logo
+                    else ""
+                ),
+            }
+        return obj.seller.company_name
 
     def get_about_company(self, obj):
         return obj.seller.about if obj.seller else ""
 
     def get_categories(self, obj):
+        if self.is_expanded("categories"):
+            return [
+                {"id": category.id, "name": category.name, "slug": category.slug}
+                for category in obj.categories.all()
+            ]
         return [category.name for category in obj.categories.all()]
 
     def get_images(self, obj):
-        return [
-            "https://www.tradepayafrica.com" + pic.image.url for pic in obj.images.all()
-        ]
+        """
+        One URL per image in the image_size from the context, "original"
+        unless the view asks for a derivative size. The smallest format of
+        that size is used, falling back to the original until the
+        derivatives have been generated
+        """
+        size = self.context.get("image_size", "original")
+        urls = []
+        for pic in obj.images.all():
+            derivatives = [d for d in pic.derivatives.all() if d.size == size]
+            if derivatives:
+                smallest = min(derivatives, key=lambda derivative: derivative.bytes)
+                urls.append("https://www.tradepayafrica.com" + smallest.file.url)
+            else:
+                urls.append("https://www.tradepayafrica.com" + pic.image.url)
+        return urls
+
+    def get_image_variants(self, obj):
+        variants = []
+        for pic in obj.images.all():
+            variant = {"original": "https://www.tradepayafrica.com" + pic.image.url}
+            for derivative in pic.derivatives.all():
+                variant.setdefault(derivative.size, {})[derivative.format] = {
+                    "url": "https://www.tradepayafrica.com" + derivative.file.url,
+                    "width": derivative.width,
+                    "height": derivative.height,
+                }
+            variants.append(variant)
+        return variants
         # images_data = []
         # for pic in obj.images.all():
         #     try:
@@ -170,6 +237,53 @@ class ProductImageSerializer(serializers.ModelSerializer):
         fields = "__all__"
 
 
+class ProductImportSerializer(serializers.ModelSerializer):
+    """
+    Validates one row of a bulk import. Seller and categories are given by
+    name and resolved for the whole batch, so they aren't fields here
+    """
+
+    payment_methods = serializers.MultipleChoiceField(
+        choices=Product.PAYMENT_METHODS, required=False
+    )
+    shipping_information = serializers.MultipleChoiceField(
+        choices=Product.SHIPPING_INFORMATION, required=False
+    )
+
+    class Meta:
+        model = Product
+        fields = [
+            "name",
+            "description",
+            "sku",
+            "is_active",
+            "unit",
+            "weight",
+            "cost",
+            "cert",
+            "cert_number",
+            "organization",
+            "issue_date",
+            "date_valid",
+            "product_cap",
+            "time_span",
+            "brand_name",
+            "order_quantity",
+            "order_unit",
+            "sample_price",
+            "payment_methods",
+            "trading_areas",
+            "shipping_information",
+        ]
+
+
+class BulkActivationSerializer(serializers.Serializer):
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), allow_empty=False
+    )
+    is_active = serializers.BooleanField()
+
+
 class CategorySerializer(serializers.ModelSerializer):
     category_image = Base64File(required=False)
 
@@ -193,6 +307,34 @@ class CategoryReturnSerializer(serializers.ModelSerializer):
         )
 
 
+class CategoryTreeSerializer(CategoryReturnSerializer):
+    """
+    Serialize a category with its children nested, for trees loaded with
+    get_cached_trees so walking the children runs no queries
+    """
+
+    children = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Category
+        fields = [
+            "id",
+            "name",
+            "slug",
+            "is_active",
+            "description",
+            "category_image",
+            "parent",
+            "level",
+            "product_count",
+            "subtree_product_count",
+            "children",
+        ]
+
+    def get_children(self, obj):
+        return CategoryTreeSerializer(obj.get_children(), many=True).data
+
+
 class ProductDocumentSerializer(serializers.ModelSerializer):
     file = Base64File()
 
@@ -212,7 +354,7 @@ class SourcingRequestSerializer(serializers.ModelSerializer):
 
 
 class QuotationImageSerializer(serializers.ModelSerializer):
-    quotation_image = Base64File()
+    image = Base64File()
 
     class Meta:
         model = QuotationImage
@@ -224,3 +366,38 @@ class QuotationSerializer(serializers.ModelSerializer):
     class Meta:
         model = QuotationForm
         fields = "__all__"
+
+
+class MediaUploadSerializer(serializers.ModelSerializer):
+    url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = MediaUpload
+        fields = [
+            "id",
+            "kind",
+            "status",
+            "name",
+            "product",
+            "quotation",
+            "image",
+            "document",
+            "url",
+            "error",
+            "created_at",
+            "processed_at",
+        ]
+
+    def get_url(self, obj):
+        if obj.image and obj.image.image:
+            file = obj.image.image
+        elif obj.document and obj.document.file:
+            file = obj.document.file
+        elif (
+            obj.kind == MediaUpload.Kind.QUOTATION_IMAGE
+            and obj.status == MediaUpload.Status.DONE
+        ):
+            file = obj.quotation.quotation_image
+        else:
+            return ""
+        return "https://www.tradepayafrica.com" + file.url if file else ""
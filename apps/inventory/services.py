@@ -0,0 +1,826 @@
+import hashlib
+import io
+import json
+import logging
+import uuid
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.utils.timezone import now
+from kombu.exceptions import OperationalError
+from PIL import Image, ImageOps, UnidentifiedImageError
+from redis import RedisError
+from rest_framework.exceptions import ValidationError
+
+from utils.redis_client import get_redis
+from utils.search_cache import bump_generation, get_generations
+from utils.utils import Base64File
+from apps.profiles.models import Rep
+from .models import (
+    Category,
+    Company,
+    MediaUpload,
+    Product,
+    ProductImage,
+    ProductImageDerivative,
+    ProductViews,
+)
+from .serializers import (
+    CategoryTreeSerializer,
+    ProductDocumentSerializer,
+    ProductImageSerializer,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ProductViewBuffer:
+    """
+    Product views are recorded in Redis on the read path, one set of
+    viewer IPs per product, and written to the database in batches by
+    the flush_product_views task
+    """
+
+    DIRTY_KEY = "product_views:dirty"
+    PENDING_KEY = "product_views:pending:{}"
+    FLUSH_BATCH_SIZE = 500
+
+    @staticmethod
+    def record(product_pk, ip):
+        pipe = get_redis().pipeline()
+        pipe.sadd(ProductViewBuffer.PENDING_KEY.format(product_pk), ip)
+        pipe.sadd(ProductViewBuffer.DIRTY_KEY, product_pk)
+        pipe.execute()
+
+    @staticmethod
+    def _take_pending(product_pks):
+        """
+        Atomically read and clear the pending IPs of each product
+        """
+        pipe = get_redis().pipeline()
+        for pk in product_pks:
+            key = ProductViewBuffer.PENDING_KEY.format(pk)
+            pipe.smembers(key)
+            pipe.delete(key)
+        results = pipe.execute()[::2]
+        return {
+            pk: {ip.decode() for ip in ips} for pk, ips in zip(product_pks, results)
+        }
+
+    @staticmethod
+    def _restore_pending(pending):
+        pipe = get_redis().pipeline()
+        for pk, ips in pending.items():
+            if ips:
+                pipe.sadd(ProductViewBuffer.PENDING_KEY.format(pk), *ips)
+                pipe.sadd(ProductViewBuffer.DIRTY_KEY, pk)
+        pipe.execute()
+
+    @staticmethod
+    def _write(pending):
+        """
+        Insert the ProductViews rows not already recorded and bump each
+        product's views by its number of new IPs, returns {pk: increment}
+        """
+        all_ips = {ip for ips in pending.values() for ip in ips}
+        existing = set(
+            ProductViews.objects.filter(
+                product_id__in=pending.keys(), ip__in=all_ips
+            ).values_list("product_id", "ip")
+        )
+        live_pks = set(
+            Product.objects.filter(pk__in=pending.keys()).values_list("pk", flat=True)
+        )
+
+        new_views = [
+            ProductViews(product_id=pk, ip=ip)
+            for pk, ips in pending.items()
+            if pk in live_pks
+            for ip in ips
+            if (pk, ip) not in existing
+        ]
+        increments = defaultdict(int)
+        for view in new_views:
+            increments[view.product_id] += 1
+
+        # one UPDATE per distinct increment rather than per product
+        by_increment = defaultdict(list)
+        for pk, increment in increments.items():
+            by_increment[increment].append(pk)
+
+        with transaction.atomic():
+            ProductViews.objects.bulk_create(new_views, batch_size=1000)
+            for increment, pks in by_increment.items():
+                Product.objects.filter(pk__in=pks).update(views=F("views") + increment)
+        return dict(increments)
+
+    @staticmethod
+    def flush():
+        client = get_redis()
+        flushed = 0
+        while True:
+            product_pks = [
+                int(pk)
+                for pk in client.spop(
+                    ProductViewBuffer.DIRTY_KEY, ProductViewBuffer.FLUSH_BATCH_SIZE
+                )
+            ]
+            if not product_pks:
+                return flushed
+            pending = ProductViewBuffer._take_pending(product_pks)
+            try:
+                increments = ProductViewBuffer._write(pending)
+            except Exception:
+                ProductViewBuffer._restore_pending(pending)
+                raise
+            flushed += sum(increments.values())
+            try:
+                ProductLeaderboard.update(list(increments))
+            except RedisError:
+                logger.exception("Could not update the product leaderboard")
+
+
+class LeaderboardNotBuilt(Exception):
+    pass
+
+
+class ProductLeaderboard:
+    """
+    Active products ranked by views in Redis sorted sets, one overall, one
+    per category and one per seller country. The sets each product is in
+    are kept in a hash so a product that is deactivated, moved to another
+    category or deleted is taken out of the right sets.
+
+    The sets are built by the build_search_indexes task, never on a read.
+    """
+
+    KEY = "leaderboard:products"
+    MEMBERSHIP_KEY = "leaderboard:products:keys"
+    BUILT_KEY = "leaderboard:products:built"
+    LOCK_KEY = "leaderboard:products:lock"
+    BUILD_CHUNK_SIZE = 2000
+
+    @staticmethod
+    def key(category=None, country=None):
+        if category is not None:
+            return f"{ProductLeaderboard.KEY}:category:{category}"
+        if country:
+            return f"{ProductLeaderboard.KEY}:country:{country.upper()}"
+        return ProductLeaderboard.KEY
+
+    @staticmethod
+    def _entries(products):
+        """
+        Return {pk: (views, keys)} for the given active products queryset.
+        Products are ranked in their categories' ancestors too, as
+        browsing a category lists its subcategories' products
+        """
+        rows = list(products.values_list("pk", "views", "seller__countries"))
+        categories = defaultdict(list)
+        for product_id, category_id in Product.categories.through.objects.filter(
+            product_id__in=[pk for pk, _, _ in rows]
+        ).values_list("product_id", "category_id"):
+            categories[product_id].append(category_id)
+        ancestors = CategoryTree.ancestors(
+            {c for category_pks in categories.values() for c in category_pks}
+        )
+
+        entries = {}
+        for pk, views, country in rows:
+            ranked_in = {a for c in categories[pk] for a in ancestors.get(c, [c])}
+            keys = [ProductLeaderboard.key()]
+            keys += [ProductLeaderboard.key(category=c) for c in sorted(ranked_in)]
+            if country:
+                keys.append(ProductLeaderboard.key(country=str(country)))
+            entries[pk] = (views, keys)
+        return entries
+
+    @staticmethod
+    def _index(pipe, pk, views, keys, old_keys=frozenset()):
+        for key in old_keys - set(keys):
+            pipe.zrem(key, pk)
+        for key in keys:
+            pipe.zadd(key, {pk: views})
+        if keys:
+            pipe.hset(ProductLeaderboard.MEMBERSHIP_KEY, pk, ",".join(keys))
+        else:
+            pipe.hdel(ProductLeaderboard.MEMBERSHIP_KEY, pk)
+
+    @staticmethod
+    def update(product_pks):
+        """
+        Re-score the given products from the database, products that are
+        inactive or gone are removed from every set
+        """
+        client = get_redis()
+        # nothing to keep up to date until build_search_indexes builds it
+        if not product_pks or not client.exists(ProductLeaderboard.BUILT_KEY):
+            return
+        entries = ProductLeaderboard._entries(
+            Product.objects.filter(pk__in=product_pks, is_active=True)
+        )
+        memberships = client.hmget(ProductLeaderboard.MEMBERSHIP_KEY, product_pks)
+        pipe = client.pipeline()
+        for pk, old_keys in zip(product_pks, memberships):
+            old_keys = set(old_keys.decode().split(",")) if old_keys else set()
+            views, keys = entries.get(pk, (0, []))
+            ProductLeaderboard._index(pipe, pk, views, keys, old_keys)
+        pipe.execute()
+
+    @staticmethod
+    def build(rebuild=True):
+        """
+        (Re)build every set from the database in chunks, with
+        rebuild=False only when they aren't built yet
+        """
+        client = get_redis()
+        with client.lock(ProductLeaderboard.LOCK_KEY, timeout=600):
+            # built by whoever held the lock before us
+            if not rebuild and client.exists(ProductLeaderboard.BUILT_KEY):
+                return False
+            keys = [
+                key
+                for key in client.scan_iter(
+                    match=f"{ProductLeaderboard.KEY}*", count=1000
+                )
+                if key.decode() != ProductLeaderboard.LOCK_KEY
+            ]
+            for start in range(0, len(keys), 1000):
+                client.unlink(*keys[start : start + 1000])
+
+            pks = Product.objects.filter(is_active=True).values_list("pk", flat=True)
+            chunk = []
+            for pk in pks.iterator(chunk_size=ProductLeaderboard.BUILD_CHUNK_SIZE):
+                chunk.append(pk)
+                if len(chunk) == ProductLeaderboard.BUILD_CHUNK_SIZE:
+                    ProductLeaderboard._build_chunk(client, chunk)
+                    chunk = []
+            ProductLeaderboard._build_chunk(client, chunk)
+            client.set(ProductLeaderboard.BUILT_KEY, 1)
+        return True
+
+    @staticmethod
+    def _build_chunk(client, product_pks):
+        entries = ProductLeaderboard._entries(
+            Product.objects.filter(pk__in=product_pks)
+        )
+        pipe = client.pipeline(transaction=False)
+        for pk, (views, keys) in entries.items():
+            ProductLeaderboard._index(pipe, pk, views, keys)
+        pipe.execute()
+
+    @staticmethod
+    def top(count, category=None, country=None):
+        """
+        Return the pks of the count most viewed active products, overall or
+        within a category pk or seller country code, raises
+        LeaderboardNotBuilt until the sets are built
+        """
+        client = get_redis()
+        if not client.exists(ProductLeaderboard.BUILT_KEY):
+            raise LeaderboardNotBuilt()
+        key = ProductLeaderboard.key(category=category, country=country)
+        return [int(pk) for pk in client.zrevrange(key, 0, count - 1)]
+
+
+class ProductFacets:
+    """
+    Counts of the products in a search result by category, seller country,
+    payment method, shipping term and trading area, from one grouped query
+    over the product columns and one over the category links
+    """
+
+    FIELDS = {
+        "countries": "seller__countries",
+        "payment_methods": "payment_methods",
+        "shipping_information": "shipping_information",
+        "trading_areas": "trading_areas",
+    }
+
+    @staticmethod
+    def _values(value):
+        # MultiSelectField columns hold several comma separated choices
+        if not value:
+            return []
+        if isinstance(value, str):
+            return value.split(",")
+        if isinstance(value, (list, tuple, set)):
+            return list(value)
+        return [str(value)]
+
+    @staticmethod
+    def count(queryset):
+        if queryset.query.is_sliced:
+            # MySQL can't use a LIMIT inside an IN subquery
+            product_pks = list(queryset.values_list("pk", flat=True))
+        else:
+            product_pks = queryset.values("pk")
+        products = Product.objects.filter(pk__in=product_pks)
+
+        facets = {name: Counter() for name in ProductFacets.FIELDS}
+        rows = (
+            products.order_by()
+            .values_list(*ProductFacets.FIELDS.values())
+            .annotate(count=Count("pk"))
+        )
+        for *values, count in rows:
+            for name, value in zip(ProductFacets.FIELDS, values):
+                for choice in ProductFacets._values(value):
+                    facets[name][str(choice)] += count
+
+        facets["categories"] = Counter(
+            dict(
+                Product.categories.through.objects.filter(product__in=products)
+                .order_by()
+                .values_list("category__name")
+                .annotate(count=Count("product_id"))
+            )
+        )
+        return {name: dict(counter.most_common()) for name, counter in facets.items()}
+
+
+class CategoryTree:
+    """
+    Category browsing by subtree. A category's descendants are the nodes
+    of its tree with lft/rght inside its own, so they are matched with
+    one range join instead of walking the children
+    """
+
+    WINDOW_KEY = "category:window:{}:{}"
+    TREE_KEY = "category:tree:{}"
+
+    @staticmethod
+    def window(name):
+        """
+        Return the (tree_id, lft, rght) of the named category, or None.
+        Cached until a category is saved or deleted, as moving or
+        inserting nodes renumbers the tree
+        """
+        (generation,) = get_generations([Category])
+        key = CategoryTree.WINDOW_KEY.format(
+            generation, hashlib.sha1(name.encode()).hexdigest()
+        )
+        window = cache.get(key)
+        if window is None:
+            window = (
+                Category.objects.filter(name=name)
+                .values_list("tree_id", "lft", "rght")
+                .first()
+            ) or ()
+            cache.set(key, window, settings.SEARCH_CACHE_TIMEOUT)
+        return tuple(window) or None
+
+    @staticmethod
+    def ancestors(category_pks):
+        """
+        Return {pk: [pk, parent pk, ...]} for the given categories, up to
+        their root, from one query
+        """
+        if not category_pks:
+            return {}
+        parents = dict(
+            Category.objects.filter(pk__in=category_pks)
+            .get_ancestors(include_self=True)
+            .values_list("pk", "parent_id")
+        )
+        ancestors = {}
+        for pk in category_pks:
+            chain = []
+            node = pk
+            while node is not None and node in parents:
+                chain.append(node)
+                node = parents[node]
+            ancestors[pk] = chain
+        return ancestors
+
+    @staticmethod
+    def subtree_lookups(window, prefix="categories"):
+        """
+        Filter kwargs matching rows linked to any category in the window,
+        pass them to a single filter() call so they share one join
+        """
+        tree_id, lft, rght = window
+        return {
+            f"{prefix}__tree_id": tree_id,
+            f"{prefix}__lft__gte": lft,
+            f"{prefix}__rght__lte": rght,
+        }
+
+    @staticmethod
+    def nested():
+        """
+        Return (etag, data) for every category nested under its parent,
+        built from one query in MPTT order and cached until a category is
+        saved or deleted, or for SEARCH_CACHE_TIMEOUT
+        """
+        (generation,) = get_generations([Category])
+        key = CategoryTree.TREE_KEY.format(generation)
+        tree = cache.get(key)
+        if tree is None:
+            roots = Category.objects.all().get_cached_trees()
+            # plain JSON so the cached value doesn't pickle the serializers
+            payload = json.dumps(
+                CategoryTreeSerializer(roots, many=True).data,
+                sort_keys=True,
+                default=str,
+            )
+            etag = hashlib.sha1(payload.encode()).hexdigest()
+            tree = (f'"{etag}"', json.loads(payload))
+            # a TTL so trees of older generations expire and can be evicted
+            cache.set(key, tree, settings.SEARCH_CACHE_TIMEOUT)
+        return tree
+
+
+class CategoryCounts:
+    """
+    Maintain Category.product_count and subtree_product_count, the number
+    of active products filed under a category directly and under it or
+    any of its descendants
+    """
+
+    @staticmethod
+    def _annotate(categories):
+        active = Product.objects.filter(is_active=True).order_by()
+        direct = (
+            active.filter(categories=OuterRef("pk"))
+            .values("categories")
+            .annotate(count=Count("pk"))
+            .values("count")
+        )
+        # grouping on the outer tree_id gives one row per category
+        subtree = (
+            active.filter(
+                categories__tree_id=OuterRef("tree_id"),
+                categories__lft__gte=OuterRef("lft"),
+                categories__rght__lte=OuterRef("rght"),
+            )
+            .values("categories__tree_id")
+            .annotate(count=Count("pk", distinct=True))
+            .values("count")
+        )
+        return categories.annotate(
+            direct_count=Coalesce(Subquery(direct), 0),
+            subtree_count=Coalesce(Subquery(subtree), 0),
+        )
+
+    @staticmethod
+    def _save(categories):
+        changed = []
+        for category in CategoryCounts._annotate(categories):
+            if (category.product_count, category.subtree_product_count) != (
+                category.direct_count,
+                category.subtree_count,
+            ):
+                category.product_count = category.direct_count
+                category.subtree_product_count = category.subtree_count
+                changed.append(category)
+        Category.objects.bulk_update(
+            changed, ["product_count", "subtree_product_count"], batch_size=500
+        )
+        if changed:
+            # the category listings and tree show the counts
+            bump_generation(Category)
+        return len(changed)
+
+    @staticmethod
+    def recount(category_pks):
+        """
+        Recount the given categories and their ancestors, whose subtree
+        counts include them
+        """
+        if not category_pks:
+            return 0
+        categories = Category.objects.filter(pk__in=category_pks).get_ancestors(
+            include_self=True
+        )
+        return CategoryCounts._save(categories)
+
+    @staticmethod
+    def rebuild():
+        return CategoryCounts._save(Category.objects.all())
+
+
+class MediaIngestion:
+    """
+    Images and documents are staged as their base64 payload when the
+    request comes in and decoded, checked and stored by a celery worker,
+    with the same serializers the synchronous endpoints use
+    """
+
+    # longer than a queued upload waits for a worker
+    REQUEUE_AFTER = timedelta(minutes=5)
+
+    @staticmethod
+    def stage(kind, payload, user=None, product=None, quotation=None, name=None):
+        if not isinstance(payload, str) or not payload:
+            raise ValidationError({"file": ["Expected a base64 encoded file."]})
+        upload = MediaUpload(
+            kind=kind,
+            name=name,
+            product=product,
+            quotation=quotation,
+            uploaded_by=user if user and user.is_authenticated else None,
+        )
+        upload.staged_file.save(
+            f"{uuid.uuid4().hex}.b64", ContentFile(payload.encode()), save=False
+        )
+        upload.save()
+        transaction.on_commit(lambda: MediaIngestion.enqueue(upload.pk))
+        return upload
+
+    @staticmethod
+    def enqueue(upload_pk):
+        # imported here as the tasks module imports this one
+        from .tasks import ingest_media_upload
+
+        try:
+            ingest_media_upload.delay(upload_pk)
+        except (OperationalError, RedisError):
+            # the upload is saved, requeue() sends it later
+            logger.exception("Could not queue media upload %s", upload_pk)
+
+    @staticmethod
+    def requeue():
+        """
+        Send again the uploads still pending long after they were staged,
+        their task was lost or the broker was down. process() takes each
+        upload once, so one queued twice is only stored once
+        """
+        upload_pks = list(
+            MediaUpload.objects.filter(
+                status=MediaUpload.Status.PENDING,
+                created_at__lt=now() - MediaIngestion.REQUEUE_AFTER,
+            ).values_list("pk", flat=True)
+        )
+        for upload_pk in upload_pks:
+            MediaIngestion.enqueue(upload_pk)
+        return len(upload_pks)
+
+    @staticmethod
+    def _store(upload, payload):
+        if upload.kind == MediaUpload.Kind.PRODUCT_IMAGE:
+            serializer = ProductImageSerializer(data={"image": payload})
+            serializer.is_valid(raise_exception=True)
+            with transaction.atomic():
+                upload.image = serializer.save()
+                upload.product.images.add(upload.image)
+        elif upload.kind == MediaUpload.Kind.PRODUCT_DOCUMENT:
+            serializer = ProductDocumentSerializer(
+                data={"name": upload.name, "file": payload}
+            )
+            serializer.is_valid(raise_exception=True)
+            with transaction.atomic():
+                upload.document = serializer.save()
+                upload.product.documents.add(upload.document)
+        else:
+            upload.quotation.quotation_image = Base64File().to_internal_value(payload)
+            upload.quotation.save(update_fields=["quotation_image"])
+
+    @staticmethod
+    def process(upload_pk):
+        with transaction.atomic():
+            upload = (
+                MediaUpload.objects.select_for_update()
+                .filter(pk=upload_pk, status=MediaUpload.Status.PENDING)
+                .first()
+            )
+            # already taken by another worker
+            if upload is None:
+                return
+            upload.status = MediaUpload.Status.PROCESSING
+            upload.save(update_fields=["status"])
+
+        try:
+            with upload.staged_file.open("rb") as staged:
+                payload = staged.read().decode()
+            MediaIngestion._store(upload, payload)
+        except ValidationError as error:
+            upload.status = MediaUpload.Status.FAILED
+            upload.error = json.dumps(error.detail)
+        except Exception:
+            logger.exception("Could not process media upload %s", upload_pk)
+            upload.status = MediaUpload.Status.FAILED
+            upload.error = "Could not process the upload"
+        else:
+            upload.status = MediaUpload.Status.DONE
+
+        upload.staged_file.delete(save=False)
+        upload.processed_at = now()
+        upload.save()
+
+
+class ImageDerivatives:
+    """
+    Resized copies of product images for listings, one per size in
+    ProductImageDerivative.SIZES, saved as JPEG (PNG when the image has
+    transparency) and also as WebP when the WebP file is smaller
+    """
+
+    SAVE_OPTIONS = {
+        "JPEG": {"quality": 85, "optimize": True, "progressive": True},
+        "PNG": {"optimize": True},
+        "WEBP": {"quality": 80, "method": 6},
+    }
+    EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp"}
+
+    @staticmethod
+    def _encode(image, image_format):
+        buffer = io.BytesIO()
+        image.save(buffer, image_format, **ImageDerivatives.SAVE_OPTIONS[image_format])
+        return buffer.getvalue()
+
+    @staticmethod
+    def _open(image):
+        try:
+            with image.image.open("rb") as original:
+                source = Image.open(original)
+                source.load()
+        except (UnidentifiedImageError, OSError):
+            logger.warning("Product image %s is not a readable image", image.pk)
+            return None
+        # apply the camera orientation before the EXIF data is dropped
+        return ImageOps.exif_transpose(source)
+
+    @staticmethod
+    def generate(image_pk):
+        image = ProductImage.objects.filter(pk=image_pk).first()
+        if image is None or not image.image:
+            return
+        source = ImageDerivatives._open(image)
+        if source is None:
+            return
+
+        transparent = source.mode in ("RGBA", "LA", "PA") or (
+            source.mode == "P" and "transparency" in source.info
+        )
+        base_format = "PNG" if transparent else "JPEG"
+        source = source.convert("RGBA" if transparent else "RGB")
+
+        derivatives = []
+        for size, edge in ProductImageDerivative.SIZES.items():
+            resized = source.copy()
+            resized.thumbnail((edge, edge), Image.LANCZOS)
+            encoded = {
+                image_format: ImageDerivatives._encode(resized, image_format)
+                for image_format in (base_format, "WEBP")
+            }
+            if len(encoded["WEBP"]) >= len(encoded[base_format]):
+                del encoded["WEBP"]
+            for image_format, content in encoded.items():
+                derivative = ProductImageDerivative(
+                    image=image,
+                    size=size,
+                    format=ImageDerivatives.EXTENSIONS[image_format],
+                    width=resized.width,
+                    height=resized.height,
+                    bytes=len(content),
+                )
+                derivative.file.save(
+                    f"{image.pk}-{size}.{derivative.format}",
+                    ContentFile(content),
+                    save=False,
+                )
+                derivatives.append(derivative)
+
+        with transaction.atomic():
+            old = list(image.derivatives.all())
+            image.derivatives.all().delete()
+            ProductImageDerivative.objects.bulk_create(derivatives)
+        for derivative in old:
+            derivative.file.delete(save=False)
+
+
+class BulkActivation:
+    """
+    Enable or disable many products or companies with one UPDATE each.
+    update() sends no post_save, so what the signals keep up to date for
+    a single save, the search caches, leaderboard and category counts, is
+    refreshed here once for the whole batch
+    """
+
+    @staticmethod
+    def set_products(product_pks, is_active):
+        """
+        Returns the number of products changed
+        """
+        with transaction.atomic():
+            return BulkActivation._update_products(
+                Product.objects.filter(pk__in=product_pks), is_active
+            )
+
+    @staticmethod
+    def set_companies(company_pks, is_active):
+        """
+        The companies and every product they sell, returns the number of
+        companies and products changed
+        """
+        with transaction.atomic():
+            companies = (
+                Company.objects.filter(pk__in=company_pks)
+                .exclude(is_active=is_active)
+                .update(is_active=is_active)
+            )
+            products = BulkActivation._update_products(
+                Product.objects.filter(seller__in=company_pks), is_active
+            )
+            if companies:
+                transaction.on_commit(lambda: bump_generation(Company))
+                StatsService.invalidate()
+        return companies, products
+
+    @staticmethod
+    def _update_products(products, is_active):
+        product_pks = list(
+            products.exclude(is_active=is_active).values_list("pk", flat=True)
+        )
+        if not product_pks:
+            return 0
+        category_pks = list(
+            Product.categories.through.objects.filter(product_id__in=product_pks)
+            .values_list("category_id", flat=True)
+            .distinct()
+        )
+        Product.objects.filter(pk__in=product_pks).update(is_active=is_active)
+        transaction.on_commit(
+            lambda: BulkActivation._refresh(product_pks, category_pks)
+        )
+        return len(product_pks)
+
+    @staticmethod
+    def _refresh(product_pks, category_pks):
+        # imported here as the tasks module imports this one
+        from .tasks import recount_categories
+
+        bump_generation(Product)
+        cache.delete(StatsService.KEY)
+        try:
+            ProductLeaderboard.update(product_pks)
+        except RedisError:
+            logger.exception("Could not update the product leaderboard")
+        if category_pks:
+            try:
+                recount_categories.delay(category_pks)
+            except (OperationalError, RedisError):
+                # the hourly rebuild_category_counts corrects the counts
+                logger.exception("Could not queue a recount of %s", category_pks)
+
+
+class StatsService:
+    """
+    Site wide counts for the stats endpoints, computed with a few COUNT
+    queries and cached. The refresh_stats task recomputes them on a
+    schedule and the signals drop them whenever a product, company or rep
+    is added, removed, enabled or disabled
+    """
+
+    KEY = "stats:counts"
+
+    @staticmethod
+    def compute():
+        products = Product.objects.aggregate(
+            total=Count("pk"), active=Count("pk", filter=Q(is_active=True))
+        )
+        products["by_country"] = dict(
+            Product.objects.filter(is_active=True, seller__isnull=False)
+            .order_by()
+            .values_list("seller__countries")
+            .annotate(count=Count("pk"))
+        )
+        companies = Company.objects.aggregate(
+            total=Count("pk"), active=Count("pk", filter=Q(is_active=True))
+        )
+        companies["by_country"] = dict(
+            Company.objects.filter(is_active=True)
+            .order_by()
+            .values_list("countries")
+            .annotate(count=Count("pk"))
+        )
+        return {
+            "products": products,
+            "companies": companies,
+            "reps": {"total": Rep.objects.count()},
+        }
+
+    @staticmethod
+    def refresh():
+        stats = StatsService.compute()
+        cache.set(StatsService.KEY, stats, settings.STATS_CACHE_TIMEOUT)
+        return stats
+
+    @staticmethod
+    def get():
+        stats = cache.get(StatsService.KEY)
+        if stats is None:
+            stats = StatsService.refresh()
+        return stats
+
+    @staticmethod
+    def invalidate():
+        # after commit, so a read in between can't cache the old counts
+        transaction.on_commit(lambda: cache.delete(StatsService.KEY))
@@ -0,0 +1,193 @@
+import logging
+
+from django.db import transaction
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+    pre_delete,
+    pre_save,
+)
+from django.dispatch import receiver
+from kombu.exceptions import OperationalError
+from redis import RedisError
+
+from utils import trigram
+from utils.search_cache import bump_generation
+from .models import Category, Company, Product, ProductImage
+from .services import ProductLeaderboard, StatsService
+from .tasks import generate_image_derivatives, recount_categories
+
+logger = logging.getLogger(__name__)
+
+trigram.register(Product, "name", "description")
+
+
+def update_leaderboard(product_pks):
+    product_pks = list(product_pks)
+
+    def update():
+        try:
+            ProductLeaderboard.update(product_pks)
+        except RedisError:
+            logger.exception("Could not update the product leaderboard")
+
+    transaction.on_commit(update)
+
+
+def recount(category_pks):
+    category_pks = list(category_pks)
+    if not category_pks:
+        return
+
+    def queue():
+        try:
+            recount_categories.delay(category_pks)
+        except (OperationalError, RedisError):
+            # the hourly rebuild_category_counts corrects the counts
+            logger.exception("Could not queue a recount of %s", category_pks)
+
+    transaction.on_commit(queue)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_searches(sender, instance, update_fields=None, **kwargs):
+    # view counter updates don't change what a search matches
+    if update_fields is not None and set(update_fields) <= {"views"}:
+        return
+    bump_generation(Product)
+
+
+@receiver(m2m_changed, sender=Product.categories.through)
+def invalidate_product_category_searches(sender, action, **kwargs):
+    if action.startswith("post_"):
+        bump_generation(Product)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_searches(sender, **kwargs):
+    bump_generation(Category)
+
+
+@receiver(m2m_changed, sender=Category.companies.through)
+def invalidate_company_category_searches(sender, action, **kwargs):
+    if action.startswith("post_"):
+        bump_generation(Company)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def update_product_leaderboard(sender, instance, update_fields=None, **kwargs):
+    # view counts are re-scored by the flush_product_views task
+    if update_fields is not None and set(update_fields) <= {"views"}:
+        return
+    update_leaderboard([instance.pk])
+
+
+@receiver(m2m_changed, sender=Product.categories.through)
+def update_product_category_leaderboard(
+    sender, instance, action, reverse, pk_set, **kwargs
+):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        update_leaderboard([instance.pk])
+    elif pk_set:
+        update_leaderboard(pk_set)
+
+
+@receiver(pre_save, sender=Category)
+def remember_category_parent(sender, instance, **kwargs):
+    instance._saved_parent_id = (
+        Category.objects.filter(pk=instance.pk)
+        .values_list("parent_id", flat=True)
+        .first()
+        if instance.pk is not None
+        else None
+    )
+
+
+@receiver(post_save, sender=Category)
+def update_moved_category_leaderboard(sender, instance, created, **kwargs):
+    # products are ranked in their categories' ancestors, which a move changes
+    if created or instance._saved_parent_id == instance.parent_id:
+        return
+    update_leaderboard(
+        Product.objects.filter(
+            categories__in=instance.get_descendants(include_self=True)
+        )
+        .values_list("pk", flat=True)
+        .distinct()
+    )
+
+
+@receiver(post_save, sender=Company)
+def update_company_leaderboard(sender, instance, update_fields=None, **kwargs):
+    # products are ranked per seller country
+    if update_fields is not None and "countries" not in update_fields:
+        return
+    update_leaderboard(
+        Product.objects.filter(seller=instance).values_list("pk", flat=True)
+    )
+
+
+@receiver(m2m_changed, sender=Product.categories.through)
+def recount_changed_categories(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "pre_clear" and not reverse:
+        # the links are gone by post_clear
+        instance._cleared_category_pks = list(
+            instance.categories.values_list("pk", flat=True)
+        )
+    elif action == "post_clear":
+        recount(
+            [instance.pk] if reverse else getattr(instance, "_cleared_category_pks", [])
+        )
+    elif action in ("post_add", "post_remove"):
+        recount([instance.pk] if reverse else pk_set)
+
+
+@receiver(post_save, sender=Product)
+def recount_product_categories(sender, instance, created, update_fields=None, **kwargs):
+    # the counts only change with the active flag of an existing product,
+    # new products get their categories through m2m_changed
+    if created or (update_fields is not None and "is_active" not in update_fields):
+        return
+    recount(instance.categories.values_list("pk", flat=True))
+
+
+@receiver(pre_delete, sender=Product)
+def remember_deleted_product_categories(sender, instance, **kwargs):
+    instance._deleted_category_pks = list(
+        instance.categories.values_list("pk", flat=True)
+    )
+
+
+@receiver(post_delete, sender=Product)
+def recount_deleted_product_categories(sender, instance, **kwargs):
+    recount(getattr(instance, "_deleted_category_pks", []))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_stats(sender, instance, update_fields=None, **kwargs):
+    # only adding, removing and enabling or disabling change the counts
+    if update_fields is not None and "is_active" not in update_fields:
+        return
+    StatsService.invalidate()
+
+
+@receiver(post_save, sender=ProductImage)
+def queue_image_derivatives(sender, instance, **kwargs):
+    if not instance.image:
+        return
+
+    def queue():
+        try:
+            generate_image_derivatives.delay(instance.pk)
+        except (OperationalError, RedisError):
+            # the generate_image_derivatives command fills in missing ones
+            logger.exception("Could not queue derivatives of image %s", instance.pk)
+
+    transaction.on_commit(queue)
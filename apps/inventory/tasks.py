@@ -0,0 +1,58 @@
+from celery import shared_task
+
+from utils import trigram
+
+from .services import (
+    CategoryCounts,
+    ImageDerivatives,
+    MediaIngestion,
+    ProductLeaderboard,
+    ProductViewBuffer,
+    StatsService,
+)
+
+
+@shared_task(ignore_result=True)
+def flush_product_views():
+    ProductViewBuffer.flush()
+
+
+@shared_task(ignore_result=True)
+def recount_categories(category_pks):
+    CategoryCounts.recount(category_pks)
+
+
+@shared_task(ignore_result=True)
+def rebuild_category_counts():
+    CategoryCounts.rebuild()
+
+
+@shared_task(ignore_result=True)
+def ingest_media_upload(upload_pk):
+    MediaIngestion.process(upload_pk)
+
+
+@shared_task(ignore_result=True)
+def requeue_media_uploads():
+    MediaIngestion.requeue()
+
+
+@shared_task(ignore_result=True)
+def generate_image_derivatives(image_pk):
+    ImageDerivatives.generate(image_pk)
+
+
+@shared_task(ignore_result=True)
+def refresh_stats():
+    StatsService.refresh()
+
+
+@shared_task(ignore_result=True)
+def build_search_indexes():
+    """
+    Build the Redis search indexes that are missing, after a deploy or
+    a Redis flush, so searches never build them
+    """
+    for index in trigram.registered_indexes():
+        index.build(rebuild=False)
+    ProductLeaderboard.build(rebuild=False)
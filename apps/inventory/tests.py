@@ -1,3 +1,82 @@
-from django.test import TestCase
+from unittest import mock
+
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from apps.profiles.models import Company
+from .models import Category, Product, ProductDocument, ProductImage
+from .services import CategoryTree, LeaderboardNotBuilt, ProductLeaderboard
 
 # Create your tests here.
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class ProductListingQueryCountTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.company = Company.objects.create(company_name="Accra Foods")
+        self.category = Category.objects.create(name="Food")
+
+    def create_products(self, count):
+        for i in range(count):
+            product = Product.objects.create(
+                name=f"Product {Product.objects.count()}",
+                description="description",
+                seller=self.company,
+            )
+            product.categories.add(self.category)
+            product.images.add(ProductImage.objects.create(image="user_main/a.png"))
+            product.documents.add(
+                ProductDocument.objects.create(name="spec", file="user_main/spec.pdf")
+            )
+
+    def count_listing_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get("/api/v1/products/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), Product.objects.count())
+        return len(context.captured_queries)
+
+    def test_query_count_does_not_grow_with_products(self):
+        self.create_products(2)
+        few = self.count_listing_queries()
+        self.create_products(20)
+        self.assertEqual(self.count_listing_queries(), few)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class TopProductsSubcategoryTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.company = Company.objects.create(company_name="Accra Foods")
+        self.food = Category.objects.create(name="Food")
+        self.fruit = Category.objects.create(name="Fruit", parent=self.food)
+        self.product = Product.objects.create(
+            name="Mango", description="description", seller=self.company, views=3
+        )
+        self.product.categories.add(self.fruit)
+
+    def test_fallback_includes_subcategories(self):
+        with mock.patch.object(
+            ProductLeaderboard, "top", side_effect=LeaderboardNotBuilt
+        ):
+            response = self.client.get("/api/v1/products/?top=1&category=Food")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [product["id"] for product in response.data], [self.product.pk]
+        )
+
+    def test_products_are_ranked_in_ancestor_categories(self):
+        self.assertEqual(
+            CategoryTree.ancestors({self.fruit.pk}),
+            {self.fruit.pk: [self.fruit.pk, self.food.pk]},
+        )
+        _, keys = ProductLeaderboard._entries(Product.objects.all())[self.product.pk]
+        self.assertIn(ProductLeaderboard.key(category=self.food.pk), keys)
+        self.assertIn(ProductLeaderboard.key(category=self.fruit.pk), keys)
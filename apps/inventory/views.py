@@ -16,48 +16,89 @@ from .serializers import (
     SourcingRequestSerializer,
     QuotationImageSerializer,
     QuotationSerializer,
+    MediaUploadSerializer,
+    BulkActivationSerializer,
 )
 from copy import deepcopy
+import logging
 from .models import (
     Product,
     Category,
     # CurrencyRates,
     Company,
-    ProductViews,
     SourcingRequest,
     QuotationForm,
+    MediaUpload,
+    ProductImageDerivative,
 )
 from apps.profiles.models import ContactPerson
 from rest_framework.response import Response
 from django.db import transaction, IntegrityError
 from rest_framework.views import APIView
+from django.utils.http import parse_etags
 from django.utils.timezone import now
 from datetime import timedelta
-from django.db.models import Count
+from django.db.models import Case, When
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework.fields import BooleanField
 from rest_framework.permissions import AllowAny
+from redis import RedisError
+from .importer import (
+    CSV_CONTENT_TYPES,
+    JSON_LINES_CONTENT_TYPES,
+    ProductImporter,
+    read_rows,
+)
+from .services import (
+    BulkActivation,
+    CategoryTree,
+    LeaderboardNotBuilt,
+    MediaIngestion,
+    ProductFacets,
+    ProductLeaderboard,
+    ProductViewBuffer,
+    StatsService,
+)
 
 # Create your views here.
 
-from utils.fuzzysearch import FuzzySearchFilter
+from utils.search import get_search_backend
+from utils.search_cache import SearchCacheMixin
+from utils.pagination import KeysetPagination
+from utils.export import EXPORT_FORMATS, stream_export
+from utils.serializers import sparse_fieldsets
 
 User = get_user_model()
+logger = logging.getLogger(__name__)
+
+IMAGE_SIZES = [*ProductImageDerivative.SIZES, "original"]
 
 
-class SearchProduct(generics.ListAPIView):
+class SearchProduct(SearchCacheMixin, generics.ListAPIView):
     """
-    Fuzzy Search allows for typos, but the tradeoff is speed,
-    increasing fuzz ratio in utils.fuzzysearch will yield faster results,
-    and decreasing will yield slower results but allows for greater margin
-    or error when searching
+    Search runs through the SEARCH_FILTER_BACKEND setting, by default MySQL
+    full-text search ranked by relevance, with fuzzy search as a fallback
+    for typos when the full-text search finds nothing.
+    ?image_size=thumbnail|card|detail|original picks the image URLs returned.
+    ?facets=true adds counts by category, country, payment method, shipping
+    and trading area for the whole result next to the results.
+    ?fields=name,images&expand=seller returns only the fields named, with
+    the expanded ones as nested objects
     """
 
     serializer_class = ProductReturnSerializer
     filter_backends = [
-        FuzzySearchFilter,
+        get_search_backend(),
     ]
     search_fields = ["name", "description"]
+    fulltext_fields = ["name", "description"]
+    search_cache_models = [Product, Category]
+    search_cache_params = ["id", "company_id", "category", "country", "top", "limit"]
+    pagination_class = KeysetPagination
+    cursor_ordering = ("-updated_at", "-id")
+    top_count = 4
 
     def get_queryset(self):
         # if superuser queryset equals all, if not qs equals is_active=True
@@ -71,37 +112,124 @@ class SearchProduct(generics.ListAPIView):
         top = self.request.query_params.get("top")
         limit = self.request.query_params.get("limit")
         if product_id:
-            product = Product.objects.filter(id=product_id).order_by("-updated_at")
-            if len(product) > 0:
-                # Update views and prevent spam views
-                x_forwarded_for = self.request.META.get("HTTP_X_FORWARDED_FOR")
-                if x_forwarded_for:
-                    ip = x_forwarded_for.split(",")[0]
-                else:
-                    ip = self.request.META.get("REMOTE_ADDR")
-
-                if not ProductViews.objects.filter(product=product[0], ip=ip).exists():
-                    ProductViews.objects.create(product=product[0], ip=ip)
-
-                    product[0].views += 1
-                    product[0].save()
-
-            queryset = product
+            queryset = Product.objects.filter(id=product_id).order_by("-updated_at")
+            if product_id.isdigit():
+                self.record_view(int(product_id))
         elif company_id:
             queryset = Product.objects.filter(
                 seller=company_id, is_active=True
             ).order_by("-updated_at")
         elif top:
-            queryset = Product.objects.filter(is_active=True).order_by("-views")[:4]
+            queryset = self.get_top_products(
+                category, self.request.query_params.get("country")
+            )
         elif limit:
             queryset = queryset[: int(limit)]
         elif category:
-            queryset = (
-                Product.objects.filter(categories__name=category, is_active=True)
-                .order_by("-updated_at")
-                .distinct()
+            # the category and all of its subcategories
+            window = CategoryTree.window(category)
+            if window is None:
+                queryset = Product.objects.none()
+            else:
+                queryset = (
+                    Product.objects.filter(
+                        is_active=True, **CategoryTree.subtree_lookups(window)
+                    )
+                    .order_by("-updated_at")
+                    .distinct()
+                )
+        fieldsets = sparse_fieldsets(self.request)
+        # columns the pagination and a fuzzy search fallback read
+        required = ["updated_at"]
+        if self.request.query_params.get("search"):
+            required += self.search_fields
+        return ProductReturnSerializer.setup_eager_loading(
+            queryset,
+            fields=fieldsets["fields"],
+            expand=fieldsets["expand"],
+            required=required,
+        )
+
+    def get_serializer_context(self):
+        # listings default to card sized images, a single product to detail
+        context = super().get_serializer_context()
+        context.update(sparse_fieldsets(self.request))
+        default = "detail" if self.request.query_params.get("id") else "card"
+        size = self.request.query_params.get("image_size", default)
+        context["image_size"] = size if size in IMAGE_SIZES else default
+        return context
+
+    def list(self, request, *args, **kwargs):
+        # parsed like a serializer BooleanField, "false" and "0" are off
+        if request.query_params.get("facets") not in BooleanField.TRUE_VALUES:
+            return super().list(request, *args, **kwargs)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        facets = ProductFacets.count(queryset)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            response = self.get_paginated_response(serializer.data)
+            response.data["facets"] = facets
+            return response
+        serializer = self.get_serializer(queryset, many=True)
+        return Response({"results": serializer.data, "facets": facets})
+
+    def get_top_products(self, category=None, country=None):
+        """
+        Most viewed active products, overall or within a category name or
+        seller country code, read from the Redis leaderboard
+        """
+        products = Product.objects.filter(is_active=True)
+        category_pk = None
+        if category:
+            category_pk = (
+                Category.objects.filter(name=category)
+                .values_list("pk", flat=True)
+                .first()
             )
-        return queryset
+            if category_pk is None:
+                return products.none()
+        try:
+            pks = ProductLeaderboard.top(
+                self.top_count, category=category_pk, country=country
+            )
+        except (RedisError, LeaderboardNotBuilt) as error:
+            if isinstance(error, RedisError):
+                logger.exception("Could not read the product leaderboard")
+            if category_pk is not None:
+                window = CategoryTree.window(category)
+                if window is None:
+                    return products.none()
+                # the category and all of its subcategories, as the listing
+                products = products.filter(
+                    **CategoryTree.subtree_lookups(window)
+                ).distinct()
+            elif country:
+                products = products.filter(seller__countries=country.upper())
+            return products.order_by("-views")[: self.top_count]
+        if not pks:
+            return products.none()
+        preserved = Case(
+            *[When(pk=pk, then=position) for position, pk in enumerate(pks)]
+        )
+        return products.filter(pk__in=pks).order_by(preserved)
+
+    def record_view(self, product_pk):
+        """
+        Views are buffered in Redis, deduplicated per IP and written to
+        the database by the flush_product_views task, unknown ids are
+        dropped there
+        """
+        x_forwarded_for = self.request.META.get("HTTP_X_FORWARDED_FOR")
+        if x_forwarded_for:
+            ip = x_forwarded_for.split(",")[0]
+        else:
+            ip = self.request.META.get("REMOTE_ADDR")
+        try:
+            ProductViewBuffer.record(product_pk, ip)
+        except RedisError:
+            logger.exception("Could not record view of product %s", product_pk)
 
 
 @api_view(["GET"])
@@ -122,15 +250,16 @@ def get_my_products(request):
             )
 
         # Collect products for all companies under the admin's profile
-        products = []
-        for company in user_instance.admin_profile.companies.all():
-            company_products = company.products.all()
-            serialized_products = ProductReturnSerializer(
-                instance=company_products, many=True
-            ).data
-            products.extend(serialized_products)
+        products = ProductReturnSerializer.setup_eager_loading(
+            Product.objects.filter(
+                seller__in=user_instance.admin_profile.companies.all()
+            ).order_by("seller", "pk")
+        )
+        serializer = ProductReturnSerializer(
+            instance=products, many=True, context={"image_size": "card"}
+        )
 
-        return Response(products, status=status.HTTP_200_OK)
+        return Response(serializer.data, status=status.HTTP_200_OK)
 
     except User.DoesNotExist:
         return Response({"detail": "User not found"}, status=status.HTTP_404_NOT_FOUND)
@@ -147,10 +276,20 @@ def get_my_products(request):
 @api_view(["GET"])
 def get_number_of_products(request):
     return Response(
-        {"uploaded_products": len(Product.objects.all())}, status=status.HTTP_200_OK
+        {"uploaded_products": StatsService.get()["products"]["total"]},
+        status=status.HTTP_200_OK,
     )
 
 
+@api_view(["GET"])
+def get_stats(request):
+    """
+    Product, company and rep totals, active counts and active counts per
+    country code, from the cache
+    """
+    return Response(StatsService.get(), status=status.HTTP_200_OK)
+
+
 @api_view(["POST"])
 @permission_classes([permissions.IsAuthenticated])
 @authentication_classes([JWTAuthentication])
@@ -189,6 +328,35 @@ def create_product(request):
 
     data["categories"] = category_instances
 
+    if settings.ASYNC_MEDIA_INGESTION:
+        # decoded by celery workers once the product exists
+        images = data.pop("images", [])
+        documents = data.pop("documents", [])
+        serializer = ProductCreateSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        product_instance = serializer.save()
+        uploads = [
+            MediaIngestion.stage(
+                MediaUpload.Kind.PRODUCT_IMAGE,
+                image,
+                user=request.user,
+                product=product_instance,
+            )
+            for image in images
+        ] + [
+            MediaIngestion.stage(
+                MediaUpload.Kind.PRODUCT_DOCUMENT,
+                document.get("file", ""),
+                user=request.user,
+                product=product_instance,
+                name=document.get("name"),
+            )
+            for document in documents
+        ]
+        return_data = dict(ProductReturnSerializer(instance=product_instance).data)
+        return_data["media_uploads"] = MediaUploadSerializer(uploads, many=True).data
+        return Response(return_data, status=status.HTTP_201_CREATED)
+
     image_instances = []
     if "images" in data:
         images = data["images"]
@@ -219,6 +387,38 @@ def create_product(request):
     return Response(return_serializer.data, status=status.HTTP_201_CREATED)
 
 
+@api_view(["POST"])
+@permission_classes([permissions.IsAuthenticated])
+@authentication_classes([JWTAuthentication])
+def import_products(request):
+    """
+    Bulk create products from a CSV or JSON Lines body, one product per
+    row, read as it streams in. Rows name their seller, or ?seller= gives
+    one for the whole file, and list categories by name (separated by ;
+    in CSV). Images and documents are added afterwards with edit-product.
+    Invalid rows are reported by row number and don't stop the import.
+    """
+    # the Django request's content type is parsed, without the charset
+    content_type = request._request.content_type
+    if content_type not in CSV_CONTENT_TYPES + JSON_LINES_CONTENT_TYPES:
+        custom_response_data = {
+            "errors": "Unsupported content type",
+            "status": "failed",
+            "message": "Send products as text/csv or application/x-ndjson",
+        }
+        return Response(
+            custom_response_data, status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+        )
+
+    # iterating the Django request reads the body a line at a time
+    # instead of loading it whole
+    rows = read_rows(request._request, content_type)
+    result = ProductImporter(request.user, request.query_params.get("seller")).run(rows)
+    if result["created"]:
+        return Response(result, status=status.HTTP_201_CREATED)
+    return Response(result, status=status.HTTP_400_BAD_REQUEST)
+
+
 @api_view(["PATCH"])
 @permission_classes([permissions.IsAuthenticated])
 @authentication_classes([JWTAuthentication])
@@ -279,6 +479,18 @@ def edit_product(request):
         # remove_categories is not a field in Product so best to remove it from data to be sent to Product
         data.pop("remove_categories")
     # Product Document is many to many to Product, so serilize and then add to Product
+    uploads = []
+    if "add_documents" in data and settings.ASYNC_MEDIA_INGESTION:
+        uploads = [
+            MediaIngestion.stage(
+                MediaUpload.Kind.PRODUCT_DOCUMENT,
+                document.get("file", ""),
+                user=request.user,
+                product=product_instance,
+                name=document.get("name"),
+            )
+            for document in data.pop("add_documents")
+        ]
     if "add_documents" in data:
         documents = data["add_documents"]
         for document in documents:
@@ -298,6 +510,10 @@ def edit_product(request):
     product_serializer.is_valid(raise_exception=True)
     product_serializer.save()
 
+    if uploads:
+        return_data = dict(product_serializer.data)
+        return_data["media_uploads"] = MediaUploadSerializer(uploads, many=True).data
+        return Response(return_data, status=status.HTTP_200_OK)
     return Response(product_serializer.data, status=status.HTTP_200_OK)
 
 
@@ -327,24 +543,63 @@ def enable_product(request):
     return Response({"success": "product enabled"}, status=status.HTTP_200_OK)
 
 
-class SearchCategories(generics.ListAPIView):
+@api_view(["PATCH"])
+@permission_classes([permissions.IsAdminUser])
+@authentication_classes([JWTAuthentication])
+def set_products_active(request):
+    """
+    Enable or disable many products at once, {"ids": [...], "is_active": false}
+    """
+    serializer = BulkActivationSerializer(data=request.data)
+    if not serializer.is_valid():
+        custom_response_data = {
+            "errors": serializer.errors,
+            "status": "failed",
+            "message": "Invalid data provided",
+        }
+        return Response(custom_response_data, status=status.HTTP_400_BAD_REQUEST)
+    products = BulkActivation.set_products(
+        serializer.validated_data["ids"], serializer.validated_data["is_active"]
+    )
+    return Response({"products": products}, status=status.HTTP_200_OK)
+
+
+class SearchCategories(SearchCacheMixin, generics.ListAPIView):
     serializer_class = CategoryReturnSerializer
     filter_backends = [filters.SearchFilter]
     search_fields = ["name"]
+    search_cache_models = [Category]
+    search_cache_params = ["id", "top"]
 
     def get_queryset(self):
         queryset = Category.objects.all()
         top = self.request.query_params.get("top")
         cat_id = self.request.query_params.get("id")
         if top:
-            queryset = Category.objects.annotate(
-                num_products=Count("products")
-            ).order_by("-num_products")[:4]
+            queryset = Category.objects.order_by("-product_count")[:4]
         elif cat_id:
             queryset = Category.objects.filter(id=cat_id)
         return queryset
 
 
+class CategoryTreeView(APIView):
+    """
+    All categories nested under their parents. The tree is cached until a
+    category changes and sent with an ETag, so clients revalidating with
+    If-None-Match get a 304 while it is unchanged
+    """
+
+    permission_classes = [AllowAny]
+
+    def get(self, request):
+        etag, data = CategoryTree.nested()
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if_none_match = parse_etags(request.headers.get("If-None-Match", ""))
+        if etag in if_none_match or "*" in if_none_match:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(data, headers=headers)
+
+
 class CreateCategory(APIView):
     @transaction.atomic
     def post(self, request):
@@ -420,14 +675,42 @@ def edit_category(request):
 @permission_classes([permissions.IsAdminUser])
 @authentication_classes([JWTAuthentication])
 def get_all_products(request):
-    serializer = ProductReturnSerializer(data=Product.objects.all(), many=True)
-    serializer.is_valid()
+    export_format = request.query_params.get("export")
+    if export_format is not None:
+        if export_format not in EXPORT_FORMATS:
+            custom_response_data = {
+                "errors": "Unsupported export format",
+                "status": "failed",
+                "message": "export must be one of " + ", ".join(EXPORT_FORMATS),
+            }
+            return Response(custom_response_data, status=status.HTTP_400_BAD_REQUEST)
+        fieldsets = sparse_fieldsets(request)
+        return stream_export(
+            ProductReturnSerializer.setup_eager_loading(
+                Product.objects.all(),
+                fields=fieldsets["fields"],
+                expand=fieldsets["expand"],
+            ),
+            ProductReturnSerializer,
+            export_format,
+            filename="products",
+            key="all_products",
+            context={"image_size": "card", **fieldsets},
+        )
+
+    serializer = ProductReturnSerializer(
+        ProductReturnSerializer.setup_eager_loading(Product.objects.all()),
+        many=True,
+        context={"image_size": "card"},
+    )
     return Response({"all_products": serializer.data}, status=status.HTTP_200_OK)
 
 
 class SourcingRequestListCreateView(generics.ListCreateAPIView):
     serializer_class = SourcingRequestSerializer
     permission_classes = [permissions.AllowAny]
+    pagination_class = KeysetPagination
+    cursor_ordering = ("-created_at", "-id")
 
     def get_queryset(self):
         queryset = SourcingRequest.objects.all()
@@ -459,6 +742,27 @@ def create_quotation(request):
     quotation_data = deepcopy(request.data)  # Create a mutable copy
     image_ids = []
 
+    if settings.ASYNC_MEDIA_INGESTION:
+        images = quotation_data.pop("images", [])
+        quotation_serializer = QuotationSerializer(data=quotation_data)
+        quotation_serializer.is_valid(raise_exception=True)
+        quotation = quotation_serializer.save()
+        return_data = dict(quotation_serializer.data)
+        # a quotation holds one picture
+        return_data["media_uploads"] = MediaUploadSerializer(
+            [
+                MediaIngestion.stage(
+                    MediaUpload.Kind.QUOTATION_IMAGE,
+                    image,
+                    user=request.user,
+                    quotation=quotation,
+                )
+                for image in images[:1]
+            ],
+            many=True,
+        ).data
+        return Response(return_data, status=status.HTTP_201_CREATED)
+
     if "images" in quotation_data:
         for image in quotation_data.pop("images"):
             image_data = {"image": image}
@@ -476,6 +780,24 @@ def create_quotation(request):
     return Response(quotation_serializer.data, status=status.HTTP_201_CREATED)
 
 
+@api_view(["GET"])
+@permission_classes([permissions.IsAuthenticated])
+@authentication_classes([JWTAuthentication])
+def get_media_upload(request, pk):
+    """
+    Processing status of a staged image or document
+    """
+    uploads = MediaUpload.objects.select_related("image", "document", "quotation")
+    if not request.user.is_superuser:
+        uploads = uploads.filter(uploaded_by=request.user)
+    upload = uploads.filter(pk=pk).first()
+    if upload is None:
+        return Response(
+            {"detail": "Upload not found."}, status=status.HTTP_404_NOT_FOUND
+        )
+    return Response(MediaUploadSerializer(upload).data, status=status.HTTP_200_OK)
+
+
 @api_view(["GET"])
 def get_quotations(request):
     quotation_id = request.query_params.get("id")  # Get the `id` parameter from the query string
@@ -491,5 +813,10 @@ def get_quotations(request):
     else:
         # Fetch all quotations
         quotation_data = QuotationForm.objects.all()
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(quotation_data, request)
+        if page is not None:
+            serializer = QuotationSerializer(page, many=True)
+            return paginator.get_paginated_response(serializer.data)
         serializer = QuotationSerializer(quotation_data, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
@@ -43,6 +43,12 @@ class Order(models.Model):
     currency = models.CharField(max_length=50, choices=CURRENCY, default=CURRENCY[0][0])
     note = models.TextField(verbose_name=_("Note"), blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            # keyset pagination order
+            models.Index(fields=["-order_date", "-id"], name="order_date_idx"),
+        ]
+
     def send_order_request_by_email(self):
         mail_context = {
             "user": self.placed_to.company_name,
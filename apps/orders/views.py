@@ -14,12 +14,15 @@ from apps.inventory.models import Product
 from datetime import timedelta
 from django.utils.timezone import localtime, now
 from rest_framework_simplejwt.authentication import JWTAuthentication
+from utils.pagination import KeysetPagination
 
 
 class SearchOrder(generics.ListAPIView):
     serializer_class = OrderSerializer
     filter_backends = [filters.SearchFilter]
     search_fields = ["placed_by"]
+    pagination_class = KeysetPagination
+    cursor_ordering = ("-order_date", "-id")
 
     def get_queryset(self):
         queryset = Order.objects.all()
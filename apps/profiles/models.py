@@ -4,6 +4,7 @@ from django_countries.fields import CountryField
 from phonenumber_field.modelfields import PhoneNumberField
 from django.contrib.auth import get_user_model
 from django.utils.timezone import localdate, now
+from utils.search import FullTextIndex
 
 # Create your models here.
 User = get_user_model()
@@ -42,6 +43,7 @@ class Company(models.Model):
         verbose_name=_("Country"),
         default="GH",
         blank_label="Country",
+        db_index=True,
     )
     is_active = models.BooleanField(default=True)
 
@@ -57,6 +59,15 @@ class Company(models.Model):
         upload_to=user_directory_path, blank=True, null=True
     )
 
+    class Meta:
+        indexes = [
+            FullTextIndex(fields=["company_name"], name="company_fulltext_idx"),
+            # keyset pagination order
+            models.Index(
+                fields=["-registration_date", "-id"], name="company_registered_idx"
+            ),
+        ]
+
     def __str__(self):
         return self.company_name if self.company_name else ""
 
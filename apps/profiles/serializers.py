@@ -1,4 +1,5 @@
 from utils.utils import Base64File
+from utils.serializers import EagerLoadingMixin
 from .models import Rep, Company, ContactPerson, Country, ProfileDocument
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
@@ -126,7 +127,7 @@ class CompanyCreateSerializer(serializers.ModelSerializer):
 """Read Serializer"""
 
 
-class CompanySearchSerializer(serializers.ModelSerializer):
+class CompanySearchSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     categories = serializers.SerializerMethodField()
     countries = CountryFullNameField()
     profile_logo = serializers.SerializerMethodField()
@@ -136,7 +137,15 @@ class CompanySearchSerializer(serializers.ModelSerializer):
         model = Company
         fields = "__all__"
 
+    prefetch_related_fields = {"categories": ["categories"]}
+    expandable_fields = {"categories": []}
+
     def get_categories(self, obj):
+        if self.is_expanded("categories"):
+            return [
+                {"id": category.id, "name": category.name, "slug": category.slug}
+                for category in obj.categories.all()
+            ]
         return [category.name for category in obj.categories.all()]
 
     def get_profile_logo(self, obj):
@@ -176,7 +185,10 @@ class CompanyDetailSerializer(serializers.ModelSerializer):
         )
 
     def get_products(self, obj):
-        return ProductReturnSerializer(obj.products.all(), many=True).data
+        products = ProductReturnSerializer.setup_eager_loading(obj.products.all())
+        return ProductReturnSerializer(
+            products, many=True, context={"image_size": "card"}
+        ).data
 
     def get_business_certificate(self, obj):
         return (
@@ -0,0 +1,34 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from apps.inventory.services import StatsService
+from utils import trigram
+from utils.search_cache import bump_generation
+from .models import Company, Rep
+
+trigram.register(Company, "company_name")
+
+
+@receiver(post_save, sender=Company)
+@receiver(post_delete, sender=Company)
+def invalidate_company_searches(sender, **kwargs):
+    bump_generation(Company)
+
+
+@receiver(post_save, sender=Company)
+@receiver(post_delete, sender=Company)
+def invalidate_company_stats(sender, instance, update_fields=None, **kwargs):
+    # products are also counted per seller country
+    if update_fields is not None and not {"is_active", "countries"} & set(
+        update_fields
+    ):
+        return
+    StatsService.invalidate()
+
+
+@receiver(post_save, sender=Rep)
+@receiver(post_delete, sender=Rep)
+def invalidate_rep_stats(sender, created=True, **kwargs):
+    # post_delete sends no created flag
+    if created:
+        StatsService.invalidate()
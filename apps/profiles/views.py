@@ -17,7 +17,14 @@ from .serializers import (
     CompanyDetailSerializer,
 )
 from apps.inventory.models import Category
+from apps.inventory.serializers import BulkActivationSerializer
+from apps.inventory.services import BulkActivation, CategoryTree, StatsService
 from utils.fuzzysearch import FuzzySearchFilter
+from utils.search import get_search_backend
+from utils.search_cache import SearchCacheMixin
+from utils.pagination import KeysetPagination
+from utils.export import EXPORT_FORMATS, stream_export
+from utils.serializers import sparse_fieldsets
 from django_countries import countries
 from rest_framework_simplejwt.authentication import JWTAuthentication
 
@@ -26,12 +33,17 @@ from ..inventory.models import Product
 # Create your views here.
 
 
-class SearchForCompany(generics.ListAPIView):
+class SearchForCompany(SearchCacheMixin, generics.ListAPIView):
     serializer_class = CompanySearchSerializer
     filter_backends = [
-        FuzzySearchFilter,
+        get_search_backend(),
     ]
     search_fields = ["countries", "company_name"]
+    fulltext_fields = ["company_name"]
+    search_cache_models = [Company, Category]
+    search_cache_params = ["id", "category", "country"]
+    pagination_class = KeysetPagination
+    cursor_ordering = ("-registration_date", "-id")
 
     def get_serializer_class(self):
         company_id = self.request.query_params.get("id")
@@ -39,14 +51,29 @@ class SearchForCompany(generics.ListAPIView):
             return CompanyDetailSerializer  # Use a different serializer for company_id
         return super().get_serializer_class()  # Use the default otherwise
 
+    def get_serializer_context(self):
+        # ?fields=company_name,countries&expand=categories
+        context = super().get_serializer_context()
+        context.update(sparse_fieldsets(self.request))
+        return context
+
     def get_queryset(self):
         category = self.request.query_params.get("category")
         country = self.request.query_params.get("country")
         company_id = self.request.query_params.get("id")
         if category:
-            queryset = Company.objects.filter(
-                categories__name__in=[category], is_active=True
-            ).order_by("-registration_date")
+            # the category and all of its subcategories
+            window = CategoryTree.window(category)
+            if window is None:
+                queryset = Company.objects.none()
+            else:
+                queryset = (
+                    Company.objects.filter(
+                        is_active=True, **CategoryTree.subtree_lookups(window)
+                    )
+                    .order_by("-registration_date")
+                    .distinct()
+                )
         elif country:
             queryset = Company.objects.filter(
                 countries=country, is_active=True
@@ -66,7 +93,19 @@ class SearchForCompany(generics.ListAPIView):
                 queryset = Company.objects.filter(is_active=True).order_by(
                     "-registration_date"
                 )
-        return queryset
+        if company_id:
+            return queryset
+        fieldsets = sparse_fieldsets(self.request)
+        # columns the pagination and a fuzzy search fallback read
+        required = ["registration_date"]
+        if self.request.query_params.get("search"):
+            required += self.search_fields
+        return CompanySearchSerializer.setup_eager_loading(
+            queryset,
+            fields=fieldsets["fields"],
+            expand=fieldsets["expand"],
+            required=required,
+        )
 
 
 @api_view(["GET"])
@@ -140,20 +179,11 @@ def update_company(request):
 def disable_company(request):
     # Make only super users capable of this
     company_id = request.query_params.get("id")
-    company_instance = Company.objects.filter(id=company_id)
-    if len(company_instance):
-        company_instance[0].is_active = False
-        company_instance[0].save()
-    else:
+    if not Company.objects.filter(id=company_id).exists():
         return Response("No company with that id", status=status.HTTP_400_BAD_REQUEST)
-    
-    # grab all products sold by this company
-    products = Product.objects.filter(seller=company_id)
-    # loop through and disable them
-    for product in products:
-        product.is_active = False
-        product.save()
-    
+
+    # the company and all products sold by it
+    BulkActivation.set_companies([company_id], False)
     return Response("company disabled", status=status.HTTP_200_OK)
 
 
@@ -163,22 +193,38 @@ def disable_company(request):
 def enable_company(request):
     # Make only super users capable of this
     company_id = request.query_params.get("id")
-    company_instance = Company.objects.filter(id=company_id)
-    if len(company_instance):
-        company_instance[0].is_active = True
-        company_instance[0].save()
-    else:
+    if not Company.objects.filter(id=company_id).exists():
         return Response("No company with that id", status=status.HTTP_400_BAD_REQUEST)
-    
-    # grab all products sold by this company
-    products = Product.objects.filter(seller=company_id)
-    # loop through and enable them
-    for product in products:
-        product.is_active = True
-        product.save()
+
+    # the company and all products sold by it
+    BulkActivation.set_companies([company_id], True)
     return Response("company enabled", status=status.HTTP_200_OK)
 
 
+@api_view(["PATCH"])
+@permission_classes([permissions.IsAdminUser])
+@authentication_classes([JWTAuthentication])
+def set_companies_active(request):
+    """
+    Enable or disable many companies and all of their products at once,
+    {"ids": [...], "is_active": false}
+    """
+    serializer = BulkActivationSerializer(data=request.data)
+    if not serializer.is_valid():
+        custom_response_data = {
+            "errors": serializer.errors,
+            "status": "failed",
+            "message": "Invalid data provided",
+        }
+        return Response(custom_response_data, status=status.HTTP_400_BAD_REQUEST)
+    companies, products = BulkActivation.set_companies(
+        serializer.validated_data["ids"], serializer.validated_data["is_active"]
+    )
+    return Response(
+        {"companies": companies, "products": products}, status=status.HTTP_200_OK
+    )
+
+
 class SearchForRep(generics.ListAPIView):
     serializer_class = RepReturnSerializer
     filter_backends = [
@@ -196,13 +242,37 @@ class SearchForRep(generics.ListAPIView):
 @api_view(["GET"])
 def get_number_of_companies(request):
     return Response(
-        {"registered_companies": len(Company.objects.all())}, status=status.HTTP_200_OK
+        {"registered_companies": StatsService.get()["companies"]["total"]},
+        status=status.HTTP_200_OK,
     )
     
 @api_view(["GET"])
 @permission_classes([permissions.IsAdminUser])
 @authentication_classes([JWTAuthentication])
 def get_all_companies(request):
+    export_format = request.query_params.get("export")
+    if export_format is not None:
+        if export_format not in EXPORT_FORMATS:
+            custom_response_data = {
+                "errors": "Unsupported export format",
+                "status": "failed",
+                "message": "export must be one of " + ", ".join(EXPORT_FORMATS),
+            }
+            return Response(custom_response_data, status=status.HTTP_400_BAD_REQUEST)
+        fieldsets = sparse_fieldsets(request)
+        return stream_export(
+            CompanySearchSerializer.setup_eager_loading(
+                Company.objects.all(),
+                fields=fieldsets["fields"],
+                expand=fieldsets["expand"],
+            ),
+            CompanySearchSerializer,
+            export_format,
+            filename="companies",
+            key="registered_companies",
+            context=fieldsets,
+        )
+
     serializer = CompanySearchSerializer(data=Company.objects.all(), many=True)
     serializer.is_valid()
     return Response(
@@ -213,7 +283,8 @@ def get_all_companies(request):
 @api_view(["GET"])
 def get_number_of_reps(request):
     return Response(
-        {"registered_reps": len(Rep.objects.all())}, status=status.HTTP_200_OK
+        {"registered_reps": StatsService.get()["reps"]["total"]},
+        status=status.HTTP_200_OK,
     )
 
 
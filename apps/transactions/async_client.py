@@ -0,0 +1,134 @@
+"""
+Asyncio client for the PeoplesPay hub, used by the async payment views.
+
+Requests go through tornado's AsyncHTTPClient, which runs on the asyncio
+event loop, so one process can keep many slow PeoplesPay calls in
+flight. Timeouts and the retry rules are the ones the sync client in
+client.py uses: connection failures are retried for every call, and
+only calls that don't move money are retried once the request was sent.
+Tokens still come from the shared token cache.
+"""
+import asyncio
+import errno
+import json
+import random
+import socket
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+from .client import (
+    BACKOFF,
+    BASE_URL,
+    DEFAULT_TIMEOUT,
+    IDEMPOTENT_ENDPOINTS,
+    MAX_ATTEMPTS,
+    MAX_BACKOFF,
+    RETRY_STATUSES,
+    TIMEOUTS,
+    PeoplesPayError,
+    record_call,
+)
+from .services import PeoplesPayService
+
+# requests in flight per process, more wait in tornado's queue
+MAX_CLIENTS = 200
+# failures to open the connection, the request was never sent
+CONNECT_ERRNOS = {errno.ECONNREFUSED, errno.ENETUNREACH, errno.EHOSTUNREACH}
+
+AsyncHTTPClient.configure(None, max_clients=MAX_CLIENTS)
+
+
+class AsyncResponse:
+    """
+    The parts of a requests Response the views use
+    """
+
+    def __init__(self, response):
+        self.status_code = response.code
+        self.text = response.body.decode() if response.body else ""
+
+    def json(self):
+        try:
+            return json.loads(self.text)
+        except ValueError as error:
+            raise PeoplesPayError(f"Invalid JSON from PeoplesPay: {error}")
+
+
+def failed_to_connect(error):
+    """
+    Whether a request failed before it was sent. A reset or broken pipe
+    can come after PeoplesPay received it, like the sync client those are
+    only retried for calls that don't move money
+    """
+    if isinstance(error, socket.gaierror):
+        return True
+    if isinstance(error, OSError):
+        return error.errno in CONNECT_ERRNOS
+    # tornado reports timeouts as HTTPClientError 599
+    return "while connecting" in str(error)
+
+
+class AsyncPeoplesPayClient:
+    def __init__(self, base_url=BASE_URL):
+        self.base_url = base_url.rstrip("/")
+
+    async def request(self, method, endpoint, payload=None, token=None):
+        """
+        Send a request to a hub endpoint, raises PeoplesPayError when no
+        response was received
+        """
+        headers = {"Content-Type": "application/json"}
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        connect_timeout, request_timeout = TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+        retry = method == "GET" or endpoint in IDEMPOTENT_ENDPOINTS
+        url = f"{self.base_url}/{endpoint}" if endpoint else self.base_url
+        body = None if payload is None else json.dumps(payload, cls=DjangoJSONEncoder)
+        if not retry:
+            record_call(endpoint)
+
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            request = HTTPRequest(
+                url,
+                method=method,
+                headers=headers,
+                body=body,
+                connect_timeout=connect_timeout,
+                request_timeout=request_timeout,
+            )
+            try:
+                # AsyncHTTPClient() is shared by everything on this event loop
+                response = await AsyncHTTPClient().fetch(request, raise_error=False)
+            except Exception as error:
+                if not (retry or failed_to_connect(error)) or attempt == MAX_ATTEMPTS:
+                    raise PeoplesPayError(f"PeoplesPay request failed: {error}")
+            else:
+                if (
+                    not retry
+                    or response.code not in RETRY_STATUSES
+                    or attempt == MAX_ATTEMPTS
+                ):
+                    return AsyncResponse(response)
+            await asyncio.sleep(
+                random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2**attempt))
+            )
+
+    async def call(self, endpoint, payload=None, operation="DEBIT", method="POST"):
+        """
+        Like PeoplesPayService.call, authenticated with the cached token
+        for the operation and retried once with a new token on a 401
+        """
+        get_token = sync_to_async(PeoplesPayService.get_token, thread_sensitive=False)
+        for attempt in range(2):
+            token = await get_token(operation)
+            if not isinstance(token, dict):
+                raise PeoplesPayError(f"Failed to retrieve a {operation} token")
+            response = await self.request(
+                method, endpoint, payload, token=token["data"]
+            )
+            if response.status_code != 401:
+                break
+            await sync_to_async(PeoplesPayService.clear_token)(operation)
+        return response
@@ -0,0 +1,210 @@
+"""
+Shared HTTP client for the PeoplesPay hub.
+
+One requests Session per process keeps a pool of keep-alive connections,
+so consecutive calls reuse an open TLS connection instead of opening a
+new one each time. Every endpoint has its own connect and read timeouts.
+
+Failures to connect are retried for every call, since the request never
+reached PeoplesPay. Calls that move money are never retried after the
+request was sent: a timeout there doesn't mean the payment failed. Only
+token, enquiry and status calls are retried on read timeouts and 5xx
+responses, with a capped exponential backoff.
+"""
+
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+BASE_URL = "https://peoplespay.com.gh/peoplepay/hub"
+
+# (connect, read) seconds
+DEFAULT_TIMEOUT = (3.05, 15)
+TIMEOUTS = {
+    "token/get": (3.05, 10),
+    "enquiry": (3.05, 10),
+    "disburse": (3.05, 30),
+    "collectmoney": (3.05, 30),
+    "collectmoney/card": (3.05, 30),
+}
+# safe to send twice, they don't move money
+IDEMPOTENT_ENDPOINTS = {"token/get", "enquiry"}
+# GET, a transaction by the externalTransactionId it was sent with
+STATUS_ENDPOINT = "transactions/status/{}"
+RETRY_STATUSES = {502, 503, 504}
+MAX_ATTEMPTS = 3
+BACKOFF = 0.5
+MAX_BACKOFF = 4
+POOL_SIZE = 10
+# seconds between the metrics each process logs
+METRICS_INTERVAL = 300
+
+# calls that move money made in the current context, see track_calls
+_calls = ContextVar("peoplespay_calls", default=None)
+
+
+class PeoplesPayError(requests.exceptions.RequestException):
+    """
+    A call that can't be made, views handle it with the other request errors
+    """
+
+
+def never_sent(error):
+    """
+    Whether a failed call provably never reached PeoplesPay: there was no
+    token for it, or no connection could be made. After any other error
+    PeoplesPay may have received the request
+    """
+    if isinstance(error, (PeoplesPayError, requests.exceptions.ConnectTimeout)):
+        return True
+    if not isinstance(error, requests.exceptions.ConnectionError):
+        return False
+    # refused or unresolvable, urllib3 wraps it in a MaxRetryError
+    reason = error.args[0] if error.args else None
+    return isinstance(getattr(reason, "reason", reason), ConnectTimeoutError)
+
+
+@contextmanager
+def track_calls():
+    """
+    Collects the endpoints that move money called within the block, by
+    either client, so callers can tell whether PeoplesPay may have acted
+    """
+    calls = []
+    token = _calls.set(calls)
+    try:
+        yield calls
+    finally:
+        _calls.reset(token)
+
+
+def record_call(endpoint):
+    calls = _calls.get()
+    if calls is not None:
+        calls.append(endpoint)
+
+
+class PeoplesPayClient:
+    def __init__(self, base_url=BASE_URL, pool_size=POOL_SIZE):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        self.session.headers["Content-Type"] = "application/json"
+        # urllib3 only retries connection errors here, the request wasn't sent
+        self.adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=None,
+                connect=2,
+                read=0,
+                redirect=0,
+                status=0,
+                other=0,
+                backoff_factor=0.2,
+            ),
+        )
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.counters = Counter()
+        self.lock = threading.Lock()
+        self.metrics_logged_at = time.monotonic()
+
+    def request(self, method, endpoint, payload=None, token=None):
+        """
+        Send a request to a hub endpoint and return the requests Response,
+        raises requests' RequestException when no response was received
+        """
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        timeout = TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+        retry = method == "GET" or endpoint in IDEMPOTENT_ENDPOINTS
+        url = f"{self.base_url}/{endpoint}" if endpoint else self.base_url
+        if not retry:
+            record_call(endpoint)
+        self.log_metrics()
+
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            started = time.perf_counter()
+            try:
+                response = self.session.request(
+                    method, url, json=payload, headers=headers, timeout=timeout
+                )
+            except requests.exceptions.RequestException:
+                self.count(endpoint, "errors", started)
+                if not retry or attempt == MAX_ATTEMPTS:
+                    raise
+            else:
+                self.count(endpoint, "responses", started)
+                if (
+                    not retry
+                    or response.status_code not in RETRY_STATUSES
+                    or attempt == MAX_ATTEMPTS
+                ):
+                    return response
+            self.count(endpoint, "retries")
+            time.sleep(random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2**attempt)))
+
+    def post(self, endpoint, payload=None, token=None):
+        return self.request("POST", endpoint, payload, token)
+
+    def get(self, endpoint, token=None):
+        return self.request("GET", endpoint, token=token)
+
+    def count(self, endpoint, counter, started=None):
+        with self.lock:
+            self.counters[f"{endpoint or '/'}:{counter}"] += 1
+            if started is not None:
+                self.counters[f"{endpoint or '/'}:ms"] += int(
+                    (time.perf_counter() - started) * 1000
+                )
+
+    def log_metrics(self):
+        """
+        Log metrics() at most every METRICS_INTERVAL seconds, the
+        counters are per process
+        """
+        with self.lock:
+            if time.monotonic() - self.metrics_logged_at < METRICS_INTERVAL:
+                return
+            self.metrics_logged_at = time.monotonic()
+        logger.info("PeoplesPay client metrics: %s", self.metrics())
+
+    def metrics(self):
+        """
+        This process's counters per endpoint, and how many requests the
+        connection pool served against how many connections it opened
+        """
+        pools = self.adapter.poolmanager.pools
+        connections = requests_sent = 0
+        for key in pools.keys():
+            pool = pools[key]
+            connections += pool.num_connections
+            requests_sent += pool.num_requests
+        with self.lock:
+            counters = dict(self.counters)
+        return {
+            "counters": counters,
+            "connections_opened": connections,
+            "requests_sent": requests_sent,
+            "connections_reused": max(0, requests_sent - connections),
+        }
+
+
+@lru_cache(maxsize=None)
+def get_client():
+    """
+    The process wide client, created on first use so forked workers each
+    open their own connections
+    """
+    return PeoplesPayClient()
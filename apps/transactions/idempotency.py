@@ -0,0 +1,376 @@
+"""
+Idempotency-Key support for the payment endpoints.
+
+The first request with a key claims it, atomically in Redis with
+cache.add and durably with an IdempotencyKey row unique on (scope, key),
+runs, and its response is stored in both. Repeats of the request with
+the same key get the stored response back without calling PeoplesPay,
+normally from Redis alone. A repeat arriving while the first request is
+still running waits for its response. Reusing a key for a different
+request is refused with 422. Keys are scoped to the authenticated user.
+The decorator works on the sync APIViews and on the async views, which
+wait without blocking the event loop.
+
+A claim is a lease: one still pending after LEASE_TIMEOUT belongs to a
+request that died, and the next repeat takes it over. Requests that
+raise or answer 5xx release the key so they can be retried, unless they
+already called a PeoplesPay endpoint that moves money, then their
+response is kept like any other.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from datetime import timedelta
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.http import JsonResponse
+from django.utils.timezone import now
+from redis import RedisError
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from .client import track_calls
+from .models import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+# replays are served from Redis for a day, from the database after that
+CACHE_TIMEOUT = 60 * 60 * 24
+# longer than the slowest PeoplesPay call the first request can make
+WAIT_TIMEOUT = 35
+# longer than the first request can take, a token refresh and a retried
+# call included, so a live request is never taken over
+LEASE_TIMEOUT = 120
+POLL_INTERVAL = 0.25
+# response headers replayed with the body
+REPLAYED_HEADERS = ("Location", "Preference-Applied")
+
+
+def _cache_key(scope, key):
+    digest = hashlib.sha256(key.encode()).hexdigest()
+    return f"idempotency:{scope}:{digest}"
+
+
+def _fingerprint(request):
+    if hasattr(request, "data"):
+        data = request.data
+    else:
+        # plain Django request, as the async views get
+        try:
+            data = json.loads(request.body or b"{}")
+        except ValueError:
+            data = request.body.decode(errors="replace")
+    body = json.dumps(data, sort_keys=True, cls=JSONEncoder)
+    return hashlib.sha256(
+        f"{request.method} {request.path}\n{body}".encode()
+    ).hexdigest()
+
+
+def _scope(scope, user):
+    return f"{scope}:{user.pk}" if user.is_authenticated else scope
+
+
+def _entry(record):
+    return {
+        "request_hash": record.request_hash,
+        "status_code": record.status_code,
+        "body": record.response_body,
+        "headers": record.response_headers,
+        "claimed_at": record.claimed_at.timestamp(),
+    }
+
+
+def _expired(entry):
+    return (
+        entry["status_code"] is None
+        and entry.get("claimed_at", 0) < time.time() - LEASE_TIMEOUT
+    )
+
+
+def _take_over(scope, key, request_hash):
+    """
+    Renew an expired claim for this request, only one repeat gets it
+    """
+    return IdempotencyKey.objects.filter(
+        scope=scope,
+        key=key,
+        request_hash=request_hash,
+        status_code=None,
+        claimed_at__lt=now() - timedelta(seconds=LEASE_TIMEOUT),
+    ).update(claimed_at=now())
+
+
+def claim(scope, key, request_hash):
+    """
+    None when this request now owns the key, else the entry of the
+    request that does, its status_code is None while that one runs
+    """
+    cache_key = _cache_key(scope, key)
+    pending = {
+        "request_hash": request_hash,
+        "status_code": None,
+        "claimed_at": time.time(),
+    }
+    claimed_in_cache = False
+    try:
+        claimed_in_cache = cache.add(cache_key, pending, CACHE_TIMEOUT)
+        if not claimed_in_cache:
+            entry = cache.get(cache_key)
+            # an expired claim is taken over through the database
+            if entry is not None and not _expired(entry):
+                return entry
+    except RedisError:
+        logger.exception("Could not claim idempotency key in Redis")
+
+    try:
+        with transaction.atomic():
+            IdempotencyKey.objects.create(
+                scope=scope, key=key, request_hash=request_hash
+            )
+    except IntegrityError:
+        # claimed before the Redis entry expired or while Redis was down
+        entry = _entry(IdempotencyKey.objects.get(scope=scope, key=key))
+        owned = (
+            _expired(entry)
+            and entry["request_hash"] == request_hash
+            and _take_over(scope, key, request_hash)
+        )
+        try:
+            if owned:
+                cache.set(cache_key, pending, CACHE_TIMEOUT)
+            elif entry["status_code"] is None:
+                cache.delete(cache_key)
+            else:
+                cache.set(cache_key, entry, CACHE_TIMEOUT)
+        except RedisError:
+            logger.exception("Could not update idempotency key in Redis")
+        return None if owned else entry
+
+    if not claimed_in_cache:
+        # replace the expired or unreadable claim
+        try:
+            cache.set(cache_key, pending, CACHE_TIMEOUT)
+        except RedisError:
+            logger.exception("Could not update idempotency key in Redis")
+    return None
+
+
+def _store(scope, key, entry):
+    IdempotencyKey.objects.filter(scope=scope, key=key).update(
+        status_code=entry["status_code"],
+        response_body=entry["body"],
+        response_headers=entry["headers"],
+        completed_at=now(),
+    )
+    try:
+        cache.set(_cache_key(scope, key), entry, CACHE_TIMEOUT)
+    except RedisError:
+        logger.exception("Could not store idempotent response in Redis")
+
+
+def complete(scope, key, request_hash, response):
+    if hasattr(response, "data"):
+        data = response.data
+    else:
+        data = json.loads(response.content or b"null")
+    _store(
+        scope,
+        key,
+        {
+            "request_hash": request_hash,
+            "status_code": response.status_code,
+            # stored as plain JSON, as it would be rendered
+            "body": json.loads(json.dumps(data, cls=JSONEncoder)),
+            "headers": {
+                header: response[header]
+                for header in REPLAYED_HEADERS
+                if response.has_header(header)
+            },
+        },
+    )
+
+
+def release(scope, key):
+    IdempotencyKey.objects.filter(scope=scope, key=key).delete()
+    try:
+        cache.delete(_cache_key(scope, key))
+    except RedisError:
+        logger.exception("Could not release idempotency key in Redis")
+
+
+def lookup(scope, key):
+    """
+    The current entry for the key, None when it was released
+    """
+    try:
+        entry = cache.get(_cache_key(scope, key))
+    except RedisError:
+        entry = None
+    if entry is None:
+        record = IdempotencyKey.objects.filter(scope=scope, key=key).first()
+        if record is None:
+            return None
+        entry = _entry(record)
+    return entry
+
+
+def wait_for(scope, key):
+    """
+    Poll until the request holding the key has its response, None when
+    it released the key or is still running after WAIT_TIMEOUT
+    """
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        entry = lookup(scope, key)
+        if entry is None or entry["status_code"] is not None:
+            return entry
+    return None
+
+
+async def async_wait_for(scope, key):
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(POLL_INTERVAL)
+        entry = await sync_to_async(lookup)(scope, key)
+        if entry is None or entry["status_code"] is not None:
+            return entry
+    return None
+
+
+def _answer(message, status_code):
+    return {"body": {"message": message}, "status_code": status_code, "headers": {}}
+
+
+def _replayed(entry):
+    return {**entry, "headers": {**entry["headers"], "Idempotent-Replayed": "true"}}
+
+
+def _response(answer, response_class):
+    if response_class is JsonResponse:
+        response = JsonResponse(
+            answer["body"], status=answer["status_code"], safe=False
+        )
+    else:
+        response = Response(answer["body"], status=answer["status_code"])
+    for header, value in answer["headers"].items():
+        response[header] = value
+    return response
+
+
+def _begin(scope, request):
+    """
+    (answer, claim): the answer to send without running the handler, or
+    the (scope, key, request_hash) claimed for it. Both are None without
+    an Idempotency-Key. An answer with a None status_code is a claim
+    still held by another request
+    """
+    key = request.headers.get(HEADER)
+    if key is None:
+        return None, None
+    if not key.strip() or len(key) > MAX_KEY_LENGTH:
+        message = f"{HEADER} must be 1 to {MAX_KEY_LENGTH} characters"
+        return _answer(message, status.HTTP_400_BAD_REQUEST), None
+
+    key_scope = _scope(scope, request.user)
+    request_hash = _fingerprint(request)
+    entry = claim(key_scope, key, request_hash)
+    if entry is None:
+        return None, (key_scope, key, request_hash)
+    if entry["request_hash"] != request_hash:
+        message = f"{HEADER} was used for a different request"
+        return _answer(message, status.HTTP_422_UNPROCESSABLE_ENTITY), None
+    if entry["status_code"] is not None:
+        return _replayed(entry), None
+    return entry, (key_scope, key, request_hash)
+
+
+def _waited(entry):
+    if entry is None:
+        message = f"A request with this {HEADER} is in progress"
+        return _answer(message, status.HTTP_409_CONFLICT)
+    return _replayed(entry)
+
+
+def _failed(claimed, calls):
+    key_scope, key, request_hash = claimed
+    if not calls:
+        release(key_scope, key)
+        return
+    # PeoplesPay may have acted, don't let a retry send it again
+    answer = _answer(
+        "The outcome of the request is unknown",
+        status.HTTP_500_INTERNAL_SERVER_ERROR,
+    )
+    _store(key_scope, key, {**answer, "request_hash": request_hash})
+
+
+def _finished(claimed, calls, response):
+    key_scope, key, request_hash = claimed
+    if response.status_code >= 500 and not calls:
+        release(key_scope, key)
+    else:
+        complete(key_scope, key, request_hash, response)
+
+
+def idempotent(scope):
+    """
+    For APIView handlers and the async views. A request with an
+    Idempotency-Key header runs once per key within the scope and user,
+    repeats get its response back
+    """
+
+    def decorator(handler):
+        if asyncio.iscoroutinefunction(handler):
+
+            @wraps(handler)
+            async def async_wrapper(view, request, *args, **kwargs):
+                answer, claimed = await sync_to_async(_begin)(scope, request)
+                if answer is not None:
+                    if answer["status_code"] is None:
+                        answer = _waited(await async_wait_for(*claimed[:2]))
+                    return _response(answer, JsonResponse)
+                if claimed is None:
+                    return await handler(view, request, *args, **kwargs)
+
+                with track_calls() as calls:
+                    try:
+                        response = await handler(view, request, *args, **kwargs)
+                    except Exception:
+                        await sync_to_async(_failed)(claimed, calls)
+                        raise
+                await sync_to_async(_finished)(claimed, calls, response)
+                return response
+
+            return async_wrapper
+
+        @wraps(handler)
+        def wrapper(view, request, *args, **kwargs):
+            answer, claimed = _begin(scope, request)
+            if answer is not None:
+                if answer["status_code"] is None:
+                    answer = _waited(wait_for(*claimed[:2]))
+                return _response(answer, Response)
+            if claimed is None:
+                return handler(view, request, *args, **kwargs)
+
+            with track_calls() as calls:
+                try:
+                    response = handler(view, request, *args, **kwargs)
+                except Exception:
+                    _failed(claimed, calls)
+                    raise
+            _finished(claimed, calls, response)
+            return response
+
+        return wrapper
+
+    return decorator
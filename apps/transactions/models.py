@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 from django.utils import timezone
@@ -12,6 +13,15 @@ import uuid
 
 # this model will replace donations
 class Payments(models.Model):
+    PAYMENT_STATUS_CHOICES = [
+        ("pending", "Pending"),
+        # saved with Prefer: respond-async, waiting for disburse_payment
+        ("queued", "Queued"),
+        # claimed by the disburse_payment task
+        ("processing", "Processing"),
+        ("completed", "Completed"),
+        ("failed", "Failed"),
+    ]
     external_transaction_id = models.UUIDField(
         default=uuid.uuid4, editable=False, primary_key=True
     )
@@ -26,6 +36,19 @@ class Payments(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     # read only field that cant be changed and remains constant
     operation = models.CharField(max_length=100, default="CREDIT", editable=False)
+    transaction_status = models.CharField(
+        max_length=100, choices=PAYMENT_STATUS_CHOICES, default="pending"
+    )
+    # PeoplesPay's message for queued payments
+    status_message = models.CharField(max_length=255, blank=True, default="")
+    # only they can read the status of a queued payment
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        blank=True,
+        null=True,
+        on_delete=models.SET_NULL,
+        related_name="payments",
+    )
 
     def __str__(self):
         return f"{self.account_name} {self.account_number} {self.created_at}"
@@ -59,6 +82,23 @@ class Collections(models.Model):
     transaction_id = models.CharField(
         editable=False, unique=True, max_length=255, default="peoplespay_id"
     )
+    # PeoplesPay's message for queued collections
+    status_message = models.CharField(max_length=255, blank=True, default="")
+    # set when the collect_payment task claims it, see reconcile_payments
+    updated_at = models.DateTimeField(auto_now=True, null=True)
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        blank=True,
+        null=True,
+        on_delete=models.SET_NULL,
+        related_name="collections",
+    )
+
+    # queued collections hold a unique placeholder until PeoplesPay
+    # returns their id, the collect_payment task swaps it for the sending
+    # one before calling PeoplesPay so a collection is only sent once
+    QUEUED_PREFIX = "queued:"
+    SENDING_PREFIX = "sending:"
 
     def __str__(self):
         return f"Collection: {self.amount} - {self.transaction_status} - {self.external_transaction_id}"
@@ -101,3 +141,33 @@ class CollectionsCard(models.Model):
     # Display first 10 characters of hashed card_number in hex
         card_number_hex = self.number[:10].hex() if self.number else "N/A"
         return f"Card Info (Hashed): {card_number_hex}... with Salt"
+
+
+class IdempotencyKey(models.Model):
+    """
+    A payment request sent with an Idempotency-Key header and the response
+    it got, repeats of the request are answered from here. Durable copy of
+    the Redis entry, see idempotency.py
+    """
+
+    scope = models.CharField(max_length=50)
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)
+    # empty while the first request is still being processed
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True)
+    response_headers = models.JSONField(default=dict, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    # renewed when a repeat takes over a claim whose request died
+    claimed_at = models.DateTimeField(default=timezone.now)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["scope", "key"], name="unique_idempotency_key"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.scope} {self.key}"
@@ -13,6 +13,7 @@ class PaymentsSerializer(serializers.ModelSerializer):
     class Meta:
         model = Payments
         fields = "__all__"
+        read_only_fields = ["transaction_status", "status_message", "created_by"]
 
 
 class CollectionsSerializer(serializers.ModelSerializer):
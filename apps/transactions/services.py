@@ -1,31 +1,112 @@
+import base64
+import json
+import logging
 import os
 import stat
+import time
+from datetime import timedelta
 from rest_framework.response import Response
 import requests
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.timezone import now
+from redis import RedisError
 from rest_framework import status
 
+from utils.redis_client import get_redis
+from .client import (
+    BASE_URL,
+    STATUS_ENDPOINT,
+    PeoplesPayError,
+    get_client,
+    never_sent,
+)
+from .models import Collections, Payments
+
+logger = logging.getLogger(__name__)
+
 
 class PeoplesPayService:
-    BASE_URL = "https://peoplespay.com.gh/peoplepay/hub"
+    BASE_URL = BASE_URL
+    TOKEN_KEY = "peoplespay:token:{operation}"
+    # tokens are refreshed this many seconds before they expire
+    TOKEN_EXPIRY_MARGIN = 30
 
     @staticmethod
     def get_token(operation="DEBIT"):
+        """
+        The token response for an operation, cached until shortly before
+        the token expires. When it has to be refreshed one worker fetches
+        a new token while the others, in any process, wait on a Redis lock
+        and then read it from the cache
+        """
+        operation = operation.upper()
+        key = PeoplesPayService.TOKEN_KEY.format(operation=operation)
+        token = None
+        try:
+            token = cache.get(key)
+            if token is None:
+                with get_redis().lock(f"{key}:lock", timeout=30, blocking_timeout=30):
+                    token = cache.get(key)
+                    if token is None:
+                        token = PeoplesPayService.fetch_token(operation)
+                        PeoplesPayService.cache_token(key, token)
+        except RedisError:
+            logger.exception("Could not use the cached %s token", operation)
+        if token is None:
+            token = PeoplesPayService.fetch_token(operation)
+        return token
+
+    @staticmethod
+    def cache_token(key, token):
+        # failed requests return a status code or a Response, not the data
+        if not isinstance(token, dict):
+            return
+        timeout = (
+            PeoplesPayService.token_lifetime(token)
+            - PeoplesPayService.TOKEN_EXPIRY_MARGIN
+        )
+        if timeout > 0:
+            cache.set(key, token, timeout)
+
+    @staticmethod
+    def token_lifetime(token):
+        """
+        Seconds until the token expires, from the response when it says,
+        else from the exp claim of a JWT
+        """
+        for field in ("expiresIn", "expires_in"):
+            try:
+                return int(token[field])
+            except (KeyError, TypeError, ValueError):
+                pass
+        parts = str(token["data"]).split(".")
+        if len(parts) == 3:
+            try:
+                claims = json.loads(
+                    base64.urlsafe_b64decode(parts[1] + "=" * (-len(parts[1]) % 4))
+                )
+                return int(claims["exp"] - time.time())
+            except (KeyError, TypeError, ValueError):
+                pass
+        return settings.PEOPLES_PAY_TOKEN_LIFETIME
+
+    @staticmethod
+    def fetch_token(operation="DEBIT"):
         merchantId = os.getenv("PEOPLES_PAY_MERCHANT_ID")
         apikey = os.getenv("PEOPLES_PAY_API_KEY")
 
         if not merchantId or not apikey:
             raise ValueError("Merchant ID or API key not set in environment variables.")
 
-        url = f"{PeoplesPayService.BASE_URL}/token/get"
         payload = {
             "merchantId": merchantId,
             "apikey": apikey,
             "operation": operation.upper(),
         }
-        headers = {"Content-Type": "application/json"}
         try:
-            response = requests.post(url, json=payload, headers=headers, timeout=10)
+            response = get_client().post("token/get", payload)
             response_data = response.json()
 
             if response.status_code == 200 and "data" in response_data:
@@ -39,6 +120,68 @@ class PeoplesPayService:
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
+    @staticmethod
+    def clear_token(operation="DEBIT"):
+        key = PeoplesPayService.TOKEN_KEY.format(operation=operation.upper())
+        try:
+            cache.delete(key)
+        except RedisError:
+            logger.exception("Could not clear the cached %s token", operation)
+
+    @staticmethod
+    def call(endpoint, payload=None, operation="DEBIT", method="POST"):
+        """
+        Send an authenticated request to a hub endpoint through the shared
+        client. A token PeoplesPay rejects is dropped from the cache and
+        the call sent once more with a new one
+        """
+        for attempt in range(2):
+            token = PeoplesPayService.get_token(operation)
+            if not isinstance(token, dict):
+                raise PeoplesPayError(f"Failed to retrieve a {operation} token")
+            response = get_client().request(
+                method, endpoint, payload, token=token["data"]
+            )
+            if response.status_code != 401:
+                break
+            PeoplesPayService.clear_token(operation)
+        return response
+
+    @staticmethod
+    def transaction_status(external_transaction_id, operation="DEBIT"):
+        """
+        (status, PeoplesPay id) of a transaction sent with our external id,
+        status is "completed", "failed", "pending" or "not_found". Raises
+        RequestException when PeoplesPay can't tell, a 404 without
+        PeoplesPay's JSON answer included
+        """
+        response = PeoplesPayService.call(
+            STATUS_ENDPOINT.format(external_transaction_id),
+            operation=operation,
+            method="GET",
+        )
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+        # a wrong path 404s too, only PeoplesPay's own answer means it
+        # never received the transaction
+        if response.status_code == 404 and data.get("success") is False:
+            return "not_found", None
+        if response.status_code != 200 or not data.get("success"):
+            raise PeoplesPayError(
+                f"Status of {external_transaction_id}: {data.get('message')}"
+            )
+        details = data.get("data") or {}
+        state = str(details.get("status", "")).lower()
+        if state in ("success", "successful", "completed", "paid"):
+            state = "completed"
+        elif state in ("failed", "failure", "declined", "reversed"):
+            state = "failed"
+        else:
+            state = "pending"
+        return state, details.get("transactionId")
+
     @staticmethod
     def disburse_money(
         token,
@@ -49,7 +192,6 @@ class PeoplesPayService:
         external_transaction_id,
         description,
     ):
-        URL = f"{PeoplesPayService.BASE_URL}/disburse"
         payload = {
             "amount": str(amount),
             "account_number": account_number,
@@ -58,11 +200,7 @@ class PeoplesPayService:
             "external_transaction_id": external_transaction_id,
             "description": description,
         }
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {token}",
-        }
-        reponse = requests.post(URL, json=payload, headers=headers)
+        reponse = get_client().post("disburse", payload, token=token)
         return reponse.json()
 
     @staticmethod
@@ -74,7 +212,6 @@ class PeoplesPayService:
         account_issuer,
         callbackUrl,
     ):
-        URL = f"{PeoplesPayService.BASE_URL}/collectmoney"
         payload = {
             "amount": str(amount),
             "account_number": account_number,
@@ -82,9 +219,215 @@ class PeoplesPayService:
             "account_issuer": account_issuer,
             "callbackUrl": callbackUrl,
         }
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {token}",
-        }
-        reponse = requests.post(URL, json=payload, headers=headers)
+        reponse = get_client().post("collectmoney", payload, token=token)
         return reponse.json()
+
+
+class QueuedPayments:
+    """
+    Collections and disbursements accepted with Prefer: respond-async. The
+    view saves a queued row and the tasks on the payments queue make the
+    PeoplesPay call, recording the outcome on the row for the status
+    endpoints. Each row is claimed with a conditional UPDATE first, so a
+    task delivered twice doesn't move money twice.
+
+    unsent_payments() and unsent_collections() are the rows still queued
+    long after they were saved, their task was lost or never sent.
+    reconcile() settles the rows whose worker died after claiming them,
+    or that PeoplesPay may have received without answering, from
+    PeoplesPay's record of the transaction
+    """
+
+    # longer than a queued task waits for a worker
+    REQUEUE_AFTER = timedelta(minutes=5)
+    # longer than a worker can take to call PeoplesPay
+    RECONCILE_AFTER = timedelta(minutes=10)
+
+    @staticmethod
+    def unsent_payments():
+        return Payments.objects.filter(
+            transaction_status="queued",
+            updated_at__lt=now() - QueuedPayments.REQUEUE_AFTER,
+        ).values_list("pk", flat=True)
+
+    @staticmethod
+    def unsent_collections():
+        return Collections.objects.filter(
+            transaction_id__startswith=Collections.QUEUED_PREFIX,
+            updated_at__lt=now() - QueuedPayments.REQUEUE_AFTER,
+        ).values_list("pk", flat=True)
+
+    @staticmethod
+    def collect(external_transaction_id):
+        queued = Collections.QUEUED_PREFIX + str(external_transaction_id)
+        sending = Collections.SENDING_PREFIX + str(external_transaction_id)
+        claimed = Collections.objects.filter(
+            pk=external_transaction_id, transaction_id=queued
+        ).update(transaction_id=sending, updated_at=now())
+        if not claimed:
+            return
+        collection = Collections.objects.get(pk=external_transaction_id)
+        payload = {
+            "amount": str(collection.amount),
+            "account_number": collection.account_number,
+            "account_name": collection.account_name,
+            "account_issuer": collection.account_issuer,
+            "callbackUrl": collection.callbackUrl,
+            "description": collection.description,
+            "externalTransactionId": str(external_transaction_id),
+        }
+        try:
+            response = PeoplesPayService.call("collectmoney", payload)
+            data = response.json()
+        except requests.exceptions.RequestException as e:
+            if never_sent(e):
+                logger.exception("Collection %s failed", external_transaction_id)
+                collection.transaction_status = "failed"
+                collection.status_message = f"Error processing collection: {e}"[:255]
+            else:
+                # PeoplesPay may have received it, left pending on the
+                # sending id for reconcile()
+                logger.exception(
+                    "Outcome of collection %s is unknown", external_transaction_id
+                )
+                collection.status_message = f"Outcome unknown: {e}"[:255]
+            collection.save(
+                update_fields=["transaction_status", "status_message", "updated_at"]
+            )
+            return
+
+        collection.status_message = str(data.get("message", ""))[:255]
+        transaction_id = data.get("transactionId")
+        if not (response.status_code == 200 and data.get("success") and transaction_id):
+            collection.transaction_status = "failed"
+            collection.save(update_fields=["transaction_status", "status_message"])
+            return
+        # stays pending until PeoplesPay calls back
+        with transaction.atomic():
+            collection.transaction_id = transaction_id
+            collection.save(update_fields=["transaction_id", "status_message"])
+            Payments.objects.create(
+                external_transaction_id=external_transaction_id,
+                amount=collection.amount,
+                account_name=collection.account_name,
+                account_number=collection.account_number,
+                account_issuer=collection.account_issuer,
+                created_by=collection.created_by,
+            )
+
+    @staticmethod
+    def disburse(external_transaction_id):
+        claimed = Payments.objects.filter(
+            pk=external_transaction_id, transaction_status="queued"
+        ).update(transaction_status="processing", updated_at=now())
+        if not claimed:
+            return
+        payment = Payments.objects.get(pk=external_transaction_id)
+        payload = {
+            "amount": str(payment.amount),
+            "account_number": payment.account_number,
+            "account_name": payment.account_name,
+            "account_issuer": payment.account_issuer,
+            "description": payment.description,
+            # lets reconcile() look the payment up
+            "externalTransactionId": str(external_transaction_id),
+        }
+        try:
+            response = PeoplesPayService.call("disburse", payload, operation="CREDIT")
+            data = response.json()
+        except requests.exceptions.RequestException as e:
+            if never_sent(e):
+                logger.exception("Payment %s failed", external_transaction_id)
+                payment.transaction_status = "failed"
+                payment.status_message = f"Error processing payment: {e}"[:255]
+            else:
+                # PeoplesPay may have paid it, left processing for reconcile()
+                logger.exception(
+                    "Outcome of payment %s is unknown", external_transaction_id
+                )
+                payment.status_message = f"Outcome unknown: {e}"[:255]
+        else:
+            success = response.status_code == 200 and data.get("success")
+            payment.transaction_status = "completed" if success else "failed"
+            payment.status_message = str(
+                data.get("message", "" if success else "Payment failed")
+            )[:255]
+        payment.save(
+            update_fields=["transaction_status", "status_message", "updated_at"]
+        )
+
+    @staticmethod
+    def reconcile():
+        stale = now() - QueuedPayments.RECONCILE_AFTER
+        for pk in Payments.objects.filter(
+            transaction_status="processing", updated_at__lt=stale
+        ).values_list("pk", flat=True):
+            QueuedPayments.reconcile_payment(pk)
+        for pk in Collections.objects.filter(
+            transaction_id__startswith=Collections.SENDING_PREFIX,
+            transaction_status="pending",
+            updated_at__lt=stale,
+        ).values_list("pk", flat=True):
+            QueuedPayments.reconcile_collection(pk)
+
+    @staticmethod
+    def reconcile_payment(external_transaction_id):
+        try:
+            state, _ = PeoplesPayService.transaction_status(
+                external_transaction_id, operation="CREDIT"
+            )
+        except requests.exceptions.RequestException:
+            logger.exception("Could not reconcile payment %s", external_transaction_id)
+            return
+        if state == "pending":
+            return
+        if state == "not_found":
+            state, message = "failed", "Not received by PeoplesPay"
+        else:
+            message = f"Reconciled with PeoplesPay: {state}"
+        Payments.objects.filter(
+            pk=external_transaction_id, transaction_status="processing"
+        ).update(transaction_status=state, status_message=message, updated_at=now())
+
+    @staticmethod
+    def reconcile_collection(external_transaction_id):
+        try:
+            state, transaction_id = PeoplesPayService.transaction_status(
+                external_transaction_id
+            )
+        except requests.exceptions.RequestException:
+            logger.exception(
+                "Could not reconcile collection %s", external_transaction_id
+            )
+            return
+        sending = Collections.objects.filter(
+            pk=external_transaction_id,
+            transaction_id=Collections.SENDING_PREFIX + str(external_transaction_id),
+        )
+        if state == "not_found":
+            sending.update(
+                transaction_status="failed",
+                status_message="Not received by PeoplesPay",
+                updated_at=now(),
+            )
+            return
+        if not transaction_id:
+            return
+        with transaction.atomic():
+            # pending ones are completed by PeoplesPay's callback
+            updated = sending.update(
+                transaction_id=transaction_id,
+                transaction_status=state,
+                status_message=f"Reconciled with PeoplesPay: {state}",
+                updated_at=now(),
+            )
+            if updated and state != "failed":
+                collection = Collections.objects.get(pk=external_transaction_id)
+                Payments.objects.create(
+                    external_transaction_id=external_transaction_id,
+                    amount=collection.amount,
+                    account_name=collection.account_name,
+                    account_number=collection.account_number,
+                    account_issuer=collection.account_issuer,
+                    created_by=collection.created_by,
+                )
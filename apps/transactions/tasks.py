@@ -0,0 +1,39 @@
+from datetime import timedelta
+
+from celery import shared_task
+from django.utils.timezone import now
+
+from .models import IdempotencyKey
+from .services import QueuedPayments
+
+
+# routed to the payments queue by CELERY_TASK_ROUTES, never retried
+# automatically as PeoplesPay may have received the first attempt
+@shared_task(ignore_result=True)
+def collect_payment(external_transaction_id):
+    QueuedPayments.collect(external_transaction_id)
+
+
+@shared_task(ignore_result=True)
+def disburse_payment(external_transaction_id):
+    QueuedPayments.disburse(external_transaction_id)
+
+
+@shared_task(ignore_result=True)
+def requeue_payments():
+    # their task was lost or the broker was down when they were saved
+    for pk in QueuedPayments.unsent_payments():
+        disburse_payment.delay(str(pk))
+    for pk in QueuedPayments.unsent_collections():
+        collect_payment.delay(str(pk))
+
+
+@shared_task(ignore_result=True)
+def reconcile_payments():
+    requeue_payments()
+    QueuedPayments.reconcile()
+
+
+@shared_task(ignore_result=True)
+def prune_idempotency_keys(days=7):
+    IdempotencyKey.objects.filter(created_at__lt=now() - timedelta(days=days)).delete()
@@ -1,3 +1,643 @@
-from django.test import TestCase
+import base64
+import json
+import time
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import AsyncClient, TestCase, override_settings
+from django.utils.timezone import now
+from redis import RedisError
+from kombu.exceptions import OperationalError
+from requests.exceptions import ConnectionError, ReadTimeout
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+from rest_framework.test import APIClient
+
+from . import client as peoplespay_client
+from . import idempotency
+from .client import (
+    MAX_ATTEMPTS,
+    PeoplesPayClient,
+    PeoplesPayError,
+    never_sent,
+    record_call,
+    track_calls,
+)
+from .models import Collections, IdempotencyKey, Payments
+from .services import PeoplesPayService, QueuedPayments
+from .tasks import requeue_payments
+from .views import AsyncPeoplesPayView
 
 # Create your tests here.
+
+
+def peoplespay_response(status_code=200, **data):
+    response = mock.Mock(status_code=status_code)
+    response.json.return_value = data
+    return response
+
+
+def refused():
+    # what requests raises when PeoplesPay can't be reached
+    return ConnectionError(
+        MaxRetryError(None, "/disburse", NewConnectionError(None, "refused"))
+    )
+
+
+def create_user(email):
+    return get_user_model().objects.create_user(
+        email=email, password="password", first_name="Ama", last_name="Mensah"
+    )
+
+
+PAYMENT = {
+    "amount": "10.00",
+    "account_name": "Ama Mensah",
+    "account_number": "0241234567",
+    "account_issuer": "MTN",
+    "description": "invoice 12",
+}
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class TokenCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch("apps.transactions.services.get_redis")
+        self.redis = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch_token(self, *tokens):
+        return mock.patch.object(
+            PeoplesPayService,
+            "fetch_token",
+            side_effect=[{"data": token, "expiresIn": 600} for token in tokens],
+        )
+
+    def test_token_is_fetched_once_and_cached(self):
+        with self.fetch_token("first", "second") as fetch_token:
+            self.assertEqual(PeoplesPayService.get_token()["data"], "first")
+            self.assertEqual(PeoplesPayService.get_token()["data"], "first")
+        fetch_token.assert_called_once_with("DEBIT")
+
+    def test_tokens_are_cached_per_operation(self):
+        with self.fetch_token("debit", "credit") as fetch_token:
+            self.assertEqual(PeoplesPayService.get_token("DEBIT")["data"], "debit")
+            self.assertEqual(PeoplesPayService.get_token("credit")["data"], "credit")
+            self.assertEqual(PeoplesPayService.get_token("CREDIT")["data"], "credit")
+        self.assertEqual(fetch_token.call_count, 2)
+
+    def test_token_refreshed_while_waiting_for_the_lock_is_used(self):
+        key = PeoplesPayService.TOKEN_KEY.format(operation="DEBIT")
+        # another worker refreshes the token while this one waits
+        self.redis().lock().__enter__.side_effect = lambda: cache.set(
+            key, {"data": "theirs", "expiresIn": 600}
+        )
+        with self.fetch_token("mine") as fetch_token:
+            self.assertEqual(PeoplesPayService.get_token()["data"], "theirs")
+        fetch_token.assert_not_called()
+
+    def test_token_is_fetched_without_the_lock_when_redis_is_down(self):
+        self.redis().lock.side_effect = RedisError
+        with self.fetch_token("first") as fetch_token, self.assertLogs(
+            "apps.transactions.services", "ERROR"
+        ):
+            self.assertEqual(PeoplesPayService.get_token()["data"], "first")
+        fetch_token.assert_called_once()
+
+    def test_failed_token_request_is_not_cached(self):
+        with mock.patch.object(
+            PeoplesPayService,
+            "fetch_token",
+            side_effect=[400, {"data": "token", "expiresIn": 600}],
+        ) as fetch_token:
+            self.assertEqual(PeoplesPayService.get_token(), 400)
+            self.assertEqual(PeoplesPayService.get_token()["data"], "token")
+        self.assertEqual(fetch_token.call_count, 2)
+
+    def test_token_expiring_within_the_margin_is_not_cached(self):
+        with mock.patch.object(
+            PeoplesPayService,
+            "fetch_token",
+            return_value={"data": "token", "expiresIn": 10},
+        ) as fetch_token:
+            PeoplesPayService.get_token()
+            PeoplesPayService.get_token()
+        self.assertEqual(fetch_token.call_count, 2)
+
+    def test_token_lifetime(self):
+        claims = json.dumps({"exp": int(time.time()) + 900}).encode()
+        jwt = ".".join(
+            ["header", base64.urlsafe_b64encode(claims).decode().rstrip("="), "sig"]
+        )
+        self.assertEqual(PeoplesPayService.token_lifetime({"expiresIn": "300"}), 300)
+        self.assertAlmostEqual(
+            PeoplesPayService.token_lifetime({"data": jwt}), 900, delta=5
+        )
+        with self.settings(PEOPLES_PAY_TOKEN_LIFETIME=120):
+            self.assertEqual(PeoplesPayService.token_lifetime({"data": "opaque"}), 120)
+
+    def test_rejected_token_is_replaced_and_the_call_sent_again(self):
+        client = mock.Mock()
+        client.request.side_effect = [
+            peoplespay_response(401),
+            peoplespay_response(200, success=True),
+        ]
+        with self.fetch_token("expired", "fresh"), mock.patch(
+            "apps.transactions.services.get_client", return_value=client
+        ):
+            response = PeoplesPayService.call("enquiry", {"account_number": "1"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [call.kwargs["token"] for call in client.request.call_args_list],
+            ["expired", "fresh"],
+        )
+
+
+class ClientRetryTest(TestCase):
+    def setUp(self):
+        self.client = PeoplesPayClient("https://peoplespay.test/hub")
+        self.client.session.request = mock.Mock()
+        patcher = mock.patch.object(peoplespay_client.time, "sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def respond(self, *responses):
+        self.client.session.request.side_effect = responses
+
+    def test_enquiry_is_retried_after_a_read_timeout(self):
+        self.respond(ReadTimeout(), peoplespay_response(200, success=True))
+        response = self.client.post("enquiry", {"account_number": "1"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.session.request.call_count, 2)
+        self.sleep.assert_called_once()
+
+    def test_status_lookup_is_retried_on_5xx_up_to_max_attempts(self):
+        self.respond(*[peoplespay_response(503) for _ in range(MAX_ATTEMPTS + 1)])
+        response = self.client.get("transactions/status/1")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.client.session.request.call_count, MAX_ATTEMPTS)
+
+    def test_enquiry_gives_up_after_max_attempts(self):
+        self.respond(*[ReadTimeout() for _ in range(MAX_ATTEMPTS)])
+        with self.assertRaises(ReadTimeout):
+            self.client.post("enquiry", {})
+        self.assertEqual(self.client.session.request.call_count, MAX_ATTEMPTS)
+
+    def test_disburse_is_not_retried_after_a_read_timeout(self):
+        self.respond(ReadTimeout(), peoplespay_response(200, success=True))
+        with self.assertRaises(ReadTimeout):
+            self.client.post("disburse", {"amount": "10"})
+        self.client.session.request.assert_called_once()
+
+    def test_collection_is_not_retried_on_5xx(self):
+        self.respond(peoplespay_response(503), peoplespay_response(200))
+        response = self.client.post("collectmoney", {"amount": "10"})
+        self.assertEqual(response.status_code, 503)
+        self.client.session.request.assert_called_once()
+
+    def test_only_connection_failures_are_retried_by_the_pool(self):
+        retries = self.client.adapter.max_retries
+        self.assertGreater(retries.connect, 0)
+        self.assertEqual(retries.read, 0)
+        self.assertEqual(retries.status, 0)
+        self.assertEqual(retries.other, 0)
+
+    def test_calls_that_move_money_are_tracked(self):
+        self.respond(
+            peoplespay_response(200),
+            ConnectionError(),
+            peoplespay_response(200),
+        )
+        with track_calls() as calls:
+            self.client.post("enquiry", {})
+            with self.assertRaises(ConnectionError):
+                self.client.post("disburse", {})
+            self.client.post("token/get", {})
+        self.assertEqual(calls, ["disburse"])
+
+    def test_metrics_are_logged_periodically(self):
+        self.respond(peoplespay_response(200), peoplespay_response(200))
+        with mock.patch.object(peoplespay_client, "METRICS_INTERVAL", 0):
+            with self.assertLogs("apps.transactions.client", "INFO") as logs:
+                self.client.post("enquiry", {})
+        self.assertIn("PeoplesPay client metrics", logs.output[0])
+        # not again within the interval
+        with self.assertNoLogs("apps.transactions.client", "INFO"):
+            self.client.post("enquiry", {})
+
+    def test_endpoints_have_their_own_timeouts(self):
+        self.respond(peoplespay_response(200), peoplespay_response(200))
+        self.client.post("disburse", {})
+        self.client.post("token/get", {})
+        timeouts = [
+            call.kwargs["timeout"]
+            for call in self.client.session.request.call_args_list
+        ]
+        self.assertEqual(
+            timeouts,
+            [
+                peoplespay_client.TIMEOUTS["disburse"],
+                peoplespay_client.TIMEOUTS["token/get"],
+            ],
+        )
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class QueuedPaymentsTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = create_user("ama@example.com")
+        patcher = mock.patch.object(PeoplesPayService, "call")
+        self.call = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_payment(self, **fields):
+        return Payments.objects.create(
+            **{
+                **PAYMENT,
+                "transaction_status": "queued",
+                "created_by": self.user,
+                **fields,
+            }
+        )
+
+    def create_collection(self):
+        collection = Collections(**PAYMENT, created_by=self.user)
+        collection.transaction_id = Collections.QUEUED_PREFIX + str(
+            collection.external_transaction_id
+        )
+        collection.save()
+        return collection
+
+    def make_stale(self, model, pk):
+        # older than both REQUEUE_AFTER and RECONCILE_AFTER
+        model.objects.filter(pk=pk).update(
+            updated_at=now() - QueuedPayments.RECONCILE_AFTER * 2
+        )
+
+    def test_payment_is_disbursed_once(self):
+        self.call.return_value = peoplespay_response(
+            200, success=True, message="Successful"
+        )
+        payment = self.create_payment()
+        QueuedPayments.disburse(payment.pk)
+        # delivered again
+        QueuedPayments.disburse(payment.pk)
+        self.call.assert_called_once()
+        self.assertEqual(self.call.call_args.args[0], "disburse")
+        self.assertEqual(
+            self.call.call_args.args[1]["externalTransactionId"], str(payment.pk)
+        )
+        payment.refresh_from_db()
+        self.assertEqual(payment.transaction_status, "completed")
+        self.assertEqual(payment.status_message, "Successful")
+
+    def test_declined_payment_is_marked_failed(self):
+        self.call.return_value = peoplespay_response(
+            200, success=False, message="Insufficient balance"
+        )
+        payment = self.create_payment()
+        QueuedPayments.disburse(payment.pk)
+        payment.refresh_from_db()
+        self.assertEqual(payment.transaction_status, "failed")
+        self.assertEqual(payment.status_message, "Insufficient balance")
+
+    def test_payment_that_never_reached_peoplespay_is_marked_failed(self):
+        self.call.side_effect = refused()
+        payment = self.create_payment()
+        with self.assertLogs("apps.transactions.services", "ERROR"):
+            QueuedPayments.disburse(payment.pk)
+        payment.refresh_from_db()
+        self.assertEqual(payment.transaction_status, "failed")
+
+    def test_payment_without_a_response_is_left_for_reconcile(self):
+        # PeoplesPay may have paid it before the read timed out
+        self.call.side_effect = ReadTimeout("read timed out")
+        payment = self.create_payment()
+        with self.assertLogs("apps.transactions.services", "ERROR"):
+            QueuedPayments.disburse(payment.pk)
+        payment.refresh_from_db()
+        self.assertEqual(payment.transaction_status, "processing")
+        self.assertIn("read timed out", payment.status_message)
+        self.make_stale(Payments, payment.pk)
+        with mock.patch.object(
+            PeoplesPayService, "transaction_status", return_value=("completed", "PP1")
+        ):
+            QueuedPayments.reconcile()
+        payment.refresh_from_db()
+        self.assertEqual(payment.transaction_status, "completed")
+
+    def test_collection_without_a_response_is_left_for_reconcile(self):
+        self.call.side_effect = ReadTimeout("read timed out")
+        collection = self.create_collection()
+        with self.assertLogs("apps.transactions.services", "ERROR"):
+            QueuedPayments.collect(collection.pk)
+        collection.refresh_from_db()
+        self.assertEqual(collection.transaction_status, "pending")
+        self.assertTrue(
+            collection.transaction_id.startswith(Collections.SENDING_PREFIX)
+        )
+        self.make_stale(Collections, collection.pk)
+        with mock.patch.object(
+            PeoplesPayService, "transaction_status", return_value=("pending", "PP7")
+        ):
+            QueuedPayments.reconcile()
+        collection.refresh_from_db()
+        # PeoplesPay's callback can find it now
+        self.assertEqual(collection.transaction_id, "PP7")
+
+    def test_collection_is_sent_once_and_recorded(self):
+        self.call.return_value = peoplespay_response(
+            200, success=True, message="Pending", transactionId="PP123"
+        )
+        collection = self.create_collection()
+        QueuedPayments.collect(collection.pk)
+        QueuedPayments.collect(collection.pk)
+        self.call.assert_called_once()
+        collection.refresh_from_db()
+        self.assertEqual(collection.transaction_id, "PP123")
+        # completed by PeoplesPay's callback
+        self.assertEqual(collection.transaction_status, "pending")
+        payment = Payments.objects.get(pk=collection.pk)
+        self.assertEqual(payment.created_by, self.user)
+
+    def test_reconcile_settles_stale_payments_only(self):
+        completed = self.create_payment(transaction_status="processing")
+        missing = self.create_payment(transaction_status="processing")
+        recent = self.create_payment(transaction_status="processing")
+        self.make_stale(Payments, completed.pk)
+        self.make_stale(Payments, missing.pk)
+        states = {
+            str(completed.pk): ("completed", "PP1"),
+            str(missing.pk): ("not_found", None),
+        }
+        with mock.patch.object(
+            PeoplesPayService,
+            "transaction_status",
+            side_effect=lambda pk, operation: states[str(pk)],
+        ) as transaction_status:
+            QueuedPayments.reconcile()
+        self.assertEqual(transaction_status.call_count, 2)
+        self.assertEqual(
+            Payments.objects.get(pk=completed.pk).transaction_status, "completed"
+        )
+        self.assertEqual(
+            Payments.objects.get(pk=missing.pk).transaction_status, "failed"
+        )
+        self.assertEqual(
+            Payments.objects.get(pk=recent.pk).transaction_status, "processing"
+        )
+
+    def test_reconcile_records_the_peoplespay_id_of_a_collection(self):
+        collection = self.create_collection()
+        Collections.objects.filter(pk=collection.pk).update(
+            transaction_id=Collections.SENDING_PREFIX + str(collection.pk)
+        )
+        self.make_stale(Collections, collection.pk)
+        with mock.patch.object(
+            PeoplesPayService, "transaction_status", return_value=("completed", "PP9")
+        ):
+            QueuedPayments.reconcile()
+        collection.refresh_from_db()
+        self.assertEqual(collection.transaction_id, "PP9")
+        self.assertEqual(collection.transaction_status, "completed")
+        self.assertTrue(Payments.objects.filter(pk=collection.pk).exists())
+
+    def test_respond_async_queues_the_payment(self):
+        self.client.force_authenticate(self.user)
+        with mock.patch("apps.transactions.views.disburse_payment.delay") as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(
+                    "/api/v1/payments/",
+                    PAYMENT,
+                    format="json",
+                    HTTP_PREFER="respond-async",
+                )
+        self.assertEqual(response.status_code, 202)
+        payment = Payments.objects.get()
+        self.assertEqual(payment.transaction_status, "queued")
+        self.assertEqual(payment.created_by, self.user)
+        delay.assert_called_once_with(str(payment.pk))
+        self.assertTrue(response["Location"].endswith(f"/payments/{payment.pk}/"))
+        self.call.assert_not_called()
+
+    def test_payment_queued_while_the_broker_is_down_is_sent_later(self):
+        self.client.force_authenticate(self.user)
+        with mock.patch(
+            "apps.transactions.views.disburse_payment.delay",
+            side_effect=OperationalError,
+        ), self.assertLogs("apps.transactions.views", "ERROR"):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(
+                    "/api/v1/payments/",
+                    PAYMENT,
+                    format="json",
+                    HTTP_PREFER="respond-async",
+                )
+        self.assertEqual(response.status_code, 202)
+        payment = Payments.objects.get()
+        self.make_stale(Payments, payment.pk)
+        with mock.patch("apps.transactions.tasks.disburse_payment.delay") as delay:
+            requeue_payments()
+        delay.assert_called_once_with(str(payment.pk))
+
+    def test_anonymous_respond_async_is_processed_synchronously(self):
+        self.call.return_value = peoplespay_response(200, success=True)
+        with mock.patch("apps.transactions.views.disburse_payment.delay") as delay:
+            response = self.client.post(
+                "/api/v1/payments/", PAYMENT, format="json", HTTP_PREFER="respond-async"
+            )
+        self.assertEqual(response.status_code, 201)
+        delay.assert_not_called()
+        self.assertEqual(Payments.objects.get().transaction_status, "completed")
+
+    def test_status_is_only_shown_to_its_creator(self):
+        payment = self.create_payment()
+        url = f"/api/v1/payments/{payment.pk}/"
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.force_authenticate(create_user("kofi@example.com"))
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.client.force_authenticate(self.user)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["status"], "pending")
+
+    def test_collection_status_hides_the_placeholder_id(self):
+        collection = self.create_collection()
+        self.client.force_authenticate(self.user)
+        response = self.client.get(f"/api/v1/collections/{collection.pk}/")
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.data["peoplespay_id"])
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class IdempotentPaymentsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = create_user("ama@example.com")
+        self.client.force_authenticate(self.user)
+        patcher = mock.patch.object(PeoplesPayService, "call")
+        self.call = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.call.return_value = peoplespay_response(200, success=True)
+
+    def pay(self, key="key-1", **fields):
+        return self.client.post(
+            "/api/v1/payments/",
+            {**PAYMENT, **fields},
+            format="json",
+            HTTP_IDEMPOTENCY_KEY=key,
+        )
+
+    def test_repeated_request_is_replayed(self):
+        first = self.pay()
+        second = self.pay()
+        self.assertEqual(first.status_code, 201)
+        self.assertNotIn("Idempotent-Replayed", first)
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+        self.call.assert_called_once()
+        self.assertEqual(Payments.objects.count(), 1)
+
+    def test_response_is_replayed_from_the_database_when_redis_is_down(self):
+        self.pay()
+        with mock.patch.object(idempotency, "cache") as redis_cache, self.assertLogs(
+            "apps.transactions.idempotency", "ERROR"
+        ):
+            redis_cache.add.side_effect = RedisError
+            redis_cache.set.side_effect = RedisError
+            response = self.pay()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response["Idempotent-Replayed"], "true")
+        self.call.assert_called_once()
+
+    def test_key_reused_for_a_different_request_is_refused(self):
+        self.pay()
+        response = self.pay(amount="99.00")
+        self.assertEqual(response.status_code, 422)
+        self.call.assert_called_once()
+
+    def test_invalid_key_is_refused(self):
+        self.assertEqual(self.pay(key=" ").status_code, 400)
+        self.assertEqual(self.pay(key="k" * 256).status_code, 400)
+        self.call.assert_not_called()
+
+    def test_keys_are_scoped_to_the_user(self):
+        self.pay()
+        self.client.force_authenticate(create_user("kofi@example.com"))
+        response = self.pay()
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn("Idempotent-Replayed", response)
+        self.assertEqual(self.call.call_count, 2)
+
+    def test_repeat_of_a_request_in_progress_gets_409(self):
+        repeats = []
+
+        def call(*args, **kwargs):
+            # the client retries while the first request waits on PeoplesPay
+            repeats.append(self.pay())
+            return peoplespay_response(200, success=True)
+
+        self.call.side_effect = call
+        with mock.patch.object(idempotency, "WAIT_TIMEOUT", 0.05), mock.patch.object(
+            idempotency, "POLL_INTERVAL", 0.01
+        ):
+            response = self.pay()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(repeats[0].status_code, 409)
+        self.call.assert_called_once()
+
+    def test_expired_claim_is_taken_over(self):
+        repeats = []
+        calls = []
+
+        def call(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                # the first request is taken to have died
+                repeats.append(self.pay())
+            return peoplespay_response(200, success=True)
+
+        self.call.side_effect = call
+        with mock.patch.object(idempotency, "LEASE_TIMEOUT", -60):
+            self.pay()
+        self.assertEqual(repeats[0].status_code, 201)
+        self.assertNotIn("Idempotent-Replayed", repeats[0])
+        self.assertEqual(self.call.call_count, 2)
+
+    def test_key_is_released_when_peoplespay_was_not_called(self):
+        self.call.side_effect = [
+            ValueError("bad payload"),
+            peoplespay_response(200, success=True),
+        ]
+        with self.assertRaises(ValueError):
+            self.pay()
+        self.assertFalse(IdempotencyKey.objects.exists())
+        self.assertEqual(self.pay().status_code, 201)
+        self.assertEqual(self.call.call_count, 2)
+
+    def test_unknown_outcome_is_kept_when_peoplespay_was_called(self):
+        def call(endpoint, *args, **kwargs):
+            record_call(endpoint)
+            raise ValueError("unreadable response")
+
+        self.call.side_effect = call
+        with self.assertRaises(ValueError):
+            self.pay()
+        response = self.pay()
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response["Idempotent-Replayed"], "true")
+        self.call.assert_called_once()
+
+    async def test_async_view_replays_repeated_request(self):
+        client = AsyncClient()
+        call = mock.AsyncMock(return_value=peoplespay_response(200, success=True))
+        with mock.patch.object(AsyncPeoplesPayView.client, "call", call):
+            for _ in range(2):
+                response = await client.post(
+                    "/api/v1/async/payments/",
+                    PAYMENT,
+                    content_type="application/json",
+                    IDEMPOTENCY_KEY="key-1",
+                )
+                self.assertEqual(response.status_code, 201)
+        self.assertEqual(response["Idempotent-Replayed"], "true")
+        call.assert_awaited_once()
+
+
+class TransactionStatusTest(TestCase):
+    def lookup(self, response):
+        with mock.patch.object(PeoplesPayService, "call", return_value=response):
+            return PeoplesPayService.transaction_status("ext-1")
+
+    def test_statuses_are_mapped(self):
+        response = peoplespay_response(
+            200, success=True, data={"status": "SUCCESSFUL", "transactionId": "PP1"}
+        )
+        self.assertEqual(self.lookup(response), ("completed", "PP1"))
+
+    def test_not_found_needs_peoplespay_answer(self):
+        response = peoplespay_response(404, success=False, message="Not found")
+        self.assertEqual(self.lookup(response), ("not_found", None))
+
+    def test_bare_404_is_not_taken_as_not_found(self):
+        # a wrong status path answers like this too
+        response = peoplespay_response(404)
+        response.json.side_effect = ValueError
+        with self.assertRaises(PeoplesPayError):
+            self.lookup(response)
+
+    def test_failures_that_never_left_are_told_apart(self):
+        self.assertTrue(never_sent(refused()))
+        self.assertTrue(never_sent(PeoplesPayError("no token")))
+        self.assertFalse(never_sent(ReadTimeout()))
+        self.assertFalse(never_sent(ConnectionError("Connection aborted")))
@@ -4,11 +4,25 @@ from . import views
 
 urlpatterns = [
     path("payments/", views.PaymentsView.as_view()),
+    path(
+        "payments/<uuid:pk>/",
+        views.PaymentStatusView.as_view(),
+        name="payment-status",
+    ),
     path("collections/", views.CollectionsView.as_view()),
+    path(
+        "collections/<uuid:pk>/",
+        views.CollectionStatusView.as_view(),
+        name="collection-status",
+    ),
     path(
         "payment-callback/",
         views.PaymentCallbackAPIView.as_view(),
         name="payment-callback",
     ),
     path("token/", views.TokenView.as_view()),
+    # the same calls without holding a worker while PeoplesPay answers
+    path("async/payments/", views.AsyncPaymentsView.as_view()),
+    path("async/collections/", views.AsyncCollectionsView.as_view()),
+    path("async/card-payments/", views.AsyncCardPaymentView.as_view()),
 ]
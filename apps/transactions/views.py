@@ -1,11 +1,23 @@
 import collections
 import json
+import logging
 from urllib import request
 from django.shortcuts import render
 from django.conf import settings
-from rest_framework import status
+from rest_framework import exceptions, status
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.request import Request
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework.views import APIView
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from kombu.exceptions import OperationalError
+from redis import RedisError
 
 from .models import Payments, Collections, CollectionsCard
 from .serializers import (
@@ -15,10 +27,80 @@ from .serializers import (
     NameEnquirySerializer,
 )
 from .services import PeoplesPayService
+from .async_client import AsyncPeoplesPayClient
+from .tasks import collect_payment, disburse_payment
+from .idempotency import idempotent
 from django.urls import reverse
 import requests
 import uuid
 
+logger = logging.getLogger(__name__)
+
+
+def prefers_respond_async(request):
+    """
+    Whether the client sent Prefer: respond-async (RFC 7240)
+    """
+    preferences = request.headers.get("Prefer", "").split(",")
+    return any(
+        preference.split(";")[0].strip().lower() == "respond-async"
+        for preference in preferences
+    )
+
+
+def queues(request):
+    """
+    Whether to queue the request: the client sent Prefer: respond-async
+    (RFC 7240) and is authenticated, as only they can read the status.
+    Anonymous requests are processed synchronously, the preference is
+    optional for servers
+    """
+    return prefers_respond_async(request) and request.user.is_authenticated
+
+
+def enqueue(task, external_transaction_id):
+    """
+    Send the task for a queued row once the row is committed
+    """
+    pk = str(external_transaction_id)
+
+    def send():
+        try:
+            task.delay(pk)
+        except (OperationalError, RedisError):
+            # the row is saved, the requeue_payments task sends it later
+            logger.exception("Could not queue %s for %s", task.name, pk)
+
+    transaction.on_commit(send)
+
+
+def creator(request):
+    return request.user if request.user.is_authenticated else None
+
+
+def accepted(
+    request, external_transaction_id, status_url_name, response_class=Response
+):
+    """
+    202 for a queued collection or payment, pointing at its status endpoint,
+    the async views pass JsonResponse
+    """
+    status_url = request.build_absolute_uri(
+        reverse(status_url_name, args=[external_transaction_id])
+    )
+    response = response_class(
+        {
+            "message": "Accepted for processing",
+            "internal_id": str(external_transaction_id),
+            "status": "pending",
+            "status_url": status_url,
+        },
+        status=status.HTTP_202_ACCEPTED,
+    )
+    response["Location"] = status_url
+    response["Preference-Applied"] = "respond-async"
+    return response
+
 
 class TokenView(APIView):
     def get(self, request):
@@ -34,17 +116,12 @@ class TokenView(APIView):
 
 
 class PaymentsView(APIView):
+    @idempotent("payments")
     def post(self, request):
         payment_serializer = PaymentsSerializer(data=request.data)
-        # Get the token using the PeoplesPayService from the .get_token() method
         print(payment_serializer, f"payment serializer")
-        token = PeoplesPayService.get_token(operation="CREDIT")
-        print(token, f"token")
-        if token is None:
-            return Response(
-                {"message": "Failed to retrieve token"},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
+        if queues(request):
+            return self.queue(request, payment_serializer)
         if payment_serializer.is_valid():
             validated_data = payment_serializer.validated_data
             print(validated_data, f"validated data")
@@ -57,23 +134,20 @@ class PaymentsView(APIView):
             # "external_transaction_id": validated_data["external_transaction_id"],
             "description": validated_data["description"],
         }
-        disburse_headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {token['data']}",
-        }
         print(disburse_payload, f"Disburse payload")
 
         try:
-            disburse_response = requests.post(
-                f"{PeoplesPayService.BASE_URL}/disburse",
-                json=disburse_payload,
-                headers=disburse_headers,
+            # authenticated with a CREDIT token
+            disburse_response = PeoplesPayService.call(
+                "disburse", disburse_payload, operation="CREDIT"
             )
             disburse_data = disburse_response.json()
             print(disburse_data, f"disburse_data")
 
             if disburse_response.status_code == 200 and disburse_data.get("success"):
-                payment_serializer.save()  # Save payment record to the database
+                payment_serializer.save(
+                    transaction_status="completed", created_by=creator(request)
+                )  # Save payment record to the database
                 return Response(
                     {"message": "Payment processed successfully"},
                     status=status.HTTP_201_CREATED,
@@ -90,8 +164,52 @@ class PaymentsView(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
+    def queue(self, request, payment_serializer):
+        """
+        Save a queued payment and leave the disbursement to the
+        disburse_payment task
+        """
+        if not payment_serializer.is_valid():
+            return Response(
+                payment_serializer.errors, status=status.HTTP_400_BAD_REQUEST
+            )
+        payment = payment_serializer.save(
+            transaction_status="queued", created_by=request.user
+        )
+        enqueue(disburse_payment, payment.pk)
+        return accepted(request, payment.pk, "payment-status")
+
+
+class PaymentStatusView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        try:
+            payment = Payments.objects.get(pk=pk, created_by=request.user)
+        except Payments.DoesNotExist:
+            return Response(
+                {"error": "Transaction not found"}, status=status.HTTP_404_NOT_FOUND
+            )
+        return Response(
+            {
+                "internal_id": str(payment.external_transaction_id),
+                # queued is internal, the 202 promised pending
+                "status": (
+                    "pending"
+                    if payment.transaction_status == "queued"
+                    else payment.transaction_status
+                ),
+                "message": payment.status_message,
+                "amount": payment.amount,
+                "created_at": payment.created_at,
+                "updated_at": payment.updated_at,
+            },
+            status=status.HTTP_200_OK,
+        )
+
 
 class CollectionsView(APIView):
+    @idempotent("collections")
     def post(self, request):
         collection_serializer = CollectionsSerializer(data=request.data)
         # transaction_id = request.data.get("transactionId")
@@ -100,6 +218,9 @@ class CollectionsView(APIView):
         external_transaction_id = uuid.uuid4()
         print("take a look")
 
+        if queues(request):
+            return self.queue(request, collection_serializer, external_transaction_id)
+
         if collection_serializer.is_valid():
             print("if passed")
             validated_data = collection_serializer.validated_data
@@ -107,15 +228,6 @@ class CollectionsView(APIView):
             # Assign the external_transaction_id to the validated data after it is available
             validated_data["external_transaction_id"] = external_transaction_id
 
-            # Get the token using the PeoplesPayService
-            token = PeoplesPayService.get_token()
-            print(token)
-            if token is None:
-                return Response(
-                    {"message": "Failed to retrieve token"},
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
-
             # Process the collection
             collection_payload = {
                 "amount": str(validated_data["amount"]),
@@ -126,17 +238,11 @@ class CollectionsView(APIView):
                 "description": validated_data["description"],
                 "externalTransactionId": str(external_transaction_id),
             }
-            collection_headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {token['data']}",
-            }
 
             try:
                 print(collection_payload, f"trying to send collection")
-                collection_response = requests.post(
-                    f"{PeoplesPayService.BASE_URL}/collectmoney",
-                    json=collection_payload,
-                    headers=collection_headers,
+                collection_response = PeoplesPayService.call(
+                    "collectmoney", collection_payload
                 )
                 collection_data = collection_response.json()
                 print(collection_data, f"collection data")
@@ -153,6 +259,7 @@ class CollectionsView(APIView):
                     collection_serializer.save(
                         external_transaction_id=external_transaction_id,
                         transaction_id=transaction_id,  # Save the PeoplesPay ID
+                        created_by=creator(request),
                     )
                     # Create a corresponding payment entry with the same external_transaction_id
                     Payments.objects.create(
@@ -161,6 +268,7 @@ class CollectionsView(APIView):
                         account_name=validated_data["account_name"],
                         account_number=validated_data["account_number"],
                         account_issuer=validated_data["account_issuer"],
+                        created_by=creator(request),
                     )
                     return Response(
                         {
@@ -197,17 +305,58 @@ class CollectionsView(APIView):
             collection_serializer.errors, status=status.HTTP_400_BAD_REQUEST
         )
 
+    def queue(self, request, collection_serializer, external_transaction_id):
+        """
+        Save a pending collection under a placeholder PeoplesPay id and
+        leave the call to the collect_payment task
+        """
+        if not collection_serializer.is_valid():
+            return Response(
+                collection_serializer.errors, status=status.HTTP_400_BAD_REQUEST
+            )
+        collection_serializer.save(
+            external_transaction_id=external_transaction_id,
+            transaction_id=Collections.QUEUED_PREFIX + str(external_transaction_id),
+            transaction_status="pending",
+            created_by=request.user,
+        )
+        enqueue(collect_payment, external_transaction_id)
+        return accepted(request, external_transaction_id, "collection-status")
+
+
+class CollectionStatusView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        try:
+            collection = Collections.objects.get(pk=pk, created_by=request.user)
+        except Collections.DoesNotExist:
+            return Response(
+                {"error": "Transaction not found"}, status=status.HTTP_404_NOT_FOUND
+            )
+        # placeholders until PeoplesPay returns its id
+        peoplespay_id = collection.transaction_id
+        if peoplespay_id.startswith(
+            (Collections.QUEUED_PREFIX, Collections.SENDING_PREFIX)
+        ):
+            peoplespay_id = None
+        return Response(
+            {
+                "internal_id": str(collection.external_transaction_id),
+                "peoplespay_id": peoplespay_id,
+                "status": collection.transaction_status,
+                "message": collection.status_message,
+                "amount": collection.amount,
+                "created_at": collection.created_at,
+            },
+            status=status.HTTP_200_OK,
+        )
+
 
 # Helper function to check peoples pay for payment status
 def check_peoplespay_status(transaction_id):
-    url = f"{PeoplesPayService.BASE_URL}"
     print(request, f"looking at peoplespay")
-    token = PeoplesPayService.get_token()
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {token['data']}",
-    }
-    response = requests.get(url, headers=headers)
+    response = PeoplesPayService.call("", method="GET")
     if response.status_code == 200:
         return response.json().get(
             "status"
@@ -281,7 +430,6 @@ class PaymentCallbackAPIView(APIView):
 class NameEnquiryView(APIView):
     def post(self, request):
         serializer = NameEnquirySerializer(data=request.data)
-        token = PeoplesPayService.get_token()
         if serializer.is_valid():
             data = serializer.validated_data
             enquiry_payload = {
@@ -290,17 +438,8 @@ class NameEnquiryView(APIView):
                 "account_issuer": data["account_issuer"],
             }
             print(enquiry_payload, f"enquiry payload")
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {token['data']}",
-            }
-            print(headers, f"headers")
             try:
-                response = requests.post(
-                    f"{PeoplesPayService.BASE_URL}/enquiry",
-                    json=enquiry_payload,
-                    headers=headers,
-                )
+                response = PeoplesPayService.call("enquiry", enquiry_payload)
                 response_data = response.json()
                 print(response_data, f"response data")
                 if response.status_code == 200 and response_data.get("success"):
@@ -343,16 +482,6 @@ class CardPaymentAPIView(APIView):
             # Assign the external_transaction_id
             validated_data["external_transaction_id"] = external_transaction_id
 
-            # Get the token using PeoplesPayService
-            token = PeoplesPayService.get_token()
-            print("Retrieved token:", token)  # Debug token retrieval
-
-            if token is None:
-                return Response(
-                    {"message": "Failed to retrieve token"},
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
-
             # Prepare the payload
             card_payload = {
                 "account_name": validated_data["account_name"],
@@ -364,19 +493,9 @@ class CardPaymentAPIView(APIView):
             }
             print("Payload prepared for PeoplesPay:", card_payload)  # Debug payload
 
-            collection_headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {token['data']}",
-            }
-            print(
-                "Headers for PeoplesPay request:", collection_headers
-            )  # Debug headers
-
             try:
-                card_response = requests.post(
-                    f"{PeoplesPayService.BASE_URL}/collectmoney/card",
-                    json=card_payload,
-                    headers=collection_headers,
+                card_response = PeoplesPayService.call(
+                    "collectmoney/card", card_payload
                 )
                 print(
                     "Response from PeoplesPay:", card_response.text
@@ -439,4 +558,270 @@ class CardPaymentAPIView(APIView):
             print(
                 "Serializer is invalid. Errors:", card_serializer.errors
             )  # Debug serializer errors
-            return Response(card_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+            return Response(card_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+# Async versions of the payment views. DRF's APIView is sync only, so
+# these are plain Django views answering JSON. While PeoplesPay answers
+# they wait on the event loop instead of holding a worker thread, when
+# served through papss_config/asgi.py. docker/local/django/start runs
+# the WSGI dev server, where each request still gets its own thread.
+# They authenticate like the APIViews and handle Idempotency-Key and
+# Prefer: respond-async the same way.
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class AsyncPeoplesPayView(View):
+    client = AsyncPeoplesPayClient()
+
+    async def dispatch(self, request, *args, **kwargs):
+        error = await sync_to_async(self.authenticate)(request)
+        if error:
+            return error
+        return await super().dispatch(request, *args, **kwargs)
+
+    @staticmethod
+    def authenticate(request):
+        """
+        Sets request.user with the authentication classes the APIViews
+        use, CSRF checks for session users included. Returns the error
+        response DRF would send when the credentials are rejected
+        """
+        authenticators = [
+            authentication()
+            for authentication in api_settings.DEFAULT_AUTHENTICATION_CLASSES
+        ]
+        drf_request = Request(request, authenticators=authenticators)
+        try:
+            request.user = drf_request.user
+        except exceptions.APIException as error:
+            detail = error.detail
+            if not isinstance(detail, (list, dict)):
+                detail = {"detail": detail}
+            response = JsonResponse(detail, status=error.status_code, safe=False)
+            if isinstance(error, exceptions.AuthenticationFailed):
+                header = authenticators[0].authenticate_header(request)
+                if header:
+                    response["WWW-Authenticate"] = header
+                else:
+                    response.status_code = status.HTTP_403_FORBIDDEN
+            return response
+        return None
+
+    @staticmethod
+    async def validate(serializer_class, request):
+        """
+        Returns the bound serializer and an error response, one of them None
+        """
+        try:
+            data = json.loads(request.body or b"{}")
+        except ValueError:
+            return None, JsonResponse(
+                {"message": "Invalid JSON"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        serializer = serializer_class(data=data)
+        # validators may query the database
+        if not await sync_to_async(serializer.is_valid)():
+            return None, JsonResponse(
+                serializer.errors, status=status.HTTP_400_BAD_REQUEST
+            )
+        return serializer, None
+
+
+class AsyncPaymentsView(AsyncPeoplesPayView):
+    @idempotent("payments")
+    async def post(self, request):
+        payment_serializer, error = await self.validate(PaymentsSerializer, request)
+        if error:
+            return error
+        if queues(request):
+            return await sync_to_async(self.queue)(request, payment_serializer)
+        validated_data = payment_serializer.validated_data
+        disburse_payload = {
+            "amount": str(validated_data["amount"]),
+            "account_number": validated_data["account_number"],
+            "account_name": validated_data["account_name"],
+            "account_issuer": validated_data["account_issuer"],
+            "description": validated_data.get("description"),
+        }
+        try:
+            disburse_response = await self.client.call(
+                "disburse", disburse_payload, operation="CREDIT"
+            )
+            disburse_data = disburse_response.json()
+        except requests.exceptions.RequestException as e:
+            return JsonResponse(
+                {"message": f"Error processing payment: {str(e)}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        if disburse_response.status_code == 200 and disburse_data.get("success"):
+            await sync_to_async(payment_serializer.save)(
+                transaction_status="completed", created_by=creator(request)
+            )
+            return JsonResponse(
+                {"message": "Payment processed successfully"},
+                status=status.HTTP_201_CREATED,
+            )
+        return JsonResponse(
+            {"message": disburse_data.get("message", "Payment failed")},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    @staticmethod
+    def queue(request, payment_serializer):
+        # as PaymentsView.queue
+        payment = payment_serializer.save(
+            transaction_status="queued", created_by=request.user
+        )
+        enqueue(disburse_payment, payment.pk)
+        return accepted(request, payment.pk, "payment-status", JsonResponse)
+
+
+class AsyncCollectionsView(AsyncPeoplesPayView):
+    @idempotent("collections")
+    async def post(self, request):
+        collection_serializer, error = await self.validate(
+            CollectionsSerializer, request
+        )
+        if error:
+            return error
+        validated_data = collection_serializer.validated_data
+        external_transaction_id = uuid.uuid4()
+        if queues(request):
+            return await sync_to_async(self.queue)(
+                request, collection_serializer, external_transaction_id
+            )
+        collection_payload = {
+            "amount": str(validated_data["amount"]),
+            "account_number": validated_data["account_number"],
+            "account_name": validated_data["account_name"],
+            "account_issuer": validated_data["account_issuer"],
+            "callbackUrl": validated_data.get("callbackUrl"),
+            "description": validated_data.get("description"),
+            "externalTransactionId": str(external_transaction_id),
+        }
+        try:
+            collection_response = await self.client.call(
+                "collectmoney", collection_payload
+            )
+            collection_data = collection_response.json()
+        except requests.exceptions.RequestException as e:
+            return JsonResponse(
+                {"message": f"Error processing collection: {str(e)}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        transaction_id = collection_data.get("transactionId")
+        if not (
+            collection_response.status_code == 200
+            and collection_data.get("success")
+            and transaction_id
+        ):
+            return JsonResponse(
+                {"message": collection_data.get("message", "Collection failed")},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        await sync_to_async(self.record)(
+            collection_serializer,
+            external_transaction_id,
+            transaction_id,
+            creator(request),
+        )
+        return JsonResponse(
+            {
+                "message": collection_data["message"],
+                "internal_id": str(external_transaction_id),
+                "peoplespay_id": transaction_id,
+                "collectin_status": collection_data["success"],
+                "collection_code": collection_data["code"],
+            },
+            status=status.HTTP_201_CREATED,
+        )
+
+    @staticmethod
+    @transaction.atomic
+    def record(
+        collection_serializer, external_transaction_id, transaction_id, created_by
+    ):
+        # the collection and its payment entry, as CollectionsView saves them
+        validated_data = collection_serializer.validated_data
+        collection_serializer.save(
+            external_transaction_id=external_transaction_id,
+            transaction_id=transaction_id,
+            created_by=created_by,
+        )
+        Payments.objects.create(
+            external_transaction_id=external_transaction_id,
+            amount=validated_data["amount"],
+            account_name=validated_data["account_name"],
+            account_number=validated_data["account_number"],
+            account_issuer=validated_data["account_issuer"],
+            created_by=created_by,
+        )
+
+    @staticmethod
+    def queue(request, collection_serializer, external_transaction_id):
+        # as CollectionsView.queue
+        collection_serializer.save(
+            external_transaction_id=external_transaction_id,
+            transaction_id=Collections.QUEUED_PREFIX + str(external_transaction_id),
+            transaction_status="pending",
+            created_by=request.user,
+        )
+        enqueue(collect_payment, external_transaction_id)
+        return accepted(
+            request, external_transaction_id, "collection-status", JsonResponse
+        )
+
+
+class AsyncCardPaymentView(AsyncPeoplesPayView):
+    async def post(self, request):
+        card_serializer, error = await self.validate(CollectionsCardSerializer, request)
+        if error:
+            return error
+        validated_data = card_serializer.validated_data
+        external_transaction_id = uuid.uuid4()
+        card_payload = {
+            "account_name": validated_data["account_name"],
+            "amount": validated_data["amount"],
+            "card": validated_data["card"],
+            "description": validated_data["description"],
+            "callbackUrl": validated_data["callbackUrl"],
+            "clientRedirectUrl": validated_data["clientRedirectUrl"],
+        }
+        try:
+            card_response = await self.client.call("collectmoney/card", card_payload)
+            card_data = card_response.json()
+        except requests.exceptions.RequestException as e:
+            return JsonResponse(
+                {"message": f"Error processing collection: {str(e)}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        card_transaction_id = card_data.get("transactionId")
+        if not (
+            card_response.status_code == 200
+            and card_data.get("success")
+            and card_transaction_id
+        ):
+            return JsonResponse(
+                {"message": card_data.get("message", "Transaction failed")},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        await sync_to_async(card_serializer.save)(
+            external_transaction_id=external_transaction_id,
+            card_transaction_id=card_transaction_id,
+        )
+        return JsonResponse(
+            {
+                "message": "Collection processed successfully",
+                "external_transaction_id": str(external_transaction_id),
+                "card_transaction_id": card_transaction_id,
+                "collection_status": card_data["success"],
+                "redirect_url": card_data["redirectUrl"],
+            },
+            status=status.HTTP_201_CREATED,
+        )
@@ -228,6 +228,10 @@ MERCHANTID = env("PEOPLES_PAY_MERCHANT_ID")
 
 APIKEY = env("PEOPLES_PAY_API_KEY")
 
+# Seconds a PeoplesPay token is assumed valid for when the token response
+# doesn't say when it expires
+PEOPLES_PAY_TOKEN_LIFETIME = env.int("PEOPLES_PAY_TOKEN_LIFETIME", default=300)
+
 CELERY_BROKER_URL = env("CELERY_BROKER")
 
 CELERY_RESULT_BACKEND = env("CELERY_BACKEND")
@@ -235,3 +239,87 @@ CELERY_RESULT_BACKEND = env("CELERY_BACKEND")
 CELERY_TIMEZONE = "Africa/Accra"
 
 CELERY_WORKER_MAX_TASKS_PER_CHILD = 100
+
+# PeoplesPay calls run on their own workers, see celery/payments/start
+CELERY_TASK_ROUTES = {
+    "apps.transactions.tasks.collect_payment": {"queue": "payments"},
+    "apps.transactions.tasks.disburse_payment": {"queue": "payments"},
+    "apps.transactions.tasks.reconcile_payments": {"queue": "payments"},
+}
+
+CELERY_BEAT_SCHEDULE = {
+    "flush-product-views": {
+        "task": "apps.inventory.tasks.flush_product_views",
+        "schedule": 60.0,
+    },
+    # corrects counts changed by bulk updates that send no signals
+    "rebuild-category-counts": {
+        "task": "apps.inventory.tasks.rebuild_category_counts",
+        "schedule": 3600.0,
+    },
+    "build-search-indexes": {
+        "task": "apps.inventory.tasks.build_search_indexes",
+        "schedule": 60.0,
+    },
+    # uploads whose ingest task was never sent
+    "requeue-media-uploads": {
+        "task": "apps.inventory.tasks.requeue_media_uploads",
+        "schedule": 300.0,
+    },
+    "refresh-stats": {
+        "task": "apps.inventory.tasks.refresh_stats",
+        "schedule": 300.0,
+    },
+    # queued payments whose task was never sent
+    "requeue-payments": {
+        "task": "apps.transactions.tasks.requeue_payments",
+        "schedule": 300.0,
+    },
+    # settles queued payments left processing, enable once
+    # client.STATUS_ENDPOINT is confirmed against PeoplesPay's API docs
+    # "reconcile-payments": {
+    #     "task": "apps.transactions.tasks.reconcile_payments",
+    #     "schedule": 300.0,
+    # },
+    "prune-idempotency-keys": {
+        "task": "apps.transactions.tasks.prune_idempotency_keys",
+        "schedule": 86400.0,
+    },
+}
+
+# Redis database used for application data (search indexes, counters),
+# kept apart from the celery broker database
+REDIS_URL = env("REDIS_URL", default="redis://redis:6379/1")
+
+# Redis instance for Django's cache, capped and evicting, see docker-compose.yml
+CACHE_REDIS_URL = env("CACHE_REDIS_URL", default="redis://redis-cache:6379/0")
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": CACHE_REDIS_URL,
+        "KEY_PREFIX": "papss",
+    }
+}
+
+# Search result id lists, entries with more ids than this are not cached
+SEARCH_CACHE_TIMEOUT = 60 * 5
+SEARCH_CACHE_MAX_IDS = 1000
+
+# Cached stats counts, refreshed by the refresh_stats task, outlives its schedule
+STATS_CACHE_TIMEOUT = 60 * 15
+
+# A term matches a document when at least this share of its trigrams is
+# found in the indexed text, roughly the old fuzz.partial_ratio > 60 cut-off
+TRIGRAM_SIMILARITY_THRESHOLD = 0.5
+
+# Filter backend used by the product and company search views,
+# "utils.fuzzysearch.FuzzySearchFilter" disables MySQL full-text search
+SEARCH_FILTER_BACKEND = env(
+    "SEARCH_FILTER_BACKEND", default="utils.search.FullTextSearchFilter"
+)
+
+# Stage base64 images and documents sent to create-product, edit-product
+# and create-quotation and decode them in celery workers instead of inside
+# the request
+ASYNC_MEDIA_INGESTION = env.bool("ASYNC_MEDIA_INGESTION", default=False)
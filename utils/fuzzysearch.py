@@ -1,8 +1,74 @@
+import logging
+import re
+from functools import lru_cache
+
 from django.db.models import Q
+from django_countries import countries
 from django_countries.fields import CountryField
+from redis import RedisError
 from rest_framework import filters
 import fuzzywuzzy.fuzz as fuzz
 
+from utils import trigram
+
+logger = logging.getLogger(__name__)
+
+# Names people search with that differ from the django_countries ones
+COUNTRY_ALIASES = {
+    "AE": ["UAE", "Emirates"],
+    "CD": ["DRC", "DR Congo", "Congo-Kinshasa"],
+    "CG": ["Congo-Brazzaville", "Republic of the Congo"],
+    "CI": ["Ivory Coast", "Cote d'Ivoire"],
+    "CV": ["Cape Verde"],
+    "GB": ["UK", "Great Britain", "Britain", "England"],
+    "KR": ["Korea"],
+    "SZ": ["Swaziland"],
+    "US": ["USA", "America", "United States"],
+}
+
+COUNTRY_NAME_STOPWORDS = {"and", "of", "the"}
+
+
+@lru_cache(maxsize=1)
+def country_table():
+    """
+    (code, alpha3, words) for every country, words holds the lowercased
+    names, aliases and the individual words they are made of
+    """
+    table = []
+    for code, name in countries:
+        names = [name.lower()] + [
+            alias.lower() for alias in COUNTRY_ALIASES.get(code, [])
+        ]
+        words = set(names)
+        for country_name in names:
+            words.update(re.findall(r"[\w']+", country_name))
+        table.append(
+            (
+                code.lower(),
+                (countries.alpha3(code) or "").lower(),
+                words - COUNTRY_NAME_STOPWORDS,
+            )
+        )
+    return table
+
+
+@lru_cache(maxsize=1024)
+def match_countries(term):
+    """
+    Country codes matching the term once against the ~250 countries instead
+    of every row: an exact alpha-2/alpha-3 code, a name or word starting
+    with the term, or a name or word within typo distance of it
+    """
+    term = term.lower()
+    return frozenset(
+        code.upper()
+        for code, alpha3, words in country_table()
+        if term in (code, alpha3)
+        or (len(term) >= 3 and any(word.startswith(term) for word in words))
+        or any(fuzz.ratio(word, term) >= 80 for word in words)
+    )
+
 
 class FuzzySearchFilter(filters.SearchFilter):
     def filter_queryset(self, request, queryset, view):
@@ -11,31 +77,43 @@ class FuzzySearchFilter(filters.SearchFilter):
         if not search_terms:
             return queryset
 
+        q_objects = self.get_fuzzy_q(queryset, search_terms, view.search_fields)
+        return queryset.filter(q_objects).distinct()
+
+    def get_fuzzy_q(self, queryset, search_terms, search_fields):
         q_objects = Q()
+        # primary keys found through the trigram index, applied as one pk__in
+        matched_pks = set()
         for term in search_terms:
-            for field in view.search_fields:
+            for field in search_fields:
                 # Check if the field is a CountryField
                 model_field = queryset.model._meta.get_field(field)
                 if isinstance(model_field, CountryField):
                     # Handle CountryField specifically
-                    for obj in queryset:
-                        country = getattr(obj, field)
-                        if country and (
-                            fuzz.partial_ratio(country.name.lower(), term.lower()) > 60
-                            or fuzz.partial_ratio(country.code.lower(), term.lower())
-                            > 60
-                        ):
-                            q_objects |= Q(pk=obj.pk)
-                else:
-                    # Handle other fields
-                    q_objects |= Q(**{f"{field}__icontains": term})
-                    for obj in queryset:
-                        field_value = getattr(obj, field)
-                        if (
-                            isinstance(field_value, str)
-                            and fuzz.partial_ratio(field_value.lower(), term.lower())
-                            > 60
-                        ):
-                            q_objects |= Q(pk=obj.pk)
+                    codes = match_countries(term)
+                    if codes:
+                        q_objects |= Q(**{f"{field}__in": codes})
+                    continue
 
-        return queryset.filter(q_objects).distinct()
+                # Handle other fields
+                q_objects |= Q(**{f"{field}__icontains": term})
+                index = trigram.get_index(queryset.model, field)
+                if index is not None:
+                    try:
+                        matched_pks |= index.search(term)
+                        continue
+                    except trigram.IndexNotBuilt:
+                        logger.warning("Trigram index for %s is not built", field)
+                    except RedisError:
+                        logger.exception("Trigram index unavailable for %s", field)
+                for obj in queryset:
+                    field_value = getattr(obj, field)
+                    if (
+                        isinstance(field_value, str)
+                        and fuzz.partial_ratio(field_value.lower(), term.lower()) > 60
+                    ):
+                        q_objects |= Q(pk=obj.pk)
+
+        if matched_pks:
+            q_objects |= Q(pk__in=matched_pks)
+        return q_objects
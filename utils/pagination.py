@@ -0,0 +1,133 @@
+import base64
+import json
+
+from django.db.models import Q, QuerySet
+from rest_framework.exceptions import NotFound
+from rest_framework.filters import SearchFilter
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset (cursor) pagination on the view's cursor_ordering, e.g.
+    ("-updated_at", "-id"). The cursor holds the ordering values of the
+    last row sent, so the next page is a range read on the matching
+    composite index and costs the same however deep it is.
+
+    Only applied when the client sends ?cursor= or ?page_size=, without
+    them the view keeps returning the full list.
+
+    Search results keep the ranking of the search backends, which has no
+    keyset, so with ?search= the cursor holds an offset into the results
+    instead.
+    """
+
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    page_size = 20
+    max_page_size = 100
+    ordering = ("-id",)
+    invalid_cursor_message = "Invalid cursor"
+
+    def get_ordering(self, view):
+        return getattr(view, "cursor_ordering", self.ordering)
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if (
+            self.cursor_query_param not in request.query_params
+            and self.page_size_query_param not in request.query_params
+        ):
+            return None
+        if not isinstance(queryset, QuerySet) or queryset.query.is_sliced:
+            return None
+
+        self.request = request
+        self.ranked = bool(SearchFilter().get_search_terms(request))
+        self.ordering = self.get_ordering(view)
+        page_size = self.get_page_size(request)
+
+        position = self.decode_cursor(request)
+        if self.ranked:
+            self.offset = position or 0
+            results = list(queryset[self.offset : self.offset + page_size + 1])
+        else:
+            queryset = queryset.order_by(*self.ordering)
+            if position is not None:
+                queryset = queryset.filter(self.get_position_filter(position))
+            results = list(queryset[: page_size + 1])
+        self.has_next = len(results) > page_size
+        self.page = results[:page_size]
+        return self.page
+
+    def get_position_filter(self, position):
+        """
+        Rows strictly after position in the ordering:
+        (a < x) OR (a = x AND b < y) OR ...
+        """
+        q_objects = Q()
+        equal = {}
+        for field, value in zip(self.ordering, position):
+            name = field.lstrip("-")
+            lookup = "lt" if field.startswith("-") else "gt"
+            q_objects |= Q(**equal, **{f"{name}__{lookup}": value})
+            equal[name] = value
+        return q_objects
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            position = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if self.ranked:
+            valid = type(position) is int and position >= 0
+        else:
+            valid = isinstance(position, list) and len(position) == len(self.ordering)
+        if not valid:
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+    def encode_cursor(self, instance):
+        if self.ranked:
+            position = self.offset + len(self.page)
+            return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+        position = []
+        for field in self.ordering:
+            value = getattr(instance, field.lstrip("-"))
+            # full precision, DjangoJSONEncoder drops microseconds
+            position.append(
+                value.isoformat() if hasattr(value, "isoformat") else str(value)
+            )
+        return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(),
+            self.cursor_query_param,
+            self.encode_cursor(self.page[-1]),
+        )
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
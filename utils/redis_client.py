@@ -0,0 +1,13 @@
+from functools import lru_cache
+
+import redis
+from django.conf import settings
+
+
+@lru_cache(maxsize=None)
+def get_redis():
+    """
+    Shared client for application data kept in Redis,
+    the connection pool is created once per process
+    """
+    return redis.Redis.from_url(settings.REDIS_URL)
@@ -0,0 +1,83 @@
+"""
+Search backends for the catalog list views.
+
+The backend is chosen with the SEARCH_FILTER_BACKEND setting so views can
+switch between MySQL full-text search and plain fuzzy matching.
+"""
+from django.conf import settings
+from django.db import connection, models
+from django.db.models import F, FloatField, Func, Q
+from django.utils.module_loading import import_string
+
+from utils.fuzzysearch import FuzzySearchFilter
+
+
+class FullTextIndex(models.Index):
+    """
+    FULLTEXT index on MySQL, a regular index on other databases
+    """
+
+    def create_sql(self, model, schema_editor, using="", **kwargs):
+        if schema_editor.connection.vendor == "mysql":
+            kwargs["sql"] = "CREATE FULLTEXT INDEX %(name)s ON %(table)s (%(columns)s)"
+        return super().create_sql(model, schema_editor, using=using, **kwargs)
+
+
+class MatchAgainst(Func):
+    """
+    MATCH (fields) AGAINST (query) relevance score, the fields must be
+    covered by a single FullTextIndex
+    """
+
+    output_field = FloatField()
+
+    def __init__(self, fields, query):
+        super().__init__(*[F(field) for field in fields])
+        self.query = query
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        sql, params = super().as_sql(
+            compiler,
+            connection,
+            template="MATCH (%(expressions)s) AGAINST (%%s IN NATURAL LANGUAGE MODE)",
+            **extra_context,
+        )
+        return sql, (*params, self.query)
+
+
+class FullTextSearchFilter(FuzzySearchFilter):
+    """
+    Filters and orders by MATCH ... AGAINST relevance on the view's
+    fulltext_fields, the remaining search_fields (e.g. CountryField) are
+    matched fuzzily. Fuzzy matching on every field is only used as a
+    typo-tolerant fallback when the full-text search has no hits.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        search_terms = self.get_search_terms(request)
+        fulltext_fields = getattr(view, "fulltext_fields", None)
+
+        if not search_terms or not fulltext_fields or connection.vendor != "mysql":
+            return super().filter_queryset(request, queryset, view)
+
+        q_objects = Q(relevance__gt=0)
+        other_fields = [
+            field for field in view.search_fields if field not in fulltext_fields
+        ]
+        if other_fields:
+            q_objects |= self.get_fuzzy_q(queryset, search_terms, other_fields)
+
+        ranked = (
+            queryset.annotate(
+                relevance=MatchAgainst(fulltext_fields, " ".join(search_terms))
+            )
+            .filter(q_objects)
+            .order_by("-relevance", *queryset.query.order_by)
+        )
+        if ranked.exists():
+            return ranked
+        return super().filter_queryset(request, queryset, view)
+
+
+def get_search_backend():
+    return import_string(settings.SEARCH_FILTER_BACKEND)
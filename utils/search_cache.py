@@ -0,0 +1,108 @@
+"""
+Cache of search result ids for the list views.
+
+Entries are keyed on the normalized search terms, the view's filtering
+query params, staff vs public access and a per-model generation counter.
+Saving a model bumps its generation once the transaction commits, so every
+entry built from older data stops being looked up and expires with its TTL.
+"""
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, IntegerField, QuerySet, When
+from rest_framework.filters import SearchFilter
+
+GENERATION_KEY = "search:generation:{}"
+
+
+def _generation_key(model):
+    return GENERATION_KEY.format(model._meta.label_lower)
+
+
+def get_generations(models):
+    keys = [_generation_key(model) for model in models]
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            generations[key] = cache.get_or_set(key, 1, timeout=None)
+    return [generations[key] for key in keys]
+
+
+def bump_generation(*models):
+    def bump():
+        for model in models:
+            key = _generation_key(model)
+            try:
+                cache.incr(key)
+            except ValueError:
+                # counter was lost, start from a value no older entry can have
+                cache.set(key, time.time_ns(), timeout=None)
+
+    # after commit, so a search in between can't cache the old results
+    # under the new generation
+    transaction.on_commit(bump)
+
+
+class SearchCacheMixin:
+    """
+    List view mixin caching the ids returned by the filter backends.
+    Views opt in by listing the models their results depend on in
+    search_cache_models and the query params that change the queryset
+    in search_cache_params.
+    """
+
+    search_cache_models = ()
+    search_cache_params = ()
+
+    def get_search_cache_key(self, search_terms):
+        request = self.request
+        payload = {
+            "view": self.__class__.__name__,
+            "terms": sorted({term.lower() for term in search_terms}),
+            "params": {
+                param: request.query_params.get(param)
+                for param in self.search_cache_params
+            },
+            "staff": bool(request.user.is_staff or request.user.is_superuser),
+            "generations": get_generations(self.search_cache_models),
+        }
+        digest = hashlib.sha256(
+            json.dumps(payload, sort_keys=True, default=str).encode()
+        ).hexdigest()
+        return f"search:results:{digest}"
+
+    def filter_queryset(self, queryset):
+        search_terms = SearchFilter().get_search_terms(self.request)
+        if (
+            not search_terms
+            or not self.search_cache_models
+            or not isinstance(queryset, QuerySet)
+            or queryset.query.is_sliced
+        ):
+            return super().filter_queryset(queryset)
+
+        key = self.get_search_cache_key(search_terms)
+        ids = cache.get(key)
+        if ids is None:
+            results = super().filter_queryset(queryset)
+            max_ids = settings.SEARCH_CACHE_MAX_IDS
+            ids = list(
+                dict.fromkeys(results.values_list("pk", flat=True)[: max_ids + 1])
+            )
+            if len(ids) > max_ids:
+                # too large to be worth caching
+                return results
+            cache.set(key, ids, settings.SEARCH_CACHE_TIMEOUT)
+
+        if not ids:
+            return queryset.none()
+        # keep the ranking the filter backends produced
+        position = Case(
+            *[When(pk=pk, then=index) for index, pk in enumerate(ids)],
+            output_field=IntegerField(),
+        )
+        return queryset.filter(pk__in=ids).order_by(position)
@@ -0,0 +1,95 @@
+from django.core.exceptions import FieldDoesNotExist
+
+
+class EagerLoadingMixin:
+    """
+    For read serializers whose fields follow relations. Each serializer
+    field lists the select_related/prefetch_related lookups it reads, and
+    list views pass their queryset through setup_eager_loading so the
+    number of queries stays the same however many rows are serialized.
+
+    Views can ask for a sparse fieldset with sparse_fieldsets(request) in
+    the serializer context: "fields" limits the fields serialized, and
+    passing the same fields to setup_eager_loading loads only the columns
+    and relations they read. Fields in expandable_fields render the
+    related objects in full when named in "expand".
+    """
+
+    select_related_fields = {}
+    prefetch_related_fields = {}
+    # columns read by fields that aren't a model field of the same name
+    only_fields = {}
+    # columns read by a field when it's expanded
+    expandable_fields = {}
+
+    @classmethod
+    def setup_eager_loading(cls, queryset, fields=None, expand=(), required=()):
+        """
+        With fields, only those fields' lookups are made and only their
+        columns loaded, plus the required columns the view itself reads
+        (ordering, search fields)
+        """
+
+        def lookups(mapping):
+            return {
+                lookup
+                for name, lookups in mapping.items()
+                if fields is None or name in fields
+                for lookup in lookups
+            }
+
+        select_related = lookups(cls.select_related_fields)
+        prefetch_related = lookups(cls.prefetch_related_fields)
+        if select_related:
+            queryset = queryset.select_related(*sorted(select_related))
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*sorted(prefetch_related))
+        if fields is not None:
+            queryset = queryset.only(
+                *sorted(
+                    cls.sparse_columns(queryset.model, fields, expand) | set(required)
+                )
+            )
+        return queryset
+
+    @classmethod
+    def sparse_columns(cls, model, fields, expand=()):
+        columns = set()
+        for name in fields:
+            if name in expand and name in cls.expandable_fields:
+                columns.update(cls.expandable_fields[name])
+            elif name in cls.only_fields:
+                columns.update(cls.only_fields[name])
+            elif name in cls.select_related_fields:
+                columns.update(cls.select_related_fields[name])
+            else:
+                try:
+                    field = model._meta.get_field(name)
+                except FieldDoesNotExist:
+                    continue
+                if field.concrete and not field.many_to_many:
+                    columns.add(name)
+        return columns
+
+    def get_fields(self):
+        fields = super().get_fields()
+        requested = self.context.get("fields")
+        if requested is None:
+            return fields
+        return {name: field for name, field in fields.items() if name in requested}
+
+    def is_expanded(self, name):
+        return name in self.context.get("expand", ())
+
+
+def sparse_fieldsets(request):
+    """
+    Serializer context for ?fields=name,price&expand=seller, fields is
+    None when every field is wanted
+    """
+
+    def names(param):
+        value = request.query_params.get(param, "")
+        return frozenset(name.strip() for name in value.split(",") if name.strip())
+
+    return {"fields": names("fields") or None, "expand": names("expand")}
@@ -0,0 +1,209 @@
+"""
+Character-trigram index kept in Redis.
+
+Every indexed field gets one Redis set per trigram holding the primary keys
+of the rows whose text contains it, plus one set per row with the trigrams
+it was indexed under so updates only touch the grams that changed.
+A lookup reads the posting sets of the search term's trigrams and keeps the
+rows that share enough of them, so it never scans the table.
+
+Indexes are built outside requests, by the build_search_indexes task and
+the rebuild_trigram_index command. Until one is built its searches raise
+IndexNotBuilt and the search filter falls back to scanning.
+"""
+import logging
+import re
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from redis import RedisError
+
+from utils.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+WORD_RE = re.compile(r"\w+")
+
+
+def trigrams(text):
+    """
+    Split text into words and return the set of padded trigrams,
+    "tea" -> {"  t", " te", "tea", "ea "}
+    """
+    grams = set()
+    for word in WORD_RE.findall((text or "").lower()):
+        padded = f"  {word} "
+        grams.update(padded[i : i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class IndexNotBuilt(Exception):
+    pass
+
+
+class TrigramIndex:
+    KEY_PREFIX = "trigram"
+    BUILD_CHUNK_SIZE = 2000
+
+    def __init__(self, model, field):
+        self.model = model
+        self.field = field
+        self.name = f"{model._meta.label_lower}.{field}"
+
+    def _key(self, *parts):
+        return ":".join((self.KEY_PREFIX, self.name) + parts)
+
+    def _to_pk(self, value):
+        return self.model._meta.pk.to_python(value.decode())
+
+    def _index(self, pipe, pk, grams, old_grams=frozenset()):
+        for gram in old_grams - grams:
+            pipe.srem(self._key("gram", gram), pk)
+        for gram in grams - old_grams:
+            pipe.sadd(self._key("gram", gram), pk)
+        doc_key = self._key("doc", str(pk))
+        pipe.delete(doc_key)
+        if grams:
+            pipe.sadd(doc_key, *grams)
+
+    def add(self, pk, text):
+        client = get_redis()
+        old_grams = {
+            gram.decode() for gram in client.smembers(self._key("doc", str(pk)))
+        }
+        pipe = client.pipeline()
+        self._index(pipe, pk, trigrams(text), old_grams)
+        pipe.execute()
+
+    def remove(self, pk):
+        self.add(pk, "")
+
+    def add_new(self, rows):
+        """
+        Index (pk, text) rows that were never indexed, in one round trip
+        """
+        pipe = get_redis().pipeline(transaction=False)
+        for pk, text in rows:
+            self._index(pipe, pk, trigrams(text))
+        pipe.execute()
+
+    def build(self, rebuild=True):
+        """
+        (Re)build the whole index from the database in chunks, with
+        rebuild=False only when it isn't built yet
+        """
+        client = get_redis()
+        lock_key = self._key("lock")
+        with client.lock(lock_key, timeout=600):
+            # built by whoever held the lock before us
+            if not rebuild and self.is_built():
+                return False
+            keys = [
+                key
+                for key in client.scan_iter(match=self._key("*"), count=1000)
+                if key.decode() != lock_key
+            ]
+            for start in range(0, len(keys), 1000):
+                client.unlink(*keys[start : start + 1000])
+
+            pipe = client.pipeline(transaction=False)
+            rows = self.model._default_manager.values_list("pk", self.field)
+            for count, (pk, text) in enumerate(
+                rows.iterator(chunk_size=self.BUILD_CHUNK_SIZE), start=1
+            ):
+                self._index(pipe, pk, trigrams(text))
+                if count % self.BUILD_CHUNK_SIZE == 0:
+                    pipe.execute()
+            pipe.set(self._key("built"), 1)
+            pipe.execute()
+        return True
+
+    def is_built(self):
+        return bool(get_redis().exists(self._key("built")))
+
+    def search(self, term, threshold=None):
+        """
+        Return the primary keys of the rows sharing at least `threshold`
+        of the term's trigrams, raises IndexNotBuilt until it's built
+        """
+        if threshold is None:
+            threshold = settings.TRIGRAM_SIMILARITY_THRESHOLD
+        grams = trigrams(term)
+        if not grams:
+            return set()
+        if not self.is_built():
+            raise IndexNotBuilt(self.name)
+
+        pipe = get_redis().pipeline(transaction=False)
+        for gram in grams:
+            pipe.smembers(self._key("gram", gram))
+        hits = Counter()
+        for members in pipe.execute():
+            hits.update(members)
+
+        required = threshold * len(grams)
+        return {self._to_pk(pk) for pk, count in hits.items() if count >= required}
+
+
+_registry = {}
+
+
+def get_index(model, field):
+    return _registry.get((model, field))
+
+
+def registered_indexes():
+    return list(_registry.values())
+
+
+def register(model, *fields):
+    """
+    Index the given text fields of model and keep them up to date
+    from post_save/post_delete
+    """
+    for field in fields:
+        _registry[(model, field)] = TrigramIndex(model, field)
+    post_save.connect(
+        _update_instance, sender=model, weak=False, dispatch_uid=f"trigram-{model}"
+    )
+    post_delete.connect(
+        _remove_instance, sender=model, weak=False, dispatch_uid=f"trigram-{model}"
+    )
+
+
+def _model_indexes(model):
+    return [index for (m, _), index in _registry.items() if m is model]
+
+
+def _update_instance(sender, instance, update_fields=None, **kwargs):
+    indexes = [
+        index
+        for index in _model_indexes(sender)
+        if update_fields is None or index.field in update_fields
+    ]
+    values = [(index, getattr(instance, index.field)) for index in indexes]
+
+    def update():
+        try:
+            for index, text in values:
+                index.add(instance.pk, text)
+        except RedisError:
+            logger.exception("Could not update trigram index for %s", instance.pk)
+
+    if values:
+        transaction.on_commit(update)
+
+
+def _remove_instance(sender, instance, **kwargs):
+    pk = instance.pk
+
+    def remove():
+        try:
+            for index in _model_indexes(sender):
+                index.remove(pk)
+        except RedisError:
+            logger.exception("Could not remove %s from trigram index", pk)
+
+    transaction.on_commit(remove)